@@ -16,7 +16,8 @@
 
 from pathlib import Path
 
-from decouple import Config, RepositoryEmpty, RepositoryEnv
+from core.patient_queue._base import DEFAULT_RETRY_DELAYS
+from decouple import Config, Csv, RepositoryEmpty, RepositoryEnv
 
 env_file = Path.cwd() / ".env"
 config = Config(RepositoryEnv(env_file)) if env_file.exists() else Config(RepositoryEmpty())
@@ -52,6 +53,9 @@ SERVICE_SETTINGS = {
     },
 }
 
+# Delays of the queues that messages wait in before being retried, see PixlConsumer
+RETRY_DELAYS = config("PIXL_RETRY_DELAYS", default=DEFAULT_RETRY_DELAYS, cast=Csv(cast=int))
+
 
 class APIConfig:
     """API Configuration"""
@@ -26,7 +26,7 @@ from core.patient_queue.producer import PixlProducer
 from decouple import config
 from loguru import logger
 
-from pixl_cli._config import SERVICE_SETTINGS
+from pixl_cli._config import RETRY_DELAYS, SERVICE_SETTINGS
 from pixl_cli._database import exported_images_for_project, filter_exported_or_add_to_db
 
 if TYPE_CHECKING:
@@ -133,6 +133,7 @@ def _message_count(queues_to_populate: list[str]) -> int:
     for queue in queues_to_count:
         with PixlBlockingInterface(queue_name=queue, **SERVICE_SETTINGS["rabbitmq"]) as rabbitmq:
             messages_in_queues += rabbitmq.message_count
+            messages_in_queues += rabbitmq.retry_message_count(RETRY_DELAYS)
 
     return messages_in_queues
 
@@ -153,7 +154,7 @@ def populate_queue_and_db(
 
         messages = messages_from_df(messages_df)
         with PixlProducer(queue_name=queue, **SERVICE_SETTINGS["rabbitmq"]) as producer:
-            producer.publish(messages, priority=messages_priority)
+            producer.publish_in_batches(messages, priority=messages_priority)
         output_messages.extend(messages)
 
     return output_messages
@@ -32,6 +32,7 @@ from opentelemetry.instrumentation.pika import PikaInstrumentor
 from pixl_cli._config import (
     HOST_EXPORT_ROOT_DIR,
     PIXL_ROOT,
+    RETRY_DELAYS,
     SERVICE_SETTINGS,
     api_config_for_queue,
     config,
@@ -283,18 +284,36 @@ def start(queues: str, rate: float | None) -> None:
     required=True,
     help="Rate at which to process items from a queue (in items per second)",
 )
-def update(queues: str, rate: float | None) -> None:
+@click.option(
+    "--key",
+    default=None,
+    help="Only update the rate for this key, e.g. a project name, giving it its own share",
+)
+@click.option(
+    "--capacity",
+    type=int,
+    default=None,
+    help="Maximum number of items that can be processed at once for the key",
+)
+def update(queues: str, rate: float | None, key: str | None, capacity: int | None) -> None:
     """Update one or a list of consumers with a defined rate"""
-    _start_or_update_extract(queues=queues.split(","), rate=rate)
+    if capacity is not None and key is None:
+        msg = "Can only set the capacity for a key"
+        raise click.UsageError(msg)
+    _start_or_update_extract(queues=queues.split(","), rate=rate, key=key, capacity=capacity)
 
 
-def _start_or_update_extract(queues: list[str], rate: float | None) -> None:
+def _start_or_update_extract(
+    queues: list[str], rate: float | None, key: str | None = None, capacity: int | None = None
+) -> None:
     """Start or update the rate of extraction for a list of queue names"""
     for queue in queues:
-        _update_extract_rate(queue_name=queue, rate=rate)
+        _update_extract_rate(queue_name=queue, rate=rate, key=key, capacity=capacity)
 
 
-def _update_extract_rate(queue_name: str, rate: float | None) -> None:
+def _update_extract_rate(
+    queue_name: str, rate: float | None, key: str | None = None, capacity: int | None = None
+) -> None:
     logger.info("Updating the extraction rate")
 
     api_config = api_config_for_queue(queue_name)
@@ -310,12 +329,16 @@ def _update_extract_rate(queue_name: str, rate: float | None) -> None:
 
     response = requests.post(
         url=f"{api_config.base_url}/token-bucket-refresh-rate",
-        json={"rate": rate},
+        json={"rate": rate, "key": key, "capacity": capacity},
         timeout=10,
     )
 
     success_code = 200
-    if response.status_code == success_code:
+    if response.status_code == success_code and key is not None:
+        logger.success(
+            "Updated {} extraction for {}, with a rate of {} queries/second", queue_name, key, rate
+        )
+    elif response.status_code == success_code:
         logger.success("Updated {} extraction, with a rate of {} queries/second", queue_name, rate)
 
     else:
@@ -351,6 +374,7 @@ def stop(queues: str, purge: bool) -> None:  # noqa: FBT001 bool argument
             logger.info("Purging queue {}", queue)
             with PixlProducer(queue_name=queue, **SERVICE_SETTINGS["rabbitmq"]) as producer:
                 producer.clear_queue()
+                producer.clear_retry_queues(RETRY_DELAYS)
 
 
 @cli.command()
@@ -369,7 +393,28 @@ def kill() -> None:
 def status(queues: str) -> None:
     """Get the status of the PIXL consumers"""
     for queue in queues.split(","):
-        logger.info(f"[{queue:^10s}] refresh rate = ", _get_extract_rate(queue))
+        logger.info(f"[{queue:^10s}] refresh rate = {{}}", _get_extract_rate(queue))
+        stats = _get_consumer_stats(queue)
+        if stats is None:
+            continue
+        outcomes = ", ".join(f"{name}={count}" for name, count in stats["outcomes"].items())
+        latencies = ", ".join(
+            f"{name}={latency:.2f}s" for name, latency in stats["latency_percentiles"].items()
+        )
+        tokens = stats["tokens"]
+        logger.info(
+            f"[{queue:^10s}] in flight = {{}}, paused = {{}}, seconds until token = {{}}",
+            stats["in_flight"],
+            tokens["paused"],
+            tokens["seconds_until_token"],
+        )
+        logger.info(f"[{queue:^10s}] outcomes: {{}}", outcomes)
+        logger.info(f"[{queue:^10s}] latency: {{}}", latencies or "no messages processed")
+        if stats["last_error"] is not None:
+            logger.info(
+                f"[{queue:^10s}] last error at {{time}} for {{message}}: {{error}}",
+                **stats["last_error"],
+            )
 
 
 def _get_extract_rate(queue_name: str) -> str:
@@ -395,6 +440,27 @@ def _get_extract_rate(queue_name: str) -> str:
         return "unknown"
 
 
+def _get_consumer_stats(queue_name: str) -> dict[str, Any] | None:
+    """
+    Get the statistics of the consumer of a queue, from the API that consumes from it
+
+    :param queue_name: Name of the queue to get the statistics of (e.g. imaging-primary)
+    :return: The statistics, or None if the API doesn't consume from the queue or isn't up
+    """
+    api_config = api_config_for_queue(queue_name)
+    success_code = 200
+    try:
+        response = requests.get(url=f"{api_config.base_url}/consumer-stats", timeout=10)
+    except requests.exceptions.ConnectionError:
+        logger.error("Failed to get the consumer statistics for {}", queue_name)
+        return None
+    if response.status_code != success_code:
+        logger.error("Failed to get the consumer statistics for {}: {}", queue_name, response.text)
+        return None
+    stats: dict[str, Any] | None = response.json().get(queue_name)
+    return stats
+
+
 def queue_is_up() -> Any:
     """Checks if the queue is up"""
     with PixlProducer(queue_name="") as producer:
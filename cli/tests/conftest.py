@@ -246,8 +246,8 @@ def rows_in_session(db_session) -> Session:
 
 @pytest.fixture
 def mock_publisher(mocker) -> Generator[Mock, None, None]:
-    """Patched publisher that does nothing, returns MagicMock of the publish method."""
+    """Patched publisher that does nothing, returns MagicMock of the publish_in_batches method."""
     mocker.patch.object(PixlProducer, "__init__", return_value=None)
     mocker.patch.object(PixlProducer, "__enter__", return_value=PixlProducer)
     mocker.patch.object(PixlProducer, "__exit__")
-    return mocker.patch.object(PixlProducer, "publish")
+    return mocker.patch.object(PixlProducer, "publish_in_batches")
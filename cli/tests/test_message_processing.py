@@ -32,11 +32,11 @@ def _zero_message_count(monkeypatch: MonkeyPatch) -> None:
 
 @pytest.fixture
 def mock_publisher(mocker) -> Generator[Mock, None, None]:
-    """Patched publisher that does nothing, returns MagicMock of the publish method."""
+    """Patched publisher that does nothing, returns MagicMock of the publish_in_batches method."""
     mocker.patch.object(PixlProducer, "__init__", return_value=None)
     mocker.patch.object(PixlProducer, "__enter__", return_value=PixlProducer)
     mocker.patch.object(PixlProducer, "__exit__")
-    return mocker.patch.object(PixlProducer, "publish")
+    return mocker.patch.object(PixlProducer, "publish_in_batches")
 
 
 @pytest.mark.usefixtures("_zero_message_count")
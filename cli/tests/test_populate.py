@@ -39,8 +39,8 @@ class MockProducer(PixlProducer):
         """Context exit point."""
         return
 
-    def publish(self, messages: list[Message], priority: int) -> None:  # noqa: ARG002 don't access messages or priority
-        """Dummy method for publish."""
+    def publish_in_batches(self, messages: list[Message], priority: int) -> None:  # noqa: ARG002 don't access messages or priority
+        """Dummy method for publish_in_batches."""
         return
 
 
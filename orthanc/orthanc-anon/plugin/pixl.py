@@ -22,19 +22,21 @@ This module:
 from __future__ import annotations
 
 import json
+import multiprocessing
 import os
 import threading
 import traceback
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from io import BytesIO
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
 from time import sleep
 from typing import TYPE_CHECKING, cast
 from zipfile import ZipFile
 
-import pydicom
 import requests
-from core.exceptions import PixlDiscardError, PixlSkipInstanceError
+from core.exceptions import PixlDiscardError
 from core.project_config.pixl_config_model import load_project_config
 from core.telemetry import configure_logging, configure_tracing
 from decouple import config
@@ -46,21 +48,23 @@ from opentelemetry.propagate import extract
 from pixl_dcmd._database import engine as pixl_db_engine
 from pixl_dcmd.dicom_helpers import get_study_info
 from pixl_dcmd.main import (
-    anonymise_dicom_and_update_db,
+    anonymise_instance,
     get_series_to_skip,
     parse_validation_results,
-    write_dataset_to_bytes,
 )
 from pydicom import dcmread
 
 import orthanc
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from concurrent.futures import Future
     from typing import Any
 
     from core.project_config.pixl_config_model import PixlConfig
     from opentelemetry.context import Context
     from pixl_dcmd.dicom_helpers import StudyInfo
+    from pixl_dcmd.main import InstanceResult, PseudoIdentifiers
 
 ORTHANC_USERNAME = config("ORTHANC_USERNAME")
 ORTHANC_PASSWORD = config("ORTHANC_PASSWORD")
@@ -92,6 +96,23 @@ executor = ThreadPoolExecutor(max_workers=max_workers)
 
 logger.info("Using {} threads for processing", max_workers)
 
+# Opt-in pool of processes that anonymise the instances of each study in parallel, started when
+# it's first needed. With 0, each study's instances are anonymised in its thread.
+instance_processes = config("PIXL_ANON_INSTANCE_PROCESSES", default=0, cast=int)
+instance_process_pool: ProcessPoolExecutor | None = None
+instance_process_pool_lock = threading.Lock()
+
+# Python of the virtual environment created in the Orthanc Dockerfile
+INSTANCE_PROCESS_PYTHON = "/.venv/bin/python"
+
+# Studies downloaded from orthanc-raw, and their anonymised instances, are kept in memory up to
+# this many bytes, and spooled to disk beyond that
+STUDY_SPOOL_MAX_SIZE = config("PIXL_ANON_STUDY_SPOOL_MAX_SIZE", default=64 * 1024 * 1024, cast=int)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+if instance_processes:
+    logger.info("Using {} processes to anonymise the instances of studies", instance_processes)
+
 
 def AzureAccessToken() -> str:
     """
@@ -322,27 +343,31 @@ def _anonymise_study_and_upload(
     project_name: str,
     series_to_keep: list[str],
 ) -> str | None:
-    zipped_study_bytes = get_study_zip_archive_from_raw(resource_id=study_resource_id)
-
-    study_info = _get_study_info_from_first_file(zipped_study_bytes)
     with (
-        tracer.start_as_current_span(name="anonymise_study"),
-        logger.contextualize(
-            mrn=study_info.mrn,
-            accession_number=study_info.accession_number,
-            study_uid=study_info.study_uid,
-        ),
+        get_study_zip_archive_from_raw(resource_id=study_resource_id) as zipped_study_file,
+        ZipFile(zipped_study_file) as zipped_study,
     ):
-        logger.info("Processing project '{}', {}", project_name, study_info)
+        study_info = _get_study_info_from_first_file(zipped_study)
+        with (
+            tracer.start_as_current_span(name="anonymise_study"),
+            logger.contextualize(
+                mrn=study_info.mrn,
+                accession_number=study_info.accession_number,
+                study_uid=study_info.study_uid,
+            ),
+            SpooledTemporaryFile(max_size=STUDY_SPOOL_MAX_SIZE) as anonymised_study_file,
+        ):
+            logger.info("Processing project '{}', {}", project_name, study_info)
 
-        with ZipFile(zipped_study_bytes) as zipped_study:
             try:
-                anonymised_instances_bytes, anonymised_study_uid = _anonymise_study_instances(
-                    zipped_study=zipped_study,
-                    study_info=study_info,
-                    project_name=project_name,
-                    series_to_keep=series_to_keep,
-                )
+                with ZipFile(anonymised_study_file, "w") as anonymised_study:
+                    anonymised_study_uid = _anonymise_study_instances(
+                        zipped_study=zipped_study,
+                        anonymised_study=anonymised_study,
+                        study_info=study_info,
+                        project_name=project_name,
+                        series_to_keep=series_to_keep,
+                    )
             except PixlDiscardError as discard:
                 logger.warning(
                     "Failed to anonymize project: '{}', {}: {}", project_name, study_info, discard
@@ -352,96 +377,96 @@ def _anonymise_study_and_upload(
                 logger.exception("Failed to anonymize project: '{}', {}", project_name, study_info)
                 return None
 
-        with logger.contextualize(pseudo_study_uid=anonymised_study_uid):
-            _upload_instances(anonymised_instances_bytes)
-            logger.info("Anonymised and uploaded study")
+            with logger.contextualize(pseudo_study_uid=anonymised_study_uid):
+                _upload_instances(anonymised_study_file)
+                logger.info("Anonymised and uploaded study")
+
+            return anonymised_study_uid
 
-        return anonymised_study_uid
 
+@contextmanager
+def get_study_zip_archive_from_raw(resource_id: str) -> Iterator[SpooledTemporaryFile[bytes]]:
+    """
+    Download zip archive of study resource from Orthanc Raw.
 
-def get_study_zip_archive_from_raw(resource_id: str) -> BytesIO:
-    """Download zip archive of study resource from Orthanc Raw."""
+    The archive is streamed into a file that's kept in memory up to STUDY_SPOOL_MAX_SIZE bytes,
+    and spooled to disk beyond that, which is removed on exit.
+    """
     query = f"{ORTHANC_RAW_URL}/studies/{resource_id}/archive"
-    response = requests.get(
-        query,
-        auth=(config("ORTHANC_RAW_USERNAME"), config("ORTHANC_RAW_PASSWORD")),
-        timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=180, cast=int),
-    )
-    response.raise_for_status()
-    logger.debug("Downloaded data for resource {} from Orthanc Raw", resource_id)
-    return BytesIO(response.content)
+    with (
+        SpooledTemporaryFile(max_size=STUDY_SPOOL_MAX_SIZE) as zipped_study_file,
+        requests.get(
+            query,
+            auth=(config("ORTHANC_RAW_USERNAME"), config("ORTHANC_RAW_PASSWORD")),
+            timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=180, cast=int),
+            stream=True,
+        ) as response,
+    ):
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            zipped_study_file.write(chunk)
+        # Release the connection while the study is anonymised
+        response.close()
+        zipped_study_file.seek(0)
+        logger.debug("Downloaded data for resource {} from Orthanc Raw", resource_id)
+        yield zipped_study_file
 
 
-def _get_study_info_from_first_file(zipped_study_bytes) -> StudyInfo:
-    with ZipFile(zipped_study_bytes) as zipped_study:
-        file_info = zipped_study.infolist()[0]
-        with zipped_study.open(file_info) as file:
-            dataset = dcmread(file)
-            return get_study_info(dataset)
+def _get_study_info_from_first_file(zipped_study: ZipFile) -> StudyInfo:
+    file_info = zipped_study.infolist()[0]
+    with zipped_study.open(file_info) as file:
+        dataset = dcmread(file, stop_before_pixels=True)
+        return get_study_info(dataset)
 
 
 def _anonymise_study_instances(
     zipped_study: ZipFile,
+    anonymised_study: ZipFile,
     study_info: StudyInfo,
     project_name: str,
     series_to_keep: list[str],
-) -> tuple[list[bytes], str]:
+) -> str:
     """
-    Iterate over all instances and anonymise them.
+    Iterate over all instances and anonymise them, in the instance process pool if it's enabled.
 
     Skip an instance if a PixlSkipInstanceError is raised during anonymisation.
 
-    Return a list of the bytes of anonymised instances, and the anonymised StudyInstanceUID.
+    Each instance is read from the zipped study when it's anonymised, and written to the
+    anonymised study as soon as it has been, so only the instances being anonymised are in memory.
+
+    Return the anonymised StudyInstanceUID.
     """
     config = load_project_config(project_name)
     series_to_skip = get_series_to_skip(zipped_study, config.min_instances_per_series)
-    anonymised_instances_bytes = []
-    skipped_instance_counts = defaultdict(int)
-    dicom_validation_errors = {}
-
-    for file_info in zipped_study.infolist():
-        with zipped_study.open(file_info) as file:
-            logger.debug("Reading file {}", file)
-            dataset = dcmread(file)
-
-            if series_to_keep and dataset.SeriesInstanceUID not in series_to_keep:
-                logger.debug(
-                    "Skipping series {} for study {} as series not in series_to_keep",
-                    dataset.SeriesInstanceUID,
-                    study_info,
-                )
-                key = "DICOM instance discarded as series not requested"
-                skipped_instance_counts[key] += 1
-                continue
-
-            if dataset.SeriesInstanceUID in series_to_skip:
-                logger.debug(
-                    "Skipping series {} for study {} due to too few instances",
-                    dataset.SeriesInstanceUID,
-                    study_info,
-                )
-                key = "DICOM instance discarded as series has too few instances"
-                skipped_instance_counts[key] += 1
-                continue
+    anonymised_instances = 0
+    skipped_instance_counts: defaultdict[str, int] = defaultdict(int)
+    dicom_validation_errors: dict = {}
 
-            try:
-                anonymised_instance, instance_validation_errors = _anonymise_dicom_instance(
-                    dataset, config
-                )
-            except PixlSkipInstanceError as e:
-                logger.debug(
-                    "Skipping instance {} for {}: {}",
-                    dataset[0x0008, 0x0018].value,
-                    study_info,
-                    e,
-                )
-                skipped_instance_counts[str(e)] += 1
-            else:
-                anonymised_instances_bytes.append(anonymised_instance)
-                anonymised_study_uid = dataset[0x0020, 0x000D].value
-                dicom_validation_errors |= instance_validation_errors
+    if instance_processes:
+        results = _anonymise_instances_in_processes(
+            zipped_study, config, series_to_keep, series_to_skip
+        )
+    else:
+        results = (
+            anonymise_instance(
+                zipped_study.read(file_info),
+                config,
+                series_to_keep=series_to_keep,
+                series_to_skip=series_to_skip,
+            )
+            for file_info in zipped_study.infolist()
+        )
+
+    for result in results:
+        if result.instance is None:
+            skipped_instance_counts[cast("str", result.skip_reason)] += 1
+            continue
+        anonymised_study.writestr(f"instance{anonymised_instances}.dcm", result.instance)
+        anonymised_instances += 1
+        anonymised_study_uid = cast("PseudoIdentifiers", result.pseudo_identifiers).study_uid
+        dicom_validation_errors |= result.validation_errors
 
-    if not anonymised_instances_bytes:
+    if not anonymised_instances:
         message = f"All instances have been skipped for study: {dict(skipped_instance_counts)}"
         raise PixlDiscardError(message)
 
@@ -459,20 +484,112 @@ def _anonymise_study_instances(
                 parse_validation_results(dicom_validation_errors),
             )
         logger.success("Finished anonymising project: '{}', {}", project_name, study_info)
-    return anonymised_instances_bytes, anonymised_study_uid
+    return anonymised_study_uid
 
 
-def _anonymise_dicom_instance(dataset: pydicom.Dataset, config: PixlConfig) -> tuple[bytes, dict]:
-    """Anonymise a DICOM instance."""
-    validation_errors = anonymise_dicom_and_update_db(dataset, config=config)
-    return write_dataset_to_bytes(dataset), validation_errors
+def _anonymise_instances_in_processes(
+    zipped_study: ZipFile,
+    config: PixlConfig,
+    series_to_keep: list[str],
+    series_to_skip: set[str],
+) -> Iterator[InstanceResult]:
+    """
+    Anonymise the instances of a study in the instance process pool, yielding their results in
+    order.
 
+    Instances are anonymised here until one isn't skipped, which synchronises the pseudonymised
+    identifiers of the study with the PIXL database. The other instances are then given the same
+    identifiers by the pool's workers, without using the database. At most two instances per
+    worker are sent to the pool at a time, to bound the memory used for them.
 
-def _upload_instances(instances_bytes: list[bytes]) -> None:
-    """Upload instances to Orthanc"""
-    files = []
-    for index, dicom_bytes in enumerate(instances_bytes):
-        files.append(("file", (f"instance{index}.dcm", dicom_bytes, "application/dicom")))
+    If a worker dies, e.g. killed for running out of memory, the pool is broken and can't be used
+    again. It's then shut down, so that the next study starts a new pool, and the error is raised
+    for this study.
+    """
+    file_infos = iter(zipped_study.infolist())
+    for file_info in file_infos:
+        result = anonymise_instance(
+            zipped_study.read(file_info),
+            config,
+            series_to_keep=series_to_keep,
+            series_to_skip=series_to_skip,
+        )
+        yield result
+        if result.pseudo_identifiers is not None:
+            pseudo_identifiers = result.pseudo_identifiers
+            break
+    else:
+        return
+
+    pending: deque[Future[InstanceResult]] = deque()
+    pool = _get_instance_process_pool()
+    try:
+        for file_info in file_infos:
+            pending.append(
+                pool.submit(
+                    anonymise_instance,
+                    zipped_study.read(file_info),
+                    config,
+                    series_to_keep=series_to_keep,
+                    series_to_skip=series_to_skip,
+                    pseudo_identifiers=pseudo_identifiers,
+                )
+            )
+            if len(pending) >= 2 * instance_processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        _reset_instance_process_pool(pool)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _get_instance_process_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for anonymising instances, started when it's first needed and shared by the
+    studies being anonymised. Each worker compiles the anonymisation plan of a project once, and
+    reuses it for all of the project's instances that it anonymises.
+    """
+    global instance_process_pool
+    with instance_process_pool_lock:
+        if instance_process_pool is None:
+            context = multiprocessing.get_context("spawn")
+            # Orthanc embeds Python, so the interpreter of the environment that our packages are
+            # installed in must be given to start the workers
+            context.set_executable(INSTANCE_PROCESS_PYTHON)
+            instance_process_pool = ProcessPoolExecutor(
+                max_workers=instance_processes,
+                mp_context=context,
+                initializer=configure_logging,
+                initargs=(logging_level,),
+            )
+        return instance_process_pool
+
+
+def _reset_instance_process_pool(pool: ProcessPoolExecutor) -> None:
+    """
+    Shut down a broken instance process pool, so that a new one is started when it's next needed.
+    The pool is only forgotten if it's still the current one, as another study may already have
+    replaced it.
+    """
+    global instance_process_pool
+    with instance_process_pool_lock:
+        if instance_process_pool is pool:
+            logger.error("Instance process pool is broken, a new one will be started")
+            instance_process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _upload_instances(anonymised_study_file: SpooledTemporaryFile[bytes]) -> None:
+    """Upload the zip archive of anonymised instances to Orthanc"""
+    size = anonymised_study_file.tell()
+    anonymised_study_file.seek(0)
+    # Streamed from disk if it was spooled there. Otherwise, it's no larger than
+    # STUDY_SPOOL_MAX_SIZE, and requests would move it to disk to get its size.
+    data = anonymised_study_file.read() if size <= STUDY_SPOOL_MAX_SIZE else anonymised_study_file
 
     # Using requests as doing:
     # `upload_response = orthanc.RestApiPost(f"/instances", anonymised_files)`
@@ -480,7 +597,8 @@ def _upload_instances(instances_bytes: list[bytes]) -> None:
     upload_response = requests.post(
         url=f"{ORTHANC_URL}/instances",
         auth=(ORTHANC_USERNAME, ORTHANC_PASSWORD),
-        files=files,
+        data=data,
+        headers={"content-type": "application/zip"},
         timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=180, cast=int),
     )
     upload_response.raise_for_status()
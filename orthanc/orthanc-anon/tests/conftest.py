@@ -0,0 +1,55 @@
+#  Copyright (c) 2022 University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+The plugin can only be imported by Orthanc's embedded interpreter, which provides the `orthanc`
+module, so it's imported here with a stand-in for that module.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+from unittest.mock import MagicMock
+
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from types import ModuleType
+
+PLUGIN_PATH = Path(__file__).parents[1] / "plugin" / "pixl.py"
+
+os.environ["ORTHANC_USERNAME"] = "orthanc"
+os.environ["ORTHANC_PASSWORD"] = "orthanc"
+os.environ["ORTHANC_RAW_USERNAME"] = "orthanc"
+os.environ["ORTHANC_RAW_PASSWORD"] = "orthanc"
+os.environ["PIXL_MAX_MESSAGES_IN_FLIGHT"] = "1"
+os.environ["OTEL_SDK_DISABLED"] = "true"
+
+
+@pytest.fixture(scope="session")
+def plugin() -> Generator[ModuleType]:
+    """The orthanc-anon plugin, imported with a mock of Orthanc's module."""
+    sys.modules["orthanc"] = MagicMock()
+    spec = importlib.util.spec_from_file_location("pixl_anon_plugin", PLUGIN_PATH)
+    assert spec is not None
+    assert spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    module.executor.shutdown()
+    del sys.modules["orthanc"]
@@ -0,0 +1,81 @@
+#  Copyright (c) 2022 University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests of anonymising studies in the orthanc-anon plugin."""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import TYPE_CHECKING, Any
+from zipfile import ZipFile
+
+import pytest
+from pixl_dcmd.main import InstanceResult, PseudoIdentifiers
+
+if TYPE_CHECKING:
+    from types import ModuleType
+
+PSEUDO_IDENTIFIERS = PseudoIdentifiers(study_uid="1.2.3", patient_id="pseudo-mrn")
+
+
+def _anonymise_in_thread(*_args: Any, **_kwargs: Any) -> InstanceResult:
+    return InstanceResult(instance=b"anonymised", pseudo_identifiers=PSEUDO_IDENTIFIERS)
+
+
+def _kill_worker(*_args: Any, **_kwargs: Any) -> InstanceResult:
+    # Exit as a worker killed for running out of memory would, without reporting back to the pool
+    os._exit(1)
+
+
+@pytest.fixture
+def zipped_study() -> ZipFile:
+    """A study of three instances, which aren't read by the stand-ins for anonymising them."""
+    study = BytesIO()
+    with ZipFile(study, "w") as writer:
+        for instance in range(3):
+            writer.writestr(f"instance{instance}.dcm", b"instance")
+    return ZipFile(study)
+
+
+def test_broken_instance_process_pool_is_replaced(
+    plugin: ModuleType, zipped_study: ZipFile, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Given a pool of processes for anonymising instances, whose worker dies
+    When a study is anonymised in the pool
+    Then the study fails, and the broken pool is shut down and replaced for the next study
+    """
+    monkeypatch.setattr(plugin, "instance_processes", 1)
+    monkeypatch.setattr(plugin, "INSTANCE_PROCESS_PYTHON", sys.executable)
+    monkeypatch.setattr(plugin, "anonymise_instance", _anonymise_in_thread)
+    broken_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+    monkeypatch.setattr(plugin, "instance_process_pool", broken_pool)
+
+    results = plugin._anonymise_instances_in_processes(zipped_study, None, [], set())
+    # The first instance is anonymised in this process, and the others in the pool
+    assert next(results).pseudo_identifiers == PSEUDO_IDENTIFIERS
+    monkeypatch.setattr(plugin, "anonymise_instance", _kill_worker)
+    with pytest.raises(BrokenProcessPool):
+        list(results)
+
+    assert plugin.instance_process_pool is None
+    new_pool = plugin._get_instance_process_pool()
+    try:
+        assert new_pool is not broken_pool
+    finally:
+        new_pool.shutdown()
@@ -64,3 +64,32 @@ class Image(Base):
             f"{self.image_id=} {self.accession_number=} {self.mrn=} {self.study_uid=}"
             f"{self.pseudo_study_uid} {self.extract_id}>"
         ).replace(" self.", " ")
+
+
+class TokenBucketState(Base):
+    """token_bucket table, for token buckets shared by all replicas of a service"""
+
+    __tablename__ = "token_bucket"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    tokens: Mapped[float]
+    # Seconds since the epoch, as monotonic clocks aren't shared between hosts
+    replenished_at: Mapped[float]
+
+    def __repr__(self) -> str:
+        """Nice representation for printing."""
+        return f"<{self.__class__.__name__} {self.key=} {self.tokens=}>".replace(" self.", " ")
+
+
+class TokenBucketRate(Base):
+    """token_bucket_rate table, for the rates of token buckets shared by all replicas"""
+
+    __tablename__ = "token_bucket_rate"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    rate: Mapped[float]
+    capacity: Mapped[int | None]
+
+    def __repr__(self) -> str:
+        """Nice representation for printing."""
+        return f"<{self.__class__.__name__} {self.key=} {self.rate=}>".replace(" self.", " ")
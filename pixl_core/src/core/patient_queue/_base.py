@@ -14,11 +14,26 @@
 from __future__ import annotations
 
 import os
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import pika
 from loguru import logger
 
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# Seconds to wait before each successive retry of a message, the last is used for further retries
+DEFAULT_RETRY_DELAYS = "1,10,60"
+RETRY_COUNT_HEADER = "x-retry-count"
+
+
+def retry_queue_name(queue_name: str, delay: int) -> str:
+    """
+    Name of the queue holding messages from `queue_name` for `delay` seconds, before they are
+    dead-lettered back to `queue_name` to be retried.
+    """
+    return f"{queue_name}.retry.{delay}s"
+
 
 class PixlQueueInterface:
     def __init__(
@@ -50,6 +65,10 @@ class PixlQueueInterface:
         self._channel: Any = None
         self._queue: Any = None
 
+    @property
+    def _url(self) -> str:
+        return f"amqp://{self._username}:{self._password}@{self._host}:{self._port}/"
+
 
 class PixlBlockingInterface(PixlQueueInterface):
     def __enter__(self) -> Any:
@@ -90,3 +109,29 @@ class PixlBlockingInterface(PixlQueueInterface):
         except (ValueError, TypeError):
             logger.exception("Failed to determine the number of messages. Returning 0")
             return 0
+
+    def retry_message_count(self, delays: Iterable[int]) -> int:
+        """Number of messages from this queue waiting in its retry queues."""
+        count = 0
+        for delay in delays:
+            # Checking for a queue that doesn't exist closes the channel, so use one per queue
+            channel = self._connection.channel()
+            try:
+                declared = channel.queue_declare(
+                    queue=retry_queue_name(self.queue_name, delay), passive=True
+                )
+            except pika.exceptions.ChannelClosedByBroker:
+                continue
+            count += int(declared.method.message_count)
+            channel.close()
+        return count
+
+    def clear_retry_queues(self, delays: Iterable[int]) -> None:
+        """Purge the messages from this queue that are waiting in its retry queues."""
+        for delay in delays:
+            channel = self._connection.channel()
+            try:
+                channel.queue_purge(queue=retry_queue_name(self.queue_name, delay))
+            except pika.exceptions.ChannelClosedByBroker:
+                continue
+            channel.close()
@@ -15,16 +15,19 @@
 
 from __future__ import annotations
 
+import json
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any
+from datetime import date, datetime
+from typing import Any
 
 from jsonpickle import decode, encode
-
-if TYPE_CHECKING:
-    from datetime import date, datetime
-
 from loguru import logger
 
+# Version of the fields in a serialised message, increment when they change
+SCHEMA_VERSION = 1
+CONTENT_TYPE = "application/json"
+SCHEMA_VERSION_HEADER = "x-pixl-schema-version"
+
 
 @dataclass
 class Message:
@@ -50,13 +53,42 @@ class Message:
         """
         Serialise the message into a JSON string and convert to bytes.
 
-        :param deserialisable: If True, the serialised message will be deserialisable, by setting
-            the unpicklable flag to False in jsonpickle.encode(), meaning that the original Message
-            object can be recovered by `deserialise()`. If False, calling `deserialise()` on the
-            serialised message will return a dictionary.
+        :param deserialisable: If True, the message is serialised as a compact JSON object of its
+            fields and `schema_version`, from which the original Message object can be recovered
+            by `deserialise()`. If False, it is serialised with jsonpickle.encode() without class
+            metadata, and calling `deserialise()` on the serialised message will return a
+            dictionary.
         """
         logger.trace("Serialising {}", self)
-        return str.encode(encode(self, unpicklable=deserialisable))
+        if not deserialisable:
+            return str.encode(encode(self, unpicklable=False))
+
+        fields = {
+            name: value.isoformat() if isinstance(value, date) else value
+            for name, value in vars(self).items()
+        }
+        return json.dumps(
+            {"schema_version": SCHEMA_VERSION, **fields}, separators=(",", ":")
+        ).encode()
+
+    @classmethod
+    def from_fields(cls, fields: dict[str, Any]) -> Message:
+        """Build a message from the fields of a message serialised by `serialise()`."""
+        if fields["schema_version"] != SCHEMA_VERSION:
+            msg = f"Unsupported message schema version {fields['schema_version']}"
+            raise ValueError(msg)
+        return cls(
+            mrn=fields["mrn"],
+            accession_number=fields["accession_number"],
+            study_uid=fields["study_uid"],
+            series_uid=fields["series_uid"],
+            study_date=_parse_date(fields["study_date"]),
+            procedure_occurrence_id=fields["procedure_occurrence_id"],
+            project_name=fields["project_name"],
+            extract_generated_timestamp=datetime.fromisoformat(
+                fields["extract_generated_timestamp"]
+            ),
+        )
 
 
 def deserialise(serialised_msg: bytes) -> Any:
@@ -65,6 +97,19 @@ def deserialise(serialised_msg: bytes) -> Any:
     If the message was serialised with `deserialisable=True`, the original Message object will be
     returned. Otherwise, a dictionary will be returned.
 
+    Messages serialised with jsonpickle by previous versions of PIXL, which may still be queued,
+    are detected and deserialised with jsonpickle.
+
     :param serialised_msg: The serialised message.
     """
+    fields = json.loads(serialised_msg)
+    if isinstance(fields, dict) and "schema_version" in fields:
+        return Message.from_fields(fields)
     return decode(serialised_msg)  # noqa: S301, since we control the input, so no security risks
+
+
+def _parse_date(value: str) -> date:
+    # Some sources give the study date as a datetime
+    if "T" in value:
+        return datetime.fromisoformat(value)
+    return date.fromisoformat(value)
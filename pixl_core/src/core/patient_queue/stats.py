@@ -0,0 +1,162 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Statistics of the messages processed by a consumer, since it started."""
+
+from __future__ import annotations
+
+import datetime
+import statistics
+from collections import Counter, deque
+from enum import StrEnum
+from typing import TYPE_CHECKING, Protocol
+
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# Number of the most recent processing times that the percentiles are taken from
+LATENCY_WINDOW = 1000
+PERCENTILES = (50, 90, 99)
+
+
+class Outcome(StrEnum):
+    """What happened to a message delivered to a consumer"""
+
+    success = "success"
+    # Waiting in a retry queue, because the callback asked for it or there was no token
+    requeued = "requeued"
+    throttled = "throttled"
+    rerouted = "rerouted"
+    out_of_hours = "out_of_hours"
+    # Returned to the front of the queue, as the consumer had run out of tokens
+    returned = "returned"
+    discarded = "discarded"
+    failed = "failed"
+
+
+class LastError(BaseModel):
+    """The most recent message that was discarded or failed"""
+
+    time: datetime.datetime
+    message: str
+    outcome: Outcome
+    error: str
+
+
+class TokenAvailability(BaseModel):
+    """Tokens for the key of a consumer"""
+
+    rate: float
+    seconds_until_token: float | None
+    paused: bool
+
+
+class ConsumerStatus(BaseModel):
+    """Statistics of a consumer, and its tokens"""
+
+    queue: str
+    in_flight: int
+    outcomes: dict[Outcome, int]
+    latency_percentiles: dict[str, float]
+    tokens: TokenAvailability
+    last_error: LastError | None = None
+
+
+class StatusReporter(Protocol):
+    """Reports the status of a consumer, e.g. `PixlConsumer`"""
+
+    def status(self) -> ConsumerStatus:
+        """Statistics of the messages consumed so far, and the tokens for the consumer."""
+        ...
+
+
+class ConsumerStats:
+    """
+    Counts of the outcomes of the messages processed by a consumer, and the time taken to process
+    the most recent of them.
+    """
+
+    def __init__(self, queue: str) -> None:
+        """:param queue: Name of the queue consumed from"""
+        self.queue = queue
+        self.in_flight = 0
+        self.outcomes: Counter[Outcome] = Counter()
+        self.last_error: LastError | None = None
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    @classmethod
+    def merge(cls, queue: str, stats: Iterable[ConsumerStats]) -> ConsumerStats:
+        """Combine the statistics of several consumers of a queue, e.g. in different processes."""
+        merged = cls(queue)
+        merged._latencies = deque()
+        for consumer_stats in stats:
+            merged.in_flight += consumer_stats.in_flight
+            merged.outcomes.update(consumer_stats.outcomes)
+            merged._latencies.extend(consumer_stats._latencies)  # noqa: SLF001
+            last_error = consumer_stats.last_error
+            if last_error is not None and (
+                merged.last_error is None or last_error.time > merged.last_error.time
+            ):
+                merged.last_error = last_error
+        return merged
+
+    def started(self) -> None:
+        """Record that a message was delivered."""
+        self.in_flight += 1
+
+    def finished(
+        self,
+        outcome: Outcome,
+        latency: float | None = None,
+        message: str = "",
+        error: BaseException | None = None,
+    ) -> None:
+        """
+        Record what happened to a delivered message.
+
+        :param outcome: What happened to the message
+        :param latency: Seconds taken to process the message, None if it wasn't processed
+        :param message: Identifier of the message, to report the error with
+        :param error: Error that the message was discarded or failed with
+        """
+        self.in_flight -= 1
+        self.outcomes[outcome] += 1
+        if latency is not None:
+            self._latencies.append(latency)
+        if error is not None:
+            self.last_error = LastError(
+                time=datetime.datetime.now(tz=datetime.UTC),
+                message=message,
+                outcome=outcome,
+                error=f"{type(error).__name__}: {error}",
+            )
+
+    def latency_percentiles(self) -> dict[str, float]:
+        """Percentiles of the most recent processing times, in seconds, e.g. {"p50": 1.2}."""
+        if not self._latencies:
+            return {}
+        cut_points = statistics.quantiles(self._latencies, n=100, method="inclusive")
+        return {f"p{percentile}": cut_points[percentile - 1] for percentile in PERCENTILES}
+
+    def status(self, tokens: TokenAvailability) -> ConsumerStatus:
+        """The statistics so far, with the availability of tokens for the consumer."""
+        return ConsumerStatus(
+            queue=self.queue,
+            in_flight=self.in_flight,
+            outcomes={outcome: self.outcomes[outcome] for outcome in Outcome},
+            latency_percentiles=self.latency_percentiles(),
+            tokens=tokens,
+            last_error=self.last_error,
+        )
@@ -17,10 +17,11 @@
 from __future__ import annotations
 
 import asyncio
+from time import monotonic
 from typing import TYPE_CHECKING, Any
 
 import aio_pika
-from decouple import config
+from decouple import Csv, config
 
 from core.exceptions import (
     PixlDiscardError,
@@ -28,9 +29,14 @@ from core.exceptions import (
     PixlRequeueMessageError,
     PixlStudyNotInPrimaryArchiveError,
 )
-from core.patient_queue._base import PixlQueueInterface
+from core.patient_queue._base import (
+    DEFAULT_RETRY_DELAYS,
+    RETRY_COUNT_HEADER,
+    PixlQueueInterface,
+    retry_queue_name,
+)
 from core.patient_queue.message import deserialise
-from core.patient_queue.producer import PixlProducer
+from core.patient_queue.stats import ConsumerStats, ConsumerStatus, Outcome, TokenAvailability
 
 if TYPE_CHECKING:
     from collections.abc import Awaitable, Callable
@@ -43,6 +49,10 @@ if TYPE_CHECKING:
 
 from loguru import logger
 
+SECONDARY_QUEUE_NAME = "imaging-secondary"
+# Seconds between checking whether a rate of zero has been changed
+TOKEN_POLL_INTERVAL = 1
+
 
 class PixlConsumer(PixlQueueInterface):
     """Connector to RabbitMQ. Consumes messages from a queue"""
@@ -62,10 +72,12 @@ class PixlConsumer(PixlQueueInterface):
         self.token_bucket = token_bucket
         self.token_bucket_key = token_bucket_key
         self._callback = callback
-
-    @property
-    def _url(self) -> str:
-        return f"amqp://{self._username}:{self._password}@{self._host}:{self._port}/"
+        self._out_of_tokens = asyncio.Event()
+        self.paused = True
+        self.stats = ConsumerStats(queue_name)
+        self.retry_delays: list[int] = config(
+            "PIXL_RETRY_DELAYS", default=DEFAULT_RETRY_DELAYS, cast=Csv(cast=int)
+        )
 
     async def __aenter__(self) -> Self:
         """Establishes connection to queue."""
@@ -80,22 +92,75 @@ class PixlConsumer(PixlQueueInterface):
             durable=True,
             arguments={"x-max-priority": 5},
         )
+        # Separate channel for publishing, so that publisher confirms don't affect consumption
+        self._publish_channel = await self._connection.channel(publisher_confirms=True)
+        await self._publish_channel.declare_queue(
+            SECONDARY_QUEUE_NAME,
+            durable=True,
+            arguments={"x-max-priority": 5},
+        )
+        # Messages wait in a retry queue until their TTL expires, then go back to this queue
+        for delay in self.retry_delays:
+            await self._publish_channel.declare_queue(
+                retry_queue_name(self.queue_name, delay),
+                durable=True,
+                arguments={
+                    "x-message-ttl": delay * 1000,
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self.queue_name,
+                },
+            )
         return self
 
     async def _process_message(self, message: AbstractIncomingMessage) -> None:
-        if not self.token_bucket.has_token(key=self.token_bucket_key):
-            await asyncio.sleep(1)
-            await message.reject(requeue=True)
-            return
+        self.stats.started()
+        start = monotonic()
+        identifier = ""
+        outcome, error = Outcome.failed, None
+        try:
+            pixl_message: Message = deserialise(message.body)
+            identifier = pixl_message.identifier
+            outcome, error = await self._handle_message(message, pixl_message)
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            processed = outcome not in (Outcome.throttled, Outcome.returned)
+            self.stats.finished(
+                outcome,
+                latency=monotonic() - start if processed else None,
+                message=identifier,
+                error=error,
+            )
+
+    async def _handle_message(  # noqa: PLR0911
+        self, message: AbstractIncomingMessage, pixl_message: Message
+    ) -> tuple[Outcome, Exception | None]:
+        """Process a message if there are tokens for it, returning the outcome and any error."""
+        # Projects with their own rate need a token for the project as well as the archive. The
+        # project's token is taken first, so that no archive token is spent on a throttled message,
+        # but only once the archive has a rate, so that no project token is spent on a message that
+        # is returned to the queue
+        if await self._tokens(self.token_bucket.rate_for, self.token_bucket_key) == 0:
+            return await self._return_until_tokens(message)
+
+        project_key = pixl_message.project_name
+        project_limited = await self._tokens(self.token_bucket.has_key_rate, project_key)
+        if project_limited and not await self._tokens(self.token_bucket.has_token, project_key):
+            logger.trace("No token for project of {}", pixl_message.identifier)
+            await self._retry_later(message)
+            return Outcome.throttled, None
+
+        if not await self._wait_for_token_and_take(self.token_bucket_key):
+            return await self._return_until_tokens(message)
 
-        pixl_message: Message = deserialise(message.body)
         logger.debug("Picked up from queue: {}", pixl_message.identifier)
         try:
             await self._callback(pixl_message)
         except PixlRequeueMessageError as requeue:
             logger.trace("Requeue message: {} from {}", pixl_message.identifier, requeue)
-            await asyncio.sleep(1)
-            await message.reject(requeue=True)
+            await self._retry_later(message)
+            return Outcome.requeued, None
         except PixlStudyNotInPrimaryArchiveError as discard:
             logger.info(
                 "Discard message: {} from {}. Sending to secondary imaging queue with priority {}.",
@@ -103,28 +168,21 @@ class PixlConsumer(PixlQueueInterface):
                 discard,
                 message.priority,
             )
-            await asyncio.sleep(1)
-            await message.reject(requeue=False)
-            with PixlProducer(
-                queue_name="imaging-secondary",
-                host=config("RABBITMQ_HOST"),
-                port=config("RABBITMQ_PORT", cast=int),
-                username=config("RABBITMQ_USERNAME"),
-                password=config("RABBITMQ_PASSWORD"),
-            ) as producer:
-                producer.publish([pixl_message], priority=message.priority)
+            await self._reroute_to_secondary(message)
+            return Outcome.rerouted, None
         except PixlOutOfHoursError as nack_requeue:
             logger.trace(
                 "Nack and requeue message: {} from {}", pixl_message.identifier, nack_requeue
             )
-            await asyncio.sleep(10)
-            await message.nack(requeue=True)
+            await self._retry_later(message, delay=self.retry_delays[-1])
+            return Outcome.out_of_hours, None
         except PixlDiscardError as exception:
             logger.warning("Failed message {}: {}", pixl_message.identifier, exception)
             await (
                 message.ack()
             )  # ack so that we can see rate of message processing in rabbitmq admin
-        except Exception:  # noqa: BLE001
+            return Outcome.discarded, exception
+        except Exception as exception:  # noqa: BLE001
             logger.exception(
                 "Failed to process {}. Not re-queuing message",
                 pixl_message.identifier,
@@ -132,13 +190,142 @@ class PixlConsumer(PixlQueueInterface):
             await (
                 message.ack()
             )  # ack so that we can see rate of message processing in rabbitmq admin
+            return Outcome.failed, exception
         else:
             logger.success("Finished message {}", pixl_message.identifier)
             await message.ack()
+            return Outcome.success, None
+
+    async def _return_until_tokens(
+        self, message: AbstractIncomingMessage
+    ) -> tuple[Outcome, Exception | None]:
+        """
+        The rate is zero, so return the message to the front of the queue, and stop consuming until
+        there's a token.
+        """
+        await message.reject(requeue=True)
+        self._out_of_tokens.set()
+        return Outcome.returned, None
+
+    async def _wait_for_token_and_take(self, key: str) -> bool:
+        """
+        Take a token for a key, holding the message until there is one rather than returning it to
+        the queue to be redelivered. Return False, without a token, if the rate is zero.
+        """
+        while not await self._tokens(self.token_bucket.has_token, key):
+            wait = await self._tokens(self.token_bucket.seconds_until_token, key)
+            if wait is None:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    async def _tokens[T](self, method: Callable[[str], T], key: str) -> T:
+        """
+        Call a method of the token bucket for a key, from a thread if the bucket is shared so that
+        the event loop isn't blocked on the database.
+        """
+        if self.token_bucket.is_shared:
+            return await asyncio.to_thread(method, key)
+        return method(key)
+
+    async def _retry_later(
+        self, message: AbstractIncomingMessage, delay: int | None = None
+    ) -> None:
+        """
+        Move a message to a retry queue, from which RabbitMQ returns it to this queue after a delay.
+
+        :param delay: seconds to wait before retrying, one of `retry_delays`. Defaults to backing
+            off according to the number of times the message has been retried.
+        """
+        retry_count = message.headers.get(RETRY_COUNT_HEADER, 0)
+        if not isinstance(retry_count, int):
+            retry_count = 0
+        if delay is None:
+            delay = self.retry_delays[min(retry_count, len(self.retry_delays) - 1)]
+        headers = {**message.headers, RETRY_COUNT_HEADER: retry_count + 1}
+        if await self._publish(message, retry_queue_name(self.queue_name, delay), headers):
+            await message.ack()
+
+    async def _reroute_to_secondary(self, message: AbstractIncomingMessage) -> None:
+        """Move a message to the secondary imaging queue."""
+        if await self._publish(message, SECONDARY_QUEUE_NAME, message.headers):
+            await message.reject(requeue=False)
+
+    async def _publish(
+        self, message: AbstractIncomingMessage, routing_key: str, headers: dict[str, Any]
+    ) -> bool:
+        """
+        Publish a copy of a message to another queue, returning whether RabbitMQ confirmed it.
+
+        The caller should only remove the message from this queue once the publish has been
+        confirmed, so that it can't be lost. If the consumer dies in between, the message is
+        redelivered to this queue and moved again. If the publish fails, the message is requeued.
+        """
+        try:
+            await self._publish_channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    content_type=message.content_type,
+                    headers=headers,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    priority=message.priority,
+                ),
+                routing_key=routing_key,
+            )
+        except aio_pika.exceptions.AMQPError:
+            logger.exception("Failed to send message to {}, requeuing", routing_key)
+            await asyncio.sleep(1)
+            await message.reject(requeue=True)
+            return False
+        return True
 
     async def run(self) -> None:
-        """Processes messages from queue asynchronously."""
-        await self._queue.consume(self._process_message)
+        """
+        Processes messages from queue asynchronously.
+
+        Messages delivered while the token bucket is empty wait for a token, up to the prefetch
+        count of them at a time. Consumption is paused while the rate is zero, so that RabbitMQ
+        doesn't deliver messages that can only be returned to the queue.
+        """
+        while True:
+            await self._wait_for_token()
+            self._out_of_tokens.clear()
+            consumer_tag = await self._queue.consume(self._process_message)
+            self.paused = False
+            logger.debug("Consuming messages from {}", self.queue_name)
+
+            await self._out_of_tokens.wait()
+            # Messages already delivered to this consumer are still processed, or returned
+            await self._queue.cancel(consumer_tag)
+            self.paused = True
+            logger.debug(
+                "Paused consuming messages from {} until there are tokens", self.queue_name
+            )
+
+    def pause(self) -> None:
+        """
+        Stop consuming until there's a token, e.g. after setting the rate of this consumer's key to
+        zero, without waiting for a message to arrive without a token.
+        """
+        self._out_of_tokens.set()
+
+    def status(self) -> ConsumerStatus:
+        """Statistics of the messages consumed so far, and the tokens for this consumer."""
+        return self.stats.status(
+            TokenAvailability(
+                rate=self.token_bucket.rate_for(self.token_bucket_key),
+                seconds_until_token=self.token_bucket.seconds_until_token(self.token_bucket_key),
+                paused=self.paused,
+            )
+        )
+
+    async def _wait_for_token(self) -> None:
+        """Wait until the token bucket has a token for this queue, polling while the rate is 0."""
+        while True:
+            wait = await self._tokens(self.token_bucket.seconds_until_token, self.token_bucket_key)
+            if wait == 0:
+                return
+            await asyncio.sleep(TOKEN_POLL_INTERVAL if wait is None else wait)
 
     async def __aexit__(self, *args: object, **kwargs: Any) -> None:
         """Requirement for the asynchronous context manager"""
@@ -11,12 +11,18 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
-"""Router for the API endpoints"""
+"""
+Router for the API endpoints
+
+Endpoints that use the token bucket aren't async, so that FastAPI runs them in a thread and they
+don't block the event loop when the bucket is in the database.
+"""
 
 from __future__ import annotations
 
 from fastapi import APIRouter, HTTPException, status
 
+from core.patient_queue.stats import ConsumerStatus  # noqa: TC001, needed by FastAPI
 from core.token_buffer.models import AppState, TokenRefreshUpdate
 
 state = AppState()
@@ -29,21 +35,55 @@ async def heart_beat() -> str:  # noqa: D103
 
 
 @router.post("/token-bucket-refresh-rate", summary="Update the refresh rate in items per second")
-async def update_tb_refresh_rate(item: TokenRefreshUpdate) -> str:  # noqa: D103
+def update_tb_refresh_rate(item: TokenRefreshUpdate) -> str:  # noqa: D103
     if not isinstance(item.rate, float) or item.rate < 0:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail=f"Refresh rate mush be a positive integer. Had {item.rate}",
         )
 
-    state.token_bucket.rate = float(item.rate)
-    return "Successfully updated the refresh rate"
+    if item.key is None:
+        if item.capacity is not None:
+            raise HTTPException(
+                status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                detail="Capacity can only be set for a key",
+            )
+        state.token_bucket.rate = float(item.rate)
+        return "Successfully updated the refresh rate"
+
+    try:
+        state.token_bucket.set_key_rate(item.key, float(item.rate), capacity=item.capacity)
+    except ValueError as error:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(error)
+        ) from error
+    return f"Successfully updated the refresh rate for {item.key}"
 
 
 @router.get(
     "/token-bucket-refresh-rate",
-    summary="Get the refresh rate in items per second",
+    summary="Get the refresh rate in items per second, of the token bucket or one of its keys",
     response_model=TokenRefreshUpdate,
 )
-async def get_tb_refresh_rate() -> TokenRefreshUpdate:  # noqa: D103
-    return TokenRefreshUpdate(rate=state.token_bucket.rate)
+def get_tb_refresh_rate(key: str | None = None) -> TokenRefreshUpdate:  # noqa: D103
+    if key is None:
+        return TokenRefreshUpdate(
+            rate=state.token_bucket.rate,
+            controller=state.rate_controller,
+            key_rates=state.token_bucket.key_rates,
+        )
+
+    key_rate = state.token_bucket.key_rates.get(key)
+    if key_rate is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{key} doesn't have its own rate"
+        )
+    return TokenRefreshUpdate(rate=key_rate.rate, key=key, capacity=key_rate.capacity)
+
+
+@router.get(
+    "/consumer-stats",
+    summary="Messages processed by each of the service's consumers, by queue, and their tokens",
+)
+def get_consumer_stats() -> dict[str, ConsumerStatus]:  # noqa: D103
+    return {queue: consumer.status() for queue, consumer in state.consumers.items()}
@@ -18,21 +18,53 @@ This module defines the data models used by the PIXL core service
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import datetime  # noqa: TC003, always import datetime otherwise pydantic throws error
+from typing import TYPE_CHECKING
 
 from pydantic import BaseModel
 
 from core.token_buffer import TokenBucket
+from core.token_buffer.storage import KeyRate, storage_from_config
+
+if TYPE_CHECKING:
+    from core.patient_queue.stats import StatusReporter
+
+
+class RateDecision(BaseModel):
+    """A change to the refresh rate made by a rate controller, and why it was made"""
+
+    time: datetime
+    old_rate: float
+    new_rate: float
+    reason: str
+
+
+class RateControllerStatus(BaseModel):
+    """Bounds of a controller that adjusts the refresh rate, and its most recent decisions"""
+
+    min_rate: float
+    max_rate: float
+    decisions: list[RateDecision] = []
 
 
 @dataclass
 class AppState:
-    """Stores the token bucket"""
+    """
+    Stores the token bucket, the status of its rate controller if there is one, and the consumers
+    of the service by queue name
+    """
 
-    token_bucket = TokenBucket(rate=0, capacity=5)
+    token_bucket = TokenBucket(rate=0, capacity=5, storage=storage_from_config())
+    rate_controller: RateControllerStatus | None = None
+    consumers: dict[str, StatusReporter] = field(default_factory=dict)
 
 
 class TokenRefreshUpdate(BaseModel):
-    """Stores the refresh rate of the token bucket"""
+    """Stores the refresh rate of the token bucket, or of one of its keys if `key` is given"""
 
     rate: float
+    key: str | None = None
+    capacity: int | None = None
+    controller: RateControllerStatus | None = None
+    key_rates: dict[str, KeyRate] = {}
@@ -0,0 +1,225 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Storage for token buckets, in memory or shared by all replicas of a service."""
+
+from __future__ import annotations
+
+import abc
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import TYPE_CHECKING
+
+import token_bucket as tb
+from decouple import config
+from sqlalchemy import case
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from core.db import queries
+from core.db.models import TokenBucketRate, TokenBucketState
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from sqlalchemy import Engine
+
+# Key of the rate of all buckets that haven't been given their own rate
+DEFAULT_RATE_KEY = "default"
+
+
+@dataclass(frozen=True)
+class KeyRate:
+    """Rate of the bucket for a key, and its capacity if it differs from the token bucket's"""
+
+    rate: float
+    capacity: int | None = None
+
+
+class SharedStorage(tb.StorageBase, abc.ABC):
+    """
+    Token bucket storage shared by several processes, which also holds the rates of the buckets so
+    that setting them in one process sets them for all of them.
+
+    Access to shared storage may block, so async callers should call it from a thread.
+    """
+
+    @abc.abstractmethod
+    def replenish_and_consume(self, key: str, rate: float, capacity: int, num_tokens: int) -> bool:
+        """
+        Add tokens to a bucket for the time since it was last replenished, then attempt to take
+        tokens from it, in a single operation. Return whether the tokens were taken.
+        """
+
+    @abc.abstractmethod
+    def available_tokens(self, key: str, rate: float, capacity: int) -> float:
+        """Tokens that a bucket would have if it were replenished now, without changing it."""
+
+    @abc.abstractmethod
+    def get_rates(self) -> dict[str, KeyRate]:
+        """Rates set by any process, by key, with `DEFAULT_RATE_KEY` for the default rate."""
+
+    @abc.abstractmethod
+    def set_rate(self, key: str, rate: KeyRate) -> None:
+        """Set the rate of a key, or `DEFAULT_RATE_KEY` for the default rate, for all processes."""
+
+    @abc.abstractmethod
+    def delete_rate(self, key: str) -> None:
+        """Stop a key having its own rate, for all processes."""
+
+
+class DatabaseStorage(SharedStorage):
+    """
+    Token buckets in the PIXL database, so that the rate is held across all replicas of a service.
+
+    Taking a token replenishes and consumes in a single upsert of the bucket's row, so that
+    replicas can't take the same tokens without holding a lock across round trips. The rates are
+    cached for `rate_ttl` seconds, so they aren't queried for every token.
+    """
+
+    def __init__(self, engine: Engine | None = None, rate_ttl: float = 1) -> None:
+        """
+        :param engine: Engine for the PIXL database, by default using PIXL_DB_* settings
+        :param rate_ttl: Seconds to use the rates for before querying them again
+        """
+        engine = engine or queries.engine
+        self._sessionmaker = sessionmaker(engine)
+        self._insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+        self.rate_ttl = rate_ttl
+        self._rates: dict[str, KeyRate] = {}
+        self._rates_fetched_at = -float("inf")
+
+    def get_token_count(self, key: str) -> float:
+        """Tokens in the bucket when it was last replenished, 0 if it doesn't exist yet."""
+        with self._sessionmaker() as session:
+            state = session.get(TokenBucketState, key)
+            return 0 if state is None else state.tokens
+
+    def replenish(self, key: str, rate: float, capacity: int) -> None:
+        """Add tokens to a bucket for the time since it was last replenished."""
+
+        def _replenish(session: Session) -> None:
+            state = _locked_state(session, key)
+            now = time()
+            if state is None:
+                session.add(TokenBucketState(key=key, tokens=capacity, replenished_at=now))
+                return
+            if now < state.replenished_at:
+                return
+            state.tokens = min(capacity, state.tokens + rate * (now - state.replenished_at))
+            state.replenished_at = now
+
+        self._transaction(_replenish)
+
+    def consume(self, key: str, num_tokens: int) -> bool:
+        """Attempt to take tokens from a bucket, returning whether they were taken."""
+
+        def _consume(session: Session) -> bool:
+            state = _locked_state(session, key)
+            if state is None or state.tokens < num_tokens:
+                return False
+            state.tokens -= num_tokens
+            return True
+
+        return self._transaction(_consume)
+
+    def replenish_and_consume(self, key: str, rate: float, capacity: int, num_tokens: int) -> bool:
+        """Replenish a bucket and attempt to take tokens from it, in a single statement."""
+        now = time()
+        state = TokenBucketState
+        elapsed = case((state.replenished_at < now, now - state.replenished_at), else_=0)
+        replenished = state.tokens + rate * elapsed
+        available = case((replenished > capacity, capacity), else_=replenished)
+        statement = (
+            self._insert(state)
+            .values(key=key, tokens=capacity - num_tokens, replenished_at=now)
+            .on_conflict_do_update(
+                index_elements=[state.key],
+                set_={
+                    "tokens": available - num_tokens,
+                    "replenished_at": case(
+                        (state.replenished_at < now, now), else_=state.replenished_at
+                    ),
+                },
+                where=available >= num_tokens,
+            )
+            .returning(state.key)
+        )
+        with self._sessionmaker() as session, session.begin():
+            return session.execute(statement).first() is not None
+
+    def available_tokens(self, key: str, rate: float, capacity: int) -> float:
+        """Tokens in a bucket if it were replenished now, the capacity if it doesn't exist yet."""
+        with self._sessionmaker() as session:
+            state = session.get(TokenBucketState, key)
+        if state is None:
+            return capacity
+        elapsed = max(0.0, time() - state.replenished_at)
+        return min(capacity, state.tokens + rate * elapsed)
+
+    def get_rates(self) -> dict[str, KeyRate]:
+        """Rates set by any replica, by key, with `DEFAULT_RATE_KEY` for the default rate."""
+        if monotonic() - self._rates_fetched_at > self.rate_ttl:
+            with self._sessionmaker() as session:
+                self._rates = {
+                    row.key: KeyRate(rate=row.rate, capacity=row.capacity)
+                    for row in session.query(TokenBucketRate)
+                }
+            self._rates_fetched_at = monotonic()
+        return dict(self._rates)
+
+    def set_rate(self, key: str, rate: KeyRate) -> None:
+        """Set the rate of a key, or `DEFAULT_RATE_KEY` for the default rate, for all replicas."""
+
+        def _set_rate(session: Session) -> None:
+            session.merge(TokenBucketRate(key=key, rate=rate.rate, capacity=rate.capacity))
+
+        self._transaction(_set_rate)
+        self._rates[key] = rate
+
+    def delete_rate(self, key: str) -> None:
+        """Stop a key having its own rate, for all replicas."""
+
+        def _delete_rate(session: Session) -> None:
+            session.query(TokenBucketRate).filter(TokenBucketRate.key == key).delete()
+
+        self._transaction(_delete_rate)
+        self._rates.pop(key, None)
+
+    def _transaction[T](self, operation: Callable[[Session], T]) -> T:
+        """
+        Run an operation in a transaction, retrying once if another replica created the same row
+        at the same time.
+        """
+        try:
+            with self._sessionmaker() as session, session.begin():
+                return operation(session)
+        except IntegrityError:
+            with self._sessionmaker() as session, session.begin():
+                return operation(session)
+
+
+def _locked_state(session: Session, key: str) -> TokenBucketState | None:
+    return session.get(TokenBucketState, key, with_for_update=True)
+
+
+def storage_from_config() -> tb.StorageBase:
+    """Token bucket storage set by PIXL_TOKEN_BUCKET_STORAGE, either "memory" or "database"."""
+    storage = config("PIXL_TOKEN_BUCKET_STORAGE", default="memory")
+    if storage == "memory":
+        return tb.MemoryStorage()
+    if storage == "database":
+        return DatabaseStorage()
+    msg = f"PIXL_TOKEN_BUCKET_STORAGE must be 'memory' or 'database', not '{storage}'"
+    raise ValueError(msg)
@@ -14,10 +14,10 @@
 #  limitations under the License.
 from __future__ import annotations
 
-import typing
-
 import token_bucket as tb
 
+from core.token_buffer.storage import DEFAULT_RATE_KEY, KeyRate, SharedStorage
+
 
 class TokenBucket(tb.Limiter):
     """
@@ -27,26 +27,27 @@ class TokenBucket(tb.Limiter):
     added back into the queue.
 
     Note that the Limiter object can operate the rate on
-    different "streams", which are specified by a string object, also called key. This
-    key has been hard coded here to accept one of two values: 'primary' or 'secondary',
-    representing two different streams.
+    different "streams", which are specified by a string object, also called key. The
+    archives use the keys 'primary' and 'secondary', and any other key can be used, e.g. for
+    each project. Each key has its own bucket, filled at the rate and capacity of the token
+    bucket unless the key has been given its own with `set_key_rate`.
     """
 
-    _keys: typing.ClassVar = ["primary", "secondary"]
-
     def __init__(
         self,
         rate: float = 5,
         capacity: int = 5,
+        storage: tb.StorageBase | None = None,
     ) -> None:
         """
         Uses the token bucket implementation from `Falconry`
         <https://github.com/falconry/token-bucket> to limit access rates for downloading
         /extracting images where throttling is required.
 
-        :param rate: The number of tokens added per second
+        :param rate: The number of tokens added per second, until a rate is set in shared storage
         :param capacity: The maximum number of tokens in the bucket at any point in time
-        :param storage: Type of storage used to hold the tokens
+        :param storage: Type of storage used to hold the tokens, in memory by default. With
+            `SharedStorage`, the rates are also shared with all other users of the storage.
         """
         self._zero_rate = False
 
@@ -54,18 +55,56 @@ class TokenBucket(tb.Limiter):
             rate = 1  # tb.Limiter does not allow zero rates, so keep track...
             self._zero_rate = True
 
-        super().__init__(rate=rate, capacity=capacity, storage=tb.MemoryStorage())
+        super().__init__(rate=rate, capacity=capacity, storage=storage or tb.MemoryStorage())
+        self._key_rates: dict[str, KeyRate] = {}
+        self._key_rate_factors: dict[str, float] = {}
 
     def has_token(self, key: str) -> bool:
         """Does this token bucket have a token for the given key?"""
-        if key not in self._keys:
-            message = f"Key must be one of {self._keys}, not '{key}'"
+        self._check_key(key)
+        self._sync_rates()
+        rate, capacity = self._rate_and_capacity(key)
+        if rate == 0:
+            return False
+        if isinstance(self._storage, SharedStorage):
+            return self._storage.replenish_and_consume(key, rate, capacity, 1)
+        self._storage.replenish(key, rate, capacity)
+        return bool(self._storage.consume(key, 1))
+
+    def seconds_until_token(self, key: str) -> float | None:
+        """
+        Seconds until there will be a token for the given key, without taking it, or None if
+        there won't be one because the rate is zero.
+        """
+        self._check_key(key)
+        self._sync_rates()
+        rate, capacity = self._rate_and_capacity(key)
+        if rate == 0:
+            return None
+        if isinstance(self._storage, SharedStorage):
+            tokens = self._storage.available_tokens(key, rate, capacity)
+        else:
+            self._storage.replenish(key, rate, capacity)
+            tokens = float(self._storage.get_token_count(key))
+        return max(0.0, (1 - tokens) / rate)
+
+    def _check_key(self, key: str) -> None:
+        if not key or key == DEFAULT_RATE_KEY:
+            message = f"Key must be a non-empty string other than '{DEFAULT_RATE_KEY}', not '{key}'"
             raise ValueError(message)
-        return not self._zero_rate and bool(self.consume(key))
+
+    def _rate_and_capacity(self, key: str) -> tuple[float, int]:
+        key_rate = self._key_rates.get(key)
+        if key_rate is None:
+            rate, capacity = (0 if self._zero_rate else self._rate), self._capacity
+        else:
+            rate, capacity = key_rate.rate, key_rate.capacity or self._capacity
+        return rate * self._key_rate_factors.get(key, 1), capacity
 
     @property
     def rate(self) -> float:
-        """Rate in items per second"""
+        """Rate in items per second, for keys without their own rate"""
+        self._sync_rates()
         return 0 if self._zero_rate else float(self._rate)
 
     @rate.setter
@@ -74,8 +113,93 @@ class TokenBucket(tb.Limiter):
             msg = "Cannot set the rate with a non integer value"
             raise TypeError(msg)
 
+        self._set_local_rate(value)
+        if isinstance(self._storage, SharedStorage):
+            self._storage.set_rate(DEFAULT_RATE_KEY, KeyRate(rate=value))
+
+    @property
+    def is_shared(self) -> bool:
+        """
+        Are the tokens and rates shared with other processes, through shared storage?
+
+        Shared storage may block, e.g. on a database, so async code should call the bucket from a
+        thread when it's shared.
+        """
+        return isinstance(self._storage, SharedStorage)
+
+    @property
+    def key_rates(self) -> dict[str, KeyRate]:
+        """Rates, and capacities, of the keys that have their own"""
+        self._sync_rates()
+        return dict(self._key_rates)
+
+    def rate_for(self, key: str) -> float:
+        """Rate in items per second for a key, its own rate if it has one"""
+        self._sync_rates()
+        return float(self._rate_and_capacity(key)[0])
+
+    def has_key_rate(self, key: str) -> bool:
+        """Does the key have its own rate?"""
+        self._sync_rates()
+        return key in self._key_rates
+
+    def set_key_rate(self, key: str, rate: float, capacity: int | None = None) -> None:
+        """
+        Give a key its own rate, instead of the rate of the token bucket.
+
+        :param key: Key to set the rate of, e.g. the name of a project
+        :param rate: The number of tokens added per second, 0 to stop the key having tokens
+        :param capacity: The maximum number of tokens for the key, defaults to the capacity of the
+            token bucket
+        """
+        self._check_key(key)
+        if rate < 0:
+            msg = f"Rate must be positive, not {rate}"
+            raise ValueError(msg)
+        if capacity is not None and capacity < 1:
+            msg = f"Capacity must be at least 1, not {capacity}"
+            raise ValueError(msg)
+
+        key_rate = KeyRate(rate=rate, capacity=capacity)
+        self._key_rates[key] = key_rate
+        if isinstance(self._storage, SharedStorage):
+            self._storage.set_rate(key, key_rate)
+
+    def set_key_rate_factor(self, key: str, factor: float | None) -> None:
+        """
+        Scale the rate of a key in this process only, e.g. to pause it or ramp it up, without
+        changing the rate set for it. The factor isn't shared through shared storage.
+
+        :param key: Key to scale the rate of
+        :param factor: Fraction of the key's rate to use, between 0 and 1, or None to use all of it
+        """
+        if factor is None:
+            self._key_rate_factors.pop(key, None)
+            return
+        if not 0 <= factor <= 1:
+            msg = f"Rate factor must be between 0 and 1, not {factor}"
+            raise ValueError(msg)
+        self._key_rate_factors[key] = factor
+
+    def remove_key_rate(self, key: str) -> None:
+        """Use the rate of the token bucket for a key that had its own rate."""
+        self._key_rates.pop(key, None)
+        if isinstance(self._storage, SharedStorage):
+            self._storage.delete_rate(key)
+
+    def _set_local_rate(self, value: float) -> None:
         if value == 0:
             self._zero_rate = True
         else:
             self._zero_rate = False
             self._rate = value
+
+    def _sync_rates(self) -> None:
+        """Use the rates set by any user of shared storage, if there are any."""
+        if not isinstance(self._storage, SharedStorage):
+            return
+        key_rates = self._storage.get_rates()
+        default = key_rates.pop(DEFAULT_RATE_KEY, None)
+        if default is not None:
+            self._set_local_rate(default.rate)
+        self._key_rates = key_rates
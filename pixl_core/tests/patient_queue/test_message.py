@@ -13,6 +13,9 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import pytest
+from jsonpickle import encode
+
 from core.patient_queue.message import deserialise
 
 
@@ -33,3 +36,27 @@ def test_deserialise(mock_message) -> None:
     """Checks if deserialised messages are the same as the original"""
     serialised_msg = mock_message.serialise()
     assert deserialise(serialised_msg) == mock_message
+
+
+def test_serialise_compact(mock_message) -> None:
+    """Checks that messages are serialised as a compact JSON object with a schema version"""
+    msg_body = mock_message.serialise()
+    assert msg_body == (
+        b'{"schema_version":1,"mrn":"111","accession_number":"123","study_uid":"1.2.3",'
+        b'"series_uid":"","study_date":"2022-11-22","procedure_occurrence_id":"234",'
+        b'"project_name":"test project","extract_generated_timestamp":"2023-12-07T14:08:00+00:00"}'
+    )
+
+
+def test_deserialise_legacy(mock_message) -> None:
+    """Checks that messages serialised with jsonpickle by previous versions can be deserialised"""
+    legacy_msg = encode(mock_message).encode()
+    assert b"py/object" in legacy_msg
+    assert deserialise(legacy_msg) == mock_message
+
+
+def test_deserialise_unsupported_version(mock_message) -> None:
+    """Checks that messages with an unknown schema version aren't deserialised"""
+    msg_body = mock_message.serialise().replace(b'"schema_version":1', b'"schema_version":2')
+    with pytest.raises(ValueError, match="Unsupported message schema version 2"):
+        deserialise(msg_body)
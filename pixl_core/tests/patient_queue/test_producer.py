@@ -39,3 +39,18 @@ def test_publish(mock_message) -> None:
 
     with PixlProducer(queue_name=TEST_QUEUE) as pp:
         assert pp.message_count == 1
+
+
+@pytest.mark.usefixtures("run_containers")
+def test_publish_in_batches(mock_message) -> None:
+    """
+    Checks that publishing in batches, with a partial final batch, delivers every message.
+    Will only work if nothing has been added to queue before.
+    """
+    with PixlProducer(queue_name=TEST_QUEUE) as pp:
+        pp.clear_queue()
+        pp.publish_in_batches(messages=[mock_message] * 5, priority=1, batch_size=2)
+
+    with PixlProducer(queue_name=TEST_QUEUE) as pp:
+        assert pp.message_count == 5
+        pp.clear_queue()
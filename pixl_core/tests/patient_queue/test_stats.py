@@ -0,0 +1,100 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+from core.patient_queue.stats import ConsumerStats, Outcome, TokenAvailability
+from core.patient_queue.subscriber import PixlConsumer
+from core.token_buffer.tokens import TokenBucket
+
+
+def test_latency_percentiles() -> None:
+    """Percentiles are taken from the processing times of the messages that were processed."""
+    stats = ConsumerStats("imaging-primary")
+    assert stats.latency_percentiles() == {}
+
+    for latency in range(1, 101):
+        stats.started()
+        stats.finished(Outcome.success, latency=latency)
+    stats.started()
+    stats.finished(Outcome.throttled)
+
+    assert stats.latency_percentiles() == {"p50": 50.5, "p90": 90.1, "p99": 99.01}
+    status = stats.status(TokenAvailability(rate=1, seconds_until_token=0, paused=False))
+    assert status.in_flight == 0
+    assert status.outcomes[Outcome.success] == 100
+    assert status.outcomes[Outcome.throttled] == 1
+    assert status.outcomes[Outcome.failed] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    ("error", "outcome"),
+    [
+        (None, Outcome.success),
+        (PixlRequeueMessageError("Try later"), Outcome.requeued),
+        (PixlDiscardError("Not found"), Outcome.discarded),
+        (RuntimeError("Unexpected"), Outcome.failed),
+    ],
+)
+async def test_consumer_records_outcomes(mock_message, error, outcome) -> None:
+    """
+    Given a consumer whose callback succeeds or raises
+    When it processes a message
+    Then the outcome of the message is counted, and errors that end its processing are kept
+    """
+    consumer = PixlConsumer(
+        queue_name="imaging-primary",
+        token_bucket=TokenBucket(rate=5, capacity=5),
+        token_bucket_key="primary",  # noqa: S106
+        callback=AsyncMock(side_effect=error),
+    )
+    consumer._publish_channel = Mock(default_exchange=AsyncMock())
+    message = AsyncMock(body=mock_message.serialise(), headers={}, priority=1)
+
+    await consumer._process_message(message)
+
+    status = consumer.status()
+    assert status.in_flight == 0
+    assert status.outcomes[outcome] == 1
+    assert set(status.latency_percentiles) == {"p50", "p90", "p99"}
+    assert status.tokens.rate == 5
+    if outcome in (Outcome.discarded, Outcome.failed):
+        assert status.last_error.message == mock_message.identifier
+        assert status.last_error.error == f"{type(error).__name__}: {error}"
+    else:
+        assert status.last_error is None
+
+
+@pytest.mark.asyncio
+async def test_consumer_without_tokens_returns_message(mock_message) -> None:
+    """Messages returned to the queue for want of a token aren't counted as processed."""
+    consumer = PixlConsumer(
+        queue_name="imaging-primary",
+        token_bucket=TokenBucket(rate=0, capacity=5),
+        token_bucket_key="primary",  # noqa: S106
+        callback=AsyncMock(),
+    )
+    message = AsyncMock(body=mock_message.serialise(), headers={}, priority=1)
+
+    await consumer._process_message(message)
+
+    status = consumer.status()
+    assert status.outcomes[Outcome.returned] == 1
+    assert status.latency_percentiles == {}
+    assert status.tokens.seconds_until_token is None
@@ -18,8 +18,12 @@ from unittest.mock import AsyncMock
 
 import pytest
 
+from core.exceptions import PixlRequeueMessageError, PixlStudyNotInPrimaryArchiveError
+from core.patient_queue._base import retry_queue_name
+from core.patient_queue.message import deserialise
 from core.patient_queue.producer import PixlProducer
-from core.patient_queue.subscriber import PixlConsumer
+from core.patient_queue.stats import Outcome
+from core.patient_queue.subscriber import SECONDARY_QUEUE_NAME, PixlConsumer
 from core.token_buffer.tokens import TokenBucket
 
 TEST_QUEUE = "test_consume"
@@ -52,9 +56,198 @@ async def test_create(mock_message) -> None:
         await asyncio.sleep(1)
         # Cancel before assertion so the task doesn't hang
         task.cancel()
-        # need to close the connection and channel
+        # need to close the connection and channels
+        await consumer._publish_channel.close()
         await consumer._channel.close()
         await consumer._connection.close()
         consume.assert_called_once()
     # Fail on purpose to check async test awaited
     raise ExpectedTestError
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("run_containers")
+async def test_study_not_in_primary_rerouted_to_secondary(mock_message) -> None:
+    """Messages for studies not in the primary archive are moved to the secondary queue."""
+    with PixlProducer(queue_name=TEST_QUEUE) as producer:
+        producer.clear_queue()
+        producer.publish(messages=[mock_message], priority=3)
+    with PixlProducer(queue_name=SECONDARY_QUEUE_NAME) as producer:
+        producer.clear_queue()
+
+    consume = AsyncMock(side_effect=PixlStudyNotInPrimaryArchiveError("not in primary"))
+    async with PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    ) as consumer:
+        task = asyncio.create_task(consumer.run())
+        await asyncio.sleep(1)
+        task.cancel()
+
+        secondary = await consumer._channel.get_queue(SECONDARY_QUEUE_NAME)
+        rerouted = await secondary.get(no_ack=True)
+        primary = await consumer._channel.get_queue(TEST_QUEUE)
+        primary_message = await primary.get(fail=False)
+
+        await consumer._publish_channel.close()
+        await consumer._channel.close()
+        await consumer._connection.close()
+
+    assert deserialise(rerouted.body) == mock_message
+    assert rerouted.priority == 3
+    assert primary_message is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("run_containers")
+async def test_requeued_message_retried_after_delay(mock_message) -> None:
+    """Messages that should be requeued wait in a retry queue before coming back to be retried."""
+    with PixlProducer(queue_name=TEST_QUEUE) as producer:
+        producer.clear_queue()
+        producer.publish(messages=[mock_message], priority=1)
+
+    consume = AsyncMock(side_effect=[PixlRequeueMessageError("not yet"), None])
+    async with PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    ) as consumer:
+        consumer_task = asyncio.create_task(consumer.run())
+        await asyncio.sleep(0.5)
+        retry_queue = await consumer._channel.get_queue(
+            retry_queue_name(TEST_QUEUE, consumer.retry_delays[0])
+        )
+        waiting = await retry_queue.get(fail=False, no_ack=False)
+        assert waiting is not None
+        assert waiting.headers["x-retry-count"] == 1
+        await waiting.nack(requeue=True)
+
+        await asyncio.sleep(consumer.retry_delays[0] + 1)
+        consumer_task.cancel()
+        await consumer._publish_channel.close()
+        await consumer._channel.close()
+        await consumer._connection.close()
+
+    assert consume.await_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("run_containers")
+async def test_consumption_paused_without_tokens(mock_message) -> None:
+    """Messages are left in the queue while the rate is zero, and consumed once it's increased."""
+    with PixlProducer(queue_name=TEST_QUEUE) as producer:
+        producer.clear_queue()
+        producer.publish(messages=[mock_message], priority=1)
+
+    consume = AsyncMock()
+    async with PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(rate=0),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    ) as consumer:
+        consumer_task = asyncio.create_task(consumer.run())
+        await asyncio.sleep(1.5)
+        assert consumer.paused
+        consume.assert_not_awaited()
+
+        consumer.token_bucket.rate = 1.0
+        await asyncio.sleep(1.5)
+        consumer_task.cancel()
+        await consumer._publish_channel.close()
+        await consumer._channel.close()
+        await consumer._connection.close()
+
+    consume.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_message_held_until_token(mock_message) -> None:
+    """Messages delivered while the bucket is empty wait for a token, rather than being returned."""
+    consume = AsyncMock()
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(rate=20, capacity=1),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    assert consumer.token_bucket.has_token(key="primary")
+    messages = [AsyncMock(), AsyncMock()]
+
+    outcomes = await asyncio.wait_for(
+        asyncio.gather(*(consumer._handle_message(message, mock_message) for message in messages)),
+        timeout=1,
+    )
+
+    assert outcomes == [(Outcome.success, None), (Outcome.success, None)]
+    assert consume.await_count == 2
+    for message in messages:
+        message.ack.assert_awaited_once()
+        message.reject.assert_not_awaited()
+    assert not consumer._out_of_tokens.is_set()
+
+
+@pytest.mark.asyncio
+async def test_message_returned_at_zero_rate(mock_message) -> None:
+    """Messages delivered while the rate is zero are returned, and consumption is paused."""
+    consume = AsyncMock()
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(rate=0),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    message = AsyncMock()
+
+    outcome = await consumer._handle_message(message, mock_message)
+
+    assert outcome == (Outcome.returned, None)
+    message.reject.assert_awaited_once_with(requeue=True)
+    consume.assert_not_awaited()
+    assert consumer._out_of_tokens.is_set()
+
+
+@pytest.mark.asyncio
+async def test_throttled_project_does_not_spend_archive_token(mock_message) -> None:
+    """Messages for a project without a token are throttled without taking an archive token."""
+    consume = AsyncMock()
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(rate=1, capacity=1),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    consumer.token_bucket.set_key_rate(mock_message.project_name, rate=0.1, capacity=1)
+    assert consumer.token_bucket.has_token(key=mock_message.project_name)
+    consumer._retry_later = AsyncMock()
+
+    outcome = await consumer._handle_message(AsyncMock(), mock_message)
+
+    assert outcome == (Outcome.throttled, None)
+    consumer._retry_later.assert_awaited_once()
+    consume.assert_not_awaited()
+    assert consumer.token_bucket.seconds_until_token(key="primary") == 0
+
+
+@pytest.mark.asyncio
+async def test_paused_archive_does_not_spend_project_token(mock_message) -> None:
+    """Messages returned while the archive's rate is zero don't take a token for their project."""
+    consume = AsyncMock()
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(rate=0),
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    consumer.token_bucket.set_key_rate(mock_message.project_name, rate=0.1, capacity=1)
+    message = AsyncMock()
+
+    outcome = await consumer._handle_message(message, mock_message)
+
+    assert outcome == (Outcome.returned, None)
+    message.reject.assert_awaited_once_with(requeue=True)
+    consume.assert_not_awaited()
+    assert consumer.token_bucket.has_token(key=mock_message.project_name)
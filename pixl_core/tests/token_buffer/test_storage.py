@@ -0,0 +1,108 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+import time
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from core.db.models import TokenBucketRate, TokenBucketState
+from core.token_buffer import TokenBucket
+from core.token_buffer.storage import DatabaseStorage, KeyRate, SharedStorage
+
+
+@pytest.fixture
+def clear_token_buckets(db_engine) -> None:
+    """Remove all token buckets and rates from the database."""
+    with sessionmaker(db_engine)() as session, session.begin():
+        session.query(TokenBucketState).delete()
+        session.query(TokenBucketRate).delete()
+
+
+@pytest.mark.usefixtures("clear_token_buckets")
+def test_tokens_shared_between_buckets(db_engine) -> None:
+    """Buckets sharing database storage, as in separate replicas, take from the same tokens."""
+    replica_1 = TokenBucket(rate=1, capacity=2, storage=DatabaseStorage(db_engine))
+    replica_2 = TokenBucket(rate=1, capacity=2, storage=DatabaseStorage(db_engine))
+
+    assert replica_1.has_token(key="primary")
+    assert replica_2.has_token(key="primary")
+    assert not replica_1.has_token(key="primary")
+    assert not replica_2.has_token(key="primary")
+    assert replica_2.has_token(key="secondary")
+
+
+@pytest.mark.usefixtures("clear_token_buckets")
+def test_rate_shared_between_buckets(db_engine) -> None:
+    """Setting the rate of a bucket with database storage sets it for all of them."""
+    replica_1 = TokenBucket(rate=0, storage=DatabaseStorage(db_engine, rate_ttl=0))
+    replica_2 = TokenBucket(rate=0, storage=DatabaseStorage(db_engine, rate_ttl=0))
+
+    replica_1.rate = 2.5
+    assert replica_2.rate == 2.5
+    assert replica_2.has_token(key="primary")
+
+    replica_2.rate = 0.0
+    assert replica_1.rate == 0
+    assert not replica_1.has_token(key="primary")
+
+
+@pytest.mark.usefixtures("clear_token_buckets")
+def test_key_rate_shared_between_buckets(db_engine) -> None:
+    """Rates of keys set for a bucket with database storage are used by all of them."""
+    replica_1 = TokenBucket(rate=1, storage=DatabaseStorage(db_engine, rate_ttl=0))
+    replica_2 = TokenBucket(rate=1, storage=DatabaseStorage(db_engine, rate_ttl=0))
+
+    replica_1.set_key_rate("project", rate=0.5, capacity=2)
+
+    assert replica_2.key_rates == {"project": KeyRate(rate=0.5, capacity=2)}
+    assert replica_2.rate == 1
+
+
+@pytest.mark.usefixtures("clear_token_buckets")
+def test_tokens_replenished_in_database(db_engine) -> None:
+    """Tokens taken from a bucket in the database are replenished at its rate, up to capacity."""
+    storage = DatabaseStorage(db_engine)
+
+    assert storage.available_tokens("primary", rate=10, capacity=2) == 2
+    assert [storage.replenish_and_consume("primary", 10, 2, 1) for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+    assert storage.available_tokens("primary", rate=10, capacity=2) < 1
+
+    time.sleep(0.15)
+
+    assert 1 <= storage.available_tokens("primary", rate=10, capacity=2) <= 2
+    assert storage.replenish_and_consume("primary", 10, 2, 1)
+    assert not storage.replenish_and_consume("primary", 10, 2, 1)
+
+
+@pytest.mark.usefixtures("clear_token_buckets")
+def test_seconds_until_token_does_not_write(db_engine) -> None:
+    """Checking when there'll be a token doesn't create or update the bucket in the database."""
+    bucket = TokenBucket(rate=1, capacity=2, storage=DatabaseStorage(db_engine))
+
+    assert bucket.seconds_until_token(key="primary") == 0
+
+    with sessionmaker(db_engine)() as session:
+        assert session.get(TokenBucketState, "primary") is None
+
+
+def test_shared_storage_is_abstract() -> None:
+    """Shared storage must implement all of its methods."""
+    with pytest.raises(TypeError):
+        SharedStorage()  # type: ignore[abstract]
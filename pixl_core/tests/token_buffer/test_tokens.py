@@ -28,12 +28,65 @@ def test_retrieve_token() -> None:
     assert bucket.has_token(key="secondary")
 
 
-def test_invalid_token_key() -> None:
+@pytest.mark.parametrize("key", ["", "default"])
+def test_invalid_token_key(key) -> None:
     """Checks whether invalid key raises an exception."""
     bucket = TokenBucket()
-    match = re.escape("Key must be one of ['primary', 'secondary'], not 'invalid'")
+    match = re.escape(f"Key must be a non-empty string other than 'default', not '{key}'")
     with pytest.raises(ValueError, match=match):
-        bucket.has_token(key="invalid")
+        bucket.has_token(key=key)
+
+
+def test_any_key_has_tokens() -> None:
+    """Keys other than the archives have their own bucket at the rate of the token bucket."""
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.has_token(key="project-1")
+    assert not bucket.has_token(key="project-1")
+    assert bucket.has_token(key="project-2")
+    assert not bucket.has_key_rate("project-1")
+
+
+def test_key_rate() -> None:
+    """Keys given their own rate and capacity don't use the rate of the token bucket."""
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.set_key_rate("big-project", rate=10, capacity=3)
+    bucket.set_key_rate("paused-project", rate=0)
+
+    assert [bucket.has_token(key="big-project") for _ in range(4)] == [True, True, True, False]
+    assert not bucket.has_token(key="paused-project")
+    assert bucket.seconds_until_token(key="paused-project") is None
+    assert bucket.has_key_rate("big-project")
+    assert bucket.key_rates["big-project"].capacity == 3
+
+    bucket.rate = 0.0
+    assert bucket.has_token(key="primary") is False
+    assert bucket.seconds_until_token(key="big-project") is not None
+
+
+def test_key_rate_factor() -> None:
+    """Scaling the rate of a key doesn't change the rate set for it."""
+    bucket = TokenBucket(rate=2, capacity=1)
+    bucket.set_key_rate("secondary", rate=4)
+
+    bucket.set_key_rate_factor("secondary", 0.25)
+    assert bucket.rate_for("secondary") == 1
+    bucket.set_key_rate_factor("primary", 0)
+    assert not bucket.has_token(key="primary")
+    assert bucket.key_rates["secondary"].rate == 4
+
+    bucket.set_key_rate_factor("secondary", None)
+    assert bucket.rate_for("secondary") == 4
+    with pytest.raises(ValueError, match="Rate factor must be between 0 and 1"):
+        bucket.set_key_rate_factor("secondary", 2)
+
+
+def test_invalid_key_rate() -> None:
+    """Checks that key rates can't be negative, and capacities must be at least 1."""
+    bucket = TokenBucket()
+    with pytest.raises(ValueError, match="Rate must be positive"):
+        bucket.set_key_rate("project", rate=-1)
+    with pytest.raises(ValueError, match="Capacity must be at least 1"):
+        bucket.set_key_rate("project", rate=1, capacity=0)
 
 
 def test_refill_tokens() -> None:
@@ -49,6 +102,18 @@ def test_refill_tokens() -> None:
     assert bucket.has_token(key="primary")
 
 
+def test_seconds_until_token() -> None:
+    """Checks the time until a token is available, without taking a token."""
+    bucket = TokenBucket(rate=2, capacity=1)
+
+    assert bucket.seconds_until_token(key="primary") == 0
+    assert bucket.has_token(key="primary")
+    assert 0.4 < bucket.seconds_until_token(key="primary") <= 0.5
+
+    bucket.rate = 0.0
+    assert bucket.seconds_until_token(key="primary") is None
+
+
 def test_zero_rate() -> None:
     """Test that the refill rate can be set to zero"""
     assert TokenBucket(rate=0).rate == 0
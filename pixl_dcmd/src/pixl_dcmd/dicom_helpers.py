@@ -27,24 +27,41 @@ from typing import Generator
 from loguru import logger
 
 from dicom_validator.spec_reader.edition_reader import EditionReader
-from dicom_validator.validator.iod_validator import IODValidator
+from dicom_validator.validator.iod_validator import DicomInfo, IODValidator
 from pydicom import Dataset
 
 if typing.TYPE_CHECKING:
     from loguru import Logger
 
 
+# The DICOM standard of each edition, loaded once per process
+_dicom_info: dict[str, DicomInfo] = {}
+_dicom_info_lock = threading.Lock()
+
+
+def load_dicom_info(edition: str) -> DicomInfo:
+    """
+    Load the DICOM standard for an edition, reading it from disk only the first time.
+
+    The standard is only read by validators, so the same one is shared by all threads. The lock
+    stops threads validating their first instances from each loading it at the same time.
+    """
+    with _dicom_info_lock:
+        if edition not in _dicom_info:
+            # Default from dicom_validator but defining here to be explicit
+            standard_path = str(Path.home() / "dicom-validator")
+            with _redirect_stdout_to_debug(logger):
+                edition_reader = EditionReader(standard_path)
+                destination = edition_reader.get_revision(edition, False)
+            json_path = Path(destination, "json")
+            _dicom_info[edition] = EditionReader.load_dicom_info(json_path)
+        return _dicom_info[edition]
+
+
 class DicomValidator:
     def __init__(self, edition: str = "current"):
         self.edition = edition
-
-        # Default from dicom_validator but defining here to be explicit
-        standard_path = str(Path.home() / "dicom-validator")
-        with _redirect_stdout_to_debug(logger):
-            edition_reader = EditionReader(standard_path)
-            destination = edition_reader.get_revision(self.edition, False)
-        json_path = Path(destination, "json")
-        self.dicom_info = EditionReader.load_dicom_info(json_path)
+        self.dicom_info = load_dicom_info(edition)
 
     def validate_original(self, dataset: Dataset) -> None:
         self.original_errors = IODValidator(
@@ -13,9 +13,12 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import threading
 import typing
+from dataclasses import dataclass, field
 from functools import lru_cache
 from io import BytesIO
+from pathlib import Path
 from zipfile import ZipFile
 
 import requests
@@ -27,7 +30,8 @@ from core.project_config import (
 from decouple import config
 from dicomanonymizer.simpledicomanonymizer import (
     ActionsMapNameFunctions,
-    anonymize_dataset,
+    initialize_actions,
+    keep,
 )
 from loguru import logger
 from pydicom import DataElement, Dataset, dcmread, dcmwrite
@@ -85,7 +89,10 @@ def get_series_to_skip(zipped_study: ZipFile, min_instances: int) -> set[str]:
     for file_info in zipped_study.infolist():
         with zipped_study.open(file_info) as file:
             logger.debug("Reading file {}", file)
-            dataset = dcmread(file)
+            # Only the header is needed, so the pixel data isn't read into memory
+            dataset = dcmread(
+                file, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"]
+            )
             if dataset.SeriesInstanceUID not in series_instances:
                 series_instances[dataset.SeriesInstanceUID] = 1
                 continue
@@ -149,6 +156,92 @@ def anonymise_dicom_and_update_db(
     return validation_errors
 
 
+@dataclass(frozen=True)
+class PseudoIdentifiers:
+    """Pseudonymised identifiers of a study, as recorded in the PIXL database"""
+
+    study_uid: str
+    patient_id: str
+
+
+@dataclass
+class InstanceResult:
+    """
+    Outcome of anonymising an instance of a study.
+
+    :param instance: Bytes of the anonymised instance, or None if it was skipped
+    :param pseudo_identifiers: Pseudonymised identifiers of the anonymised instance
+    :param skip_reason: Why the instance was skipped
+    :param validation_errors: Validation errors introduced by the anonymisation
+    """
+
+    instance: bytes | None = None
+    pseudo_identifiers: PseudoIdentifiers | None = None
+    skip_reason: str | None = None
+    validation_errors: dict = field(default_factory=dict)
+
+
+def anonymise_instance(
+    instance: bytes,
+    config: PixlConfig,
+    *,
+    series_to_keep: typing.Collection[str] = (),
+    series_to_skip: typing.Collection[str] = (),
+    pseudo_identifiers: PseudoIdentifiers | None = None,
+) -> InstanceResult:
+    """
+    Parse, filter, anonymise and validate a DICOM instance, and serialise it again.
+
+    Without `pseudo_identifiers`, the anonymisation is synchronised with the PIXL database
+    as by `anonymise_dicom_and_update_db`. Once that's been done for an instance of a
+    study, its other instances can be given the same identifiers without the database,
+    which allows them to be anonymised in other processes.
+
+    :param instance: Bytes of the DICOM instance
+    :param config: Project config to use for anonymisation
+    :param series_to_keep: Series to keep, or all if empty
+    :param series_to_skip: Series to skip
+    :param pseudo_identifiers: Pseudonymised identifiers of the study
+    """
+    dataset = dcmread(BytesIO(instance))
+
+    if series_to_keep and dataset.SeriesInstanceUID not in series_to_keep:
+        logger.debug(
+            "Skipping series {} as series not in series_to_keep",
+            dataset.SeriesInstanceUID,
+        )
+        return InstanceResult(
+            skip_reason="DICOM instance discarded as series not requested"
+        )
+    if dataset.SeriesInstanceUID in series_to_skip:
+        logger.debug(
+            "Skipping series {} due to too few instances", dataset.SeriesInstanceUID
+        )
+        return InstanceResult(
+            skip_reason="DICOM instance discarded as series has too few instances"
+        )
+
+    try:
+        if pseudo_identifiers is None:
+            validation_errors = anonymise_dicom_and_update_db(dataset, config=config)
+        else:
+            validation_errors = anonymise_and_validate_dicom(dataset, config=config)
+            dataset[0x0020, 0x000D].value = pseudo_identifiers.study_uid
+            dataset[0x0010, 0x0020].value = pseudo_identifiers.patient_id
+    except PixlSkipInstanceError as e:
+        logger.debug("Skipping instance {}: {}", dataset[0x0008, 0x0018].value, e)
+        return InstanceResult(skip_reason=str(e))
+
+    return InstanceResult(
+        instance=write_dataset_to_bytes(dataset),
+        pseudo_identifiers=PseudoIdentifiers(
+            study_uid=dataset[0x0020, 0x000D].value,
+            patient_id=dataset[0x0010, 0x0020].value,
+        ),
+        validation_errors=validation_errors,
+    )
+
+
 def anonymise_and_validate_dicom(
     dataset: Dataset,
     *,
@@ -181,8 +274,8 @@ def anonymise_dicom(
     Anonymises a DICOM dataset as Received by Orthanc in place.
     Finds appropriate configuration based on project name and anonymises by
     - dropping datasets of the wrong modality
-    - recursively applying tag operations based on the config file
-    - deleting any tags not in the tag scheme recursively
+    - deleting any tags not in the tag scheme, and applying the tag operations of the
+      config file to the others, recursively in a single pass
 
     :param dataset: DICOM dataset to be anonymised, updated in place
     :param config: Project config to use for anonymisation
@@ -211,17 +304,89 @@ def anonymise_dicom(
     # Do before anonymisation as some tag operations may rely on pixel data (e.g. burned in pixel detection).
     _clean_dicom_image_pixels(dataset, config)
 
-    # Merge tag schemes
-    tag_operations = load_tag_operations(config)
-    tag_scheme = merge_tag_schemes(tag_operations, manufacturer=dataset.Manufacturer)
+    plan = get_anonymisation_plan(config, manufacturer=dataset.Manufacturer)
 
     logger.debug(
         f"Applying DICOM tag anonymisation according to {config.tag_operation_files}"
     )
-    logger.trace(f"Tag scheme: {tag_scheme}")
+    logger.trace(f"Tag scheme: {plan.tag_scheme}")
+
+    _anonymise_dataset(dataset, plan.tag_actions, plan.allowed_tags)
 
-    _enforce_allowlist(dataset, tag_scheme, recursive=True)
-    _anonymise_dicom_from_scheme(dataset, config.project.name, tag_scheme)
+
+@dataclass(frozen=True)
+class AnonymisationPlan:
+    """
+    Tag operations of a project for the instances of a manufacturer, compiled so that
+    anonymising each instance only needs to walk its tags.
+
+    :param tag_scheme: Base tag schemes merged with the manufacturer's overrides
+    :param allowed_tags: (group, element) of the tags that are kept, all others are deleted
+    :param tag_actions: Anonymiser actions of the tag scheme and the anonymiser's defaults
+    """
+
+    tag_scheme: list[dict]
+    allowed_tags: frozenset[tuple[int, int]]
+    tag_actions: TagActions
+
+
+@dataclass(frozen=True)
+class TagActions:
+    """
+    Anonymiser actions, split by how they are matched to the elements of a dataset.
+
+    :param elements: Action for each (group, element), other than the file meta information
+    :param file_meta: Action for each (group, element) of the file meta information
+    :param ranges: Actions for the elements whose tag matches
+        (group, element, group mask, element mask), such as repeating groups
+    """
+
+    elements: dict[tuple[int, int], typing.Callable]
+    file_meta: dict[tuple[int, int], typing.Callable]
+    ranges: tuple[tuple[tuple[int, int, int, int], typing.Callable], ...]
+
+
+# Plans by project and manufacturer, with the modification times of the files they were
+# compiled from
+_plans: dict[
+    tuple[str, str | None], tuple[tuple[tuple[Path, int], ...], AnonymisationPlan]
+] = {}
+_plans_lock = threading.Lock()
+
+
+def get_anonymisation_plan(
+    config: PixlConfig, manufacturer: str | None
+) -> AnonymisationPlan:
+    """
+    Anonymisation plan for a project and manufacturer, compiled the first time it's needed and
+    again whenever the project's tag operation files change.
+    """
+    files = [
+        *config.tag_operation_files.base,
+        *(config.tag_operation_files.manufacturer_overrides or []),
+    ]
+    files_modified = tuple((file, Path(file).stat().st_mtime_ns) for file in files)
+    key = (config.project.name, manufacturer)
+
+    with _plans_lock:
+        cached = _plans.get(key)
+        if cached is None or cached[0] != files_modified:
+            logger.debug(
+                "Compiling anonymisation plan for {} and manufacturer {}",
+                config.project.name,
+                manufacturer,
+            )
+            tag_operations = load_tag_operations(config)
+            tag_scheme = merge_tag_schemes(tag_operations, manufacturer=manufacturer)
+            plan = AnonymisationPlan(
+                tag_scheme=tag_scheme,
+                allowed_tags=_allowed_tags(tag_scheme),
+                tag_actions=_compile_tag_actions(
+                    _convert_schema_to_actions(config.project.name, tag_scheme)
+                ),
+            )
+            cached = _plans[key] = (files_modified, plan)
+        return cached[1]
 
 
 def _clean_dicom_image_pixels(
@@ -271,34 +436,111 @@ def _anonymise_dicom_from_scheme(
     tag_scheme: list[dict],
 ) -> None:
     """
-    Converts tag scheme to tag actions and calls _anonymise_recursively.
+    Converts tag scheme to tag actions and applies them recursively, without
+    enforcing the allowlist.
+    """
+    tag_actions = _convert_schema_to_actions(project_slug, tag_scheme)
+
+    _anonymise_dataset(dataset, _compile_tag_actions(tag_actions))
+
+
+def _compile_tag_actions(tag_actions: dict[tuple, typing.Callable]) -> TagActions:
+    """
+    Merge tag actions with the anonymiser's default actions, as `anonymize_dataset`
+    does for every dataset it anonymises, and split them by how they are matched.
+    Elements that are kept need no action.
+    """
+    actions = initialize_actions()
+    actions.update(tag_actions)
+    elements = {}
+    file_meta = {}
+    ranges = []
+    for tag, action in actions.items():
+        if action is keep:
+            continue
+        if len(tag) > 2:
+            ranges.append((tag, action))
+        elif tag[0] == 0x0002:
+            file_meta[tag] = action
+        else:
+            elements[tag] = action
+    return TagActions(elements=elements, file_meta=file_meta, ranges=tuple(ranges))
+
+
+def _anonymise_dataset(
+    dataset: Dataset,
+    tag_actions: TagActions,
+    allowed_tags: frozenset[tuple[int, int]] | None = None,
+) -> None:
+    """
+    Anonymises a DICOM dataset in place, in a single pass over its elements and the
+    items of its sequences.
+
+    Each element that isn't in `allowed_tags` is deleted, if they're given, and the
+    actions matching the others are applied, with the same result as enforcing the
+    allowlist and then calling `anonymize_dataset` on the dataset and each item of
+    its sequences.
     """
-    tag_actions = _convert_schema_to_actions(dataset, project_slug, tag_scheme)
+    if hasattr(dataset, "file_meta"):
+        for tag, action in tag_actions.file_meta.items():
+            action(dataset.file_meta, tag)
+    _anonymise_elements(dataset, tag_actions, allowed_tags)
 
-    _anonymise_recursively(dataset, tag_actions)
 
+def _anonymise_elements(
+    dataset: Dataset,
+    tag_actions: TagActions,
+    allowed_tags: frozenset[tuple[int, int]] | None,
+) -> None:
+    for tag in sorted(dataset.keys()):
+        group_element = (tag.group, tag.element)
+        if allowed_tags is not None and group_element not in allowed_tags:
+            del dataset[tag]
+            continue
 
-def _anonymise_recursively(
-    dataset: Dataset, tag_actions: dict[tuple, typing.Callable]
+        actions = [
+            action
+            for (group, element, group_mask, element_mask), action in tag_actions.ranges
+            if tag.group & group_mask == group and tag.element & element_mask == element
+        ]
+        if group_element in tag_actions.elements:
+            actions.append(tag_actions.elements[group_element])
+
+        data_element = dataset[tag]
+        if actions:
+            if data_element.VR == "SQ":
+                for item in data_element.value:
+                    _prepare_sequence_item(item, allowed_tags)
+            for action in actions:
+                action(dataset, group_element)
+            data_element = dataset.get(tag)
+
+        if data_element is not None and data_element.VR == "SQ":
+            for item in data_element.value:
+                _anonymise_elements(item, tag_actions, allowed_tags)
+
+
+def _prepare_sequence_item(
+    item: Dataset, allowed_tags: frozenset[tuple[int, int]] | None
 ) -> None:
     """
-    Anonymises a DICOM dataset recursively (for items in sequences) in place.
+    Actions on a sequence can change the elements of its items, so they must be
+    converted from raw data elements, as walking the item does, and exclude the
+    elements that the allowlist deletes.
     """
-    anonymize_dataset(dataset, tag_actions, delete_private_tags=False)
-    for de in dataset:
-        if de.VR == "SQ":
-            for item in de.value:
-                _anonymise_recursively(item, tag_actions)
+    if allowed_tags is None:
+        item.walk(lambda _dataset, _data_element: None)
+    else:
+        _delete_tags_not_allowed(item, allowed_tags, recursive=True)
 
 
 def _convert_schema_to_actions(
-    dataset: Dataset, project_slug: str, tags_list: list[dict]
+    project_slug: str, tags_list: list[dict]
 ) -> dict[tuple, typing.Callable]:
     """
     Convert the tag schema to actions (functions) for the anonymiser.
     See https://github.com/KitwareMedical/dicom-anonymizer for more details.
-    Added custom function secure-hash for linking purposes. This function needs the MRN and
-    Accession Number, hence why the dataset is passed in as well.
+    Added custom function secure-hash for linking purposes, which hashes with the project slug.
     """
 
     tag_actions = {}
@@ -365,15 +607,30 @@ def _enforce_allowlist(
     """
     Enforce the allowlist on the dataset.
     """
-    dataset.walk(lambda ds, de: _allowlist_tag(ds, de, tag_scheme), recursive)
+    _delete_tags_not_allowed(dataset, _allowed_tags(tag_scheme), recursive)
 
 
-def _allowlist_tag(dataset: Dataset, de: DataElement, tag_scheme: list[dict]) -> None:
-    """Delete element if it is not in the tagging schemе."""
+def _allowed_tags(tag_scheme: list[dict]) -> frozenset[tuple[int, int]]:
+    """(group, element) of the tags in the tag scheme that aren't deleted."""
     tag_dict = _scheme_list_to_dict(tag_scheme)
-    if (de.tag.group, de.tag.element) in tag_dict and tag_dict[
-        (de.tag.group, de.tag.element)
-    ]["op"] != "delete":
+    return frozenset(
+        group_element
+        for group_element, tag in tag_dict.items()
+        if tag["op"] != "delete"
+    )
+
+
+def _delete_tags_not_allowed(
+    dataset: Dataset, allowed_tags: frozenset[tuple[int, int]], recursive: bool
+) -> None:
+    dataset.walk(lambda ds, de: _allowlist_tag(ds, de, allowed_tags), recursive)
+
+
+def _allowlist_tag(
+    dataset: Dataset, de: DataElement, allowed_tags: frozenset[tuple[int, int]]
+) -> None:
+    """Delete element if it is not allowed by the tagging schemе."""
+    if (de.tag.group, de.tag.element) in allowed_tags:
         return
     del dataset[de.tag]
 
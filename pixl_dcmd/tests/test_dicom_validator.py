@@ -14,7 +14,11 @@
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
 import pytest
+from pixl_dcmd import dicom_helpers
 from pixl_dcmd.dicom_helpers import DicomValidator
 from pixl_dcmd.main import anonymise_dicom
 from pydicom import Dataset
@@ -85,3 +89,24 @@ def test_validation_fails_after_invalid_tag_modification(
         "Tag (0010,0010) (Patient's Name) is missing"
         in validation_result["Patient"].keys()
     )
+
+
+def test_dicom_standard_loaded_once(monkeypatch) -> None:
+    """
+    GIVEN validators created by several threads at once
+    WHEN the DICOM standard hasn't been loaded yet
+    THEN it is only loaded once, and shared by all of the validators
+    """
+    edition_reader = Mock()
+    edition_reader.return_value.get_revision.return_value = "dicom-validator/2024e"
+    monkeypatch.setattr(dicom_helpers, "EditionReader", edition_reader)
+    monkeypatch.setattr(dicom_helpers, "_dicom_info", {})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        validators = list(executor.map(lambda _: DicomValidator("2024e"), range(32)))
+
+    edition_reader.load_dicom_info.assert_called_once()
+    assert all(
+        validator.dicom_info is edition_reader.load_dicom_info.return_value
+        for validator in validators
+    )
@@ -14,10 +14,12 @@
 from __future__ import annotations
 
 from importlib import resources
+from io import BytesIO
 import pathlib
 import re
 from pathlib import Path
 import logging
+import os
 import typing
 import zipfile
 
@@ -34,7 +36,11 @@ from core.dicom_tags import (
 )
 from core.exceptions import PixlDiscardError, PixlSkipInstanceError
 from core.project_config import load_project_config, load_tag_operations
-from core.project_config.pixl_config_model import load_config_and_validate, Manufacturer
+from core.project_config.pixl_config_model import (
+    load_config_and_validate,
+    Manufacturer,
+    TagOperationFiles,
+)
 from decouple import config
 
 from pixl_dcmd.dicom_helpers import get_study_info
@@ -47,6 +53,10 @@ from pixl_dcmd.main import (
     _enforce_allowlist,
     _should_exclude_series,
     _should_exclude_manufacturer,
+    get_anonymisation_plan,
+    anonymise_instance,
+    PseudoIdentifiers,
+    write_dataset_to_bytes,
 )
 from pytest_pixl.dicom import generate_dicom_dataset
 from pytest_pixl.helpers import run_subprocess
@@ -330,6 +340,39 @@ def test_anonymisation_with_overrides(
     assert mri_diffusion_dicom_image[(0x2001, 0x1003)] == original_private_tag
 
 
+def test_anonymisation_plan_compiled_until_tag_operations_change(
+    test_project_config: PixlConfig, tmp_path: Path
+) -> None:
+    """
+    GIVEN a project whose tag operations have been compiled into a plan
+    WHEN instances from the same manufacturer are anonymised
+    THEN the plan is reused until the tag operation files change
+    """
+    base_file = tmp_path / "base.yaml"
+    base_file.write_text(test_project_config.tag_operation_files.base[0].read_text())
+    config = test_project_config.model_copy(
+        update={
+            "tag_operation_files": TagOperationFiles(
+                base=[base_file], manufacturer_overrides=None
+            )
+        }
+    )
+
+    plan = get_anonymisation_plan(config, manufacturer="Company")
+    assert get_anonymisation_plan(config, manufacturer="Company") is plan
+    assert get_anonymisation_plan(config, manufacturer="Other") is not plan
+    assert (0x0011, 0x0010) not in plan.allowed_tags
+
+    with base_file.open("a") as base:
+        base.write('- name: "Test"\n  group: 0x0011\n  element: 0x0010\n  op: "keep"\n')
+    modified = base_file.stat().st_mtime_ns + 1_000_000_000
+    os.utime(base_file, ns=(modified, modified))
+
+    recompiled = get_anonymisation_plan(config, manufacturer="Company")
+    assert recompiled is not plan
+    assert (0x0011, 0x0010) in recompiled.allowed_tags
+
+
 @pytest.mark.usefixtures()
 def test_drop_unspecified_modalities(test_project_config: PixlConfig) -> None:
     """
@@ -491,6 +534,65 @@ def test_no_pseudo_patient_id_processing(
     )
 
 
+@pytest.mark.parametrize(
+    ("series_to_keep", "series_to_skip", "skip_reason"),
+    [
+        (["2.25.2"], set(), "DICOM instance discarded as series not requested"),
+        ([], {"2.25.1"}, "DICOM instance discarded as series has too few instances"),
+    ],
+)
+def test_anonymise_instance_skips_series(
+    series_to_keep, series_to_skip, skip_reason, test_project_config
+):
+    """
+    GIVEN an instance of a series that isn't requested, or has too few instances
+    WHEN the instance is anonymised
+    THEN it is skipped, with the reason why
+    """
+    dataset = generate_dicom_dataset(Modality="DX", SeriesInstanceUID="2.25.1")
+
+    result = anonymise_instance(
+        write_dataset_to_bytes(dataset),
+        test_project_config,
+        series_to_keep=series_to_keep,
+        series_to_skip=series_to_skip,
+    )
+
+    assert result.instance is None
+    assert result.skip_reason == skip_reason
+
+
+def test_anonymise_instance_with_pseudo_identifiers(monkeypatch, test_project_config):
+    """
+    GIVEN the pseudonymised identifiers of a study, synchronised with the database
+    WHEN another of its instances is anonymised with them
+    THEN the instance is given the identifiers without using the database
+    """
+
+    def use_database(*args):
+        raise AssertionError("The database shouldn't be used")
+
+    monkeypatch.setattr(
+        "pixl_dcmd.main.get_uniq_pseudo_study_uid_and_update_db", use_database
+    )
+    monkeypatch.setattr(
+        "pixl_dcmd.main.get_pseudo_patient_id_and_update_db", use_database
+    )
+    pseudo_identifiers = PseudoIdentifiers(study_uid="2.25.3", patient_id="pseudo-id")
+    dataset = generate_dicom_dataset(Modality="DX")
+
+    result = anonymise_instance(
+        write_dataset_to_bytes(dataset),
+        test_project_config,
+        pseudo_identifiers=pseudo_identifiers,
+    )
+
+    assert result.pseudo_identifiers == pseudo_identifiers
+    anonymised = pydicom.dcmread(BytesIO(result.instance))
+    assert anonymised.StudyInstanceUID == pseudo_identifiers.study_uid
+    assert anonymised.PatientID == pseudo_identifiers.patient_id
+
+
 def _make_dicom(
     series_description="mri_sequence",
     manufacturer="Company",
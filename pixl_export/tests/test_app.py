@@ -15,11 +15,17 @@
 
 from __future__ import annotations
 
+from typing import TYPE_CHECKING
+
+import pytest
 from core.rest_api.router import state
 from fastapi.testclient import TestClient
 
 from pixl_export.main import app
 
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
 AppState = state.__class__
 client = TestClient(app)
 
@@ -32,3 +38,39 @@ def test_heartbeat_response_is_200() -> None:
 def test_initial_state_has_no_token() -> None:
     assert not AppState().token_bucket.has_token(key="primary")
     assert not AppState().token_bucket.has_token(key="secondary")
+
+
+@pytest.fixture
+def project_key() -> Generator[str]:
+    """Key for a project, whose rate is removed from the shared token bucket afterwards."""
+    yield "my-project"
+    state.token_bucket.remove_key_rate("my-project")
+
+
+def test_key_refresh_rate(project_key) -> None:
+    """Keys can be given their own rate and capacity, which are returned with the bucket's rate."""
+    response = client.post(
+        "/token-bucket-refresh-rate", json={"rate": 0.5, "key": project_key, "capacity": 2}
+    )
+    assert response.status_code == 200
+
+    response = client.get("/token-bucket-refresh-rate", params={"key": project_key})
+    assert response.json()["rate"] == 0.5
+    assert response.json()["capacity"] == 2
+
+    response = client.get("/token-bucket-refresh-rate")
+    assert response.json()["key_rates"][project_key] == {"rate": 0.5, "capacity": 2}
+
+    response = client.get("/token-bucket-refresh-rate", params={"key": "other-project"})
+    assert response.status_code == 404
+
+
+def test_capacity_needs_key() -> None:
+    response = client.post("/token-bucket-refresh-rate", json={"rate": 1, "capacity": 2})
+    assert response.status_code == 406
+
+
+def test_consumer_stats_without_consumers() -> None:
+    response = client.get("/consumer-stats")
+    assert response.status_code == 200
+    assert response.json() == {}
@@ -0,0 +1,191 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Batch retrievals of studies from an archive into a single C-MOVE."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Coroutine
+
+    from pixl_imaging._orthanc import Orthanc
+
+
+@dataclass
+class _RetrieveRequest:
+    """Resources to retrieve for a single message, and the outcome for that message."""
+
+    resources: list[dict[str, str]]
+    result: asyncio.Future[bool]
+
+
+@dataclass
+class _Batch:
+    """Requests waiting to be retrieved from a modality at a query level."""
+
+    requests: list[_RetrieveRequest] = field(default_factory=list)
+    timer: asyncio.Task | None = None
+
+
+class RetrieveBatcher:
+    """
+    Collect retrievals from an archive for up to `window` seconds, or until there are `batch_size`
+    studies, then retrieve them all in a single C-MOVE.
+
+    Each study retrieved on its own costs a C-MOVE association and an Orthanc job, which dominates
+    the transfer time of small studies. Once the batched job finishes, each study succeeds if it's
+    now in Orthanc. If the job as a whole failed, a study that is in Orthanc may only have been
+    partly moved, so the caller is told to check it for missing instances.
+
+    A `batch_size` of 1 disables batching.
+    """
+
+    def __init__(self, orthanc: Orthanc, batch_size: int = 1, window: float = 2) -> None:
+        self._orthanc = orthanc
+        self.batch_size = batch_size
+        self.window = window
+
+        self._batches: dict[tuple[str, str], _Batch] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.batch_size > 1
+
+    async def retrieve(self, modality: str, level: str, resources: list[dict[str, str]]) -> bool:
+        """
+        Retrieve resources from a modality as part of a batch, waiting for the batch to finish.
+
+        :param modality: modality to retrieve from
+        :param level: "Study" or "Series", all resources in a batch are retrieved at the same level
+        :param resources: UIDs of the studies, or series, to retrieve
+        :return: whether the batched job succeeded. If it failed, the resources are in Orthanc
+            but may be missing instances.
+        :raises PixlDiscardError: if the resources weren't retrieved
+        """
+        key = (modality, level)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timer = self._create_task(self._flush_after_window(key, batch))
+
+        request = _RetrieveRequest(
+            resources=resources,
+            result=asyncio.get_running_loop().create_future(),
+        )
+        batch.requests.append(request)
+        if len(batch.requests) >= self.batch_size:
+            self._flush(key, batch)
+
+        return await request.result
+
+    async def stop(self) -> None:
+        """Stop waiting to send batches, requeuing the messages in them."""
+        for batch in self._batches.values():
+            if batch.timer is not None:
+                batch.timer.cancel()
+            for request in batch.requests:
+                if not request.result.done():
+                    msg = "Stopped before batched retrieval was sent"
+                    request.result.set_exception(PixlRequeueMessageError(msg))
+        self._batches.clear()
+        for task in list(self._tasks):
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _flush_after_window(self, key: tuple[str, str], batch: _Batch) -> None:
+        await asyncio.sleep(self.window)
+        batch.timer = None
+        self._flush(key, batch)
+
+    def _flush(self, key: tuple[str, str], batch: _Batch) -> None:
+        if self._batches.get(key) is not batch:
+            return
+        del self._batches[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        modality, level = key
+        self._create_task(self._send(modality, level, batch.requests))
+
+    def _create_task(self, coroutine: Coroutine[Any, Any, None]) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _send(self, modality: str, level: str, requests: list[_RetrieveRequest]) -> None:
+        try:
+            await self._retrieve_batch(modality, level, requests)
+        finally:
+            for request in requests:
+                _set_exception(request, PixlRequeueMessageError("Batched retrieval was stopped"))
+
+    async def _retrieve_batch(
+        self, modality: str, level: str, requests: list[_RetrieveRequest]
+    ) -> None:
+        resources = [resource for request in requests for resource in request.resources]
+        logger.debug(
+            "Retrieving {} resources for {} messages from {} in one batch",
+            len(resources),
+            len(requests),
+            modality,
+        )
+        job_error: PixlDiscardError | None = None
+        try:
+            job_id = await self._orthanc.retrieve_resources_from_remote(
+                modality, level=level, resources=resources
+            )
+            # Studies in a batch are transferred one after the other
+            await self._orthanc.wait_for_job_success_or_raise(
+                job_id, "batched c-move", timeout=self._orthanc.dicom_timeout * len(requests)
+            )
+        except PixlDiscardError as err:
+            job_error = err
+        except Exception as err:  # noqa: BLE001
+            for request in requests:
+                _set_exception(request, err)
+            return
+
+        for request in requests:
+            try:
+                retrieved = await self._all_present(level, request.resources)
+            except Exception as err:  # noqa: BLE001
+                _set_exception(request, err)
+                continue
+            if retrieved:
+                if not request.result.done():
+                    request.result.set_result(job_error is None)
+                continue
+            _set_exception(
+                request, job_error or PixlDiscardError(f"Batched c-move missed {request.resources}")
+            )
+
+    async def _all_present(self, level: str, resources: list[dict[str, str]]) -> bool:
+        for resource in resources:
+            if not await self._orthanc.query_local({"Level": level, "Query": resource}):
+                return False
+        return True
+
+
+def _set_exception(request: _RetrieveRequest, err: BaseException) -> None:
+    if not request.result.done():
+        request.result.set_exception(err)
@@ -0,0 +1,121 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Consumers of the imaging queues, run by imaging-api or by each of its workers."""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
+
+from core.patient_queue.subscriber import PixlConsumer
+from decouple import config
+
+from pixl_imaging._processing import DicomModality, process_message, secondary_schedule
+from pixl_imaging._rate_controller import RateController
+from pixl_imaging._schedule import ConsumptionScheduler
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from core.token_buffer import TokenBucket
+
+    from pixl_imaging._orthanc import PIXLAnonOrthanc, PIXLRawOrthanc
+
+QUEUE_NAME = "imaging-primary"
+SECONDARY_QUEUE_NAME = "imaging-secondary"
+
+# Token bucket key of each queue's consumer
+TOKEN_BUCKET_KEYS = {QUEUE_NAME: "primary", SECONDARY_QUEUE_NAME: "secondary"}
+
+
+def rate_controller_from_config(
+    token_bucket: TokenBucket, orthanc_raw: PIXLRawOrthanc
+) -> RateController | None:
+    """Rate controller set by PIXL_RATE_CONTROLLER_*, or None if it isn't enabled."""
+    if not config("PIXL_RATE_CONTROLLER_ENABLED", default=False, cast=bool):
+        return None
+    return RateController(
+        token_bucket,
+        orthanc_raw,
+        min_rate=config("PIXL_RATE_CONTROLLER_MIN_RATE", default=0.1, cast=float),
+        max_rate=config("PIXL_RATE_CONTROLLER_MAX_RATE", default=10, cast=float),
+        increase=config("PIXL_RATE_CONTROLLER_INCREASE", default=0.5, cast=float),
+        decrease=config("PIXL_RATE_CONTROLLER_DECREASE", default=0.5, cast=float),
+        interval=config("PIXL_RATE_CONTROLLER_INTERVAL", default=30, cast=float),
+        query_latency=config("PIXL_RATE_CONTROLLER_QUERY_LATENCY", default=10, cast=float),
+        move_latency=config("PIXL_RATE_CONTROLLER_MOVE_LATENCY", default=120, cast=float),
+    )
+
+
+@asynccontextmanager
+async def run_consumers(
+    token_bucket: TokenBucket, orthanc_raw: PIXLRawOrthanc, orthanc_anon: PIXLAnonOrthanc
+) -> AsyncIterator[dict[str, PixlConsumer]]:
+    """
+    Consume from the imaging queues in the background, yielding the consumers by queue name.
+
+    Task create: the coroutine submitted to run "in the background",
+    i.e. concurrently with the current task and all other tasks,
+    switching between them at await points
+    the task is consumer.run and the callback is _processing.process_message
+
+    The secondary queue is only consumed from within PIXL_SECONDARY_SCHEDULE.
+    """
+    background_tasks = set()
+    async with (
+        PixlConsumer(
+            QUEUE_NAME,
+            token_bucket=token_bucket,
+            token_bucket_key=TOKEN_BUCKET_KEYS[QUEUE_NAME],
+            callback=lambda message: process_message(
+                message,
+                archive=DicomModality.primary,
+                orthanc_raw=orthanc_raw,
+                orthanc_anon=orthanc_anon,
+            ),
+        ) as primary_consumer,
+        PixlConsumer(
+            SECONDARY_QUEUE_NAME,
+            token_bucket=token_bucket,
+            token_bucket_key=TOKEN_BUCKET_KEYS[SECONDARY_QUEUE_NAME],
+            callback=lambda message: process_message(
+                message,
+                archive=DicomModality.secondary,
+                orthanc_raw=orthanc_raw,
+                orthanc_anon=orthanc_anon,
+            ),
+        ) as secondary_consumer,
+    ):
+        task = asyncio.create_task(primary_consumer.run())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+        # Started first, so that the secondary consumer doesn't consume outside of the schedule
+        secondary_scheduler = ConsumptionScheduler(
+            secondary_schedule,
+            token_bucket,
+            secondary_consumer,
+            ramp=config("PIXL_SECONDARY_SCHEDULE_RAMP", default=300, cast=float),
+        )
+        secondary_scheduler.start()
+
+        task = asyncio.create_task(secondary_consumer.run())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+        try:
+            yield {QUEUE_NAME: primary_consumer, SECONDARY_QUEUE_NAME: secondary_consumer}
+        finally:
+            await secondary_scheduler.stop()
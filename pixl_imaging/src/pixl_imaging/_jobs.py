@@ -0,0 +1,413 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Watch Orthanc jobs with a single polling loop per Orthanc node."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import weakref
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from time import time
+from typing import TYPE_CHECKING, Any
+
+import aiohttp
+from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+from loguru import logger
+from opentelemetry import metrics
+
+from pixl_imaging._metrics import orthanc_metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from opentelemetry.metrics import CallbackOptions
+
+    from pixl_imaging._orthanc import Orthanc
+
+
+@dataclass(frozen=True)
+class JobsSnapshot:
+    """Counts of unfinished jobs on an Orthanc node at a point in time."""
+
+    pending: int = 0
+    running: int = 0
+    refreshed_at: float = 0
+
+    @classmethod
+    def from_jobs(cls, jobs: Iterable[dict]) -> JobsSnapshot:
+        """Count the unfinished jobs from an expanded list of Orthanc jobs."""
+        pending = running = 0
+        for job in jobs:
+            if job["State"] == "Pending":
+                pending += 1
+            elif job["State"] not in ("Success", "Failure"):
+                running += 1
+        return cls(pending=pending, running=running, refreshed_at=time())
+
+    @property
+    def age(self) -> float:
+        """Seconds since the snapshot was taken."""
+        return time() - self.refreshed_at
+
+
+@dataclass(frozen=True)
+class OrthancOperation:
+    """Outcome of a query or job that Orthanc ran against a remote modality."""
+
+    kind: str
+    duration: float
+    failed: bool
+    finished_at: float
+
+
+@dataclass
+class _WatchedJob:
+    """A job that a message is waiting on."""
+
+    job_type: str
+    timeout: float
+    result: asyncio.Future[dict]
+    state: str = "Pending"
+    outcome: str = "stopped"
+    timer_started: float = field(default_factory=time)
+    failed_polls: int = 0
+
+    def fail(self, outcome: str, msg: str) -> None:
+        """Stop waiting on the job, raising a PixlDiscardError for the message."""
+        self.outcome = outcome
+        self.result.set_exception(PixlDiscardError(msg))
+
+
+class JobMonitor:
+    """
+    Track the state of jobs on an Orthanc node, resolving a future for each job once it finishes.
+
+    All watched jobs are checked with a single `GET /jobs?expand` per poll, so the load on Orthanc
+    does not grow with the number of messages in flight. Polling starts at `min_interval` whenever
+    a new job is watched and backs off towards `max_interval` while no job changes state, so short
+    jobs are picked up quickly without polling long jobs aggressively.
+
+    A job that Orthanc no longer knows about fails straight away, and a job whose state could not
+    be fetched for `max_failed_polls` polls in a row fails without affecting the other jobs.
+
+    The polling task only runs while there are jobs being watched.
+    """
+
+    def __init__(
+        self,
+        orthanc: Orthanc,
+        min_interval: float = 0.5,
+        max_interval: float = 10,
+        backoff: float = 2,
+        max_failed_polls: int = 5,
+    ) -> None:
+        self._orthanc = orthanc
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_failed_polls = max_failed_polls
+
+        self.snapshot: JobsSnapshot | None = None
+        self._jobs: dict[str, _WatchedJob] = {}
+        self._interval = min_interval
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def watched_jobs(self) -> int:
+        """Number of jobs currently being waited on."""
+        return len(self._jobs)
+
+    async def wait_for_job(self, job_id: str, job_type: str, timeout: float) -> dict:
+        """
+        Wait for a job to succeed, returning its final state.
+
+        Raise a PixlDiscardError if the job fails, if its state can't be fetched from Orthanc, or
+        if it hasn't finished `timeout` seconds after being watched. Time that Orthanc reports the
+        job as Pending does not count towards the timeout.
+        """
+        job = _WatchedJob(
+            job_type=job_type,
+            timeout=timeout,
+            result=asyncio.get_running_loop().create_future(),
+        )
+        self._jobs[job_id] = job
+        self._interval = self.min_interval
+        self._wake.set()
+        self._ensure_running()
+        started_at = time()
+        try:
+            job_info = await job.result
+        except PixlDiscardError:
+            self._orthanc.record_operation(job_type, time() - started_at, failed=True)
+            raise
+        finally:
+            self._jobs.pop(job_id, None)
+            orthanc_metrics.record_job(
+                self._orthanc.aet, job_type, job.outcome, time() - started_at
+            )
+        self._orthanc.record_operation(job_type, time() - started_at, failed=False)
+        return job_info
+
+    async def stop(self) -> None:
+        """Stop polling, failing any jobs still being waited on."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for job_id, job in list(self._jobs.items()):
+            if not job.result.done():
+                msg = f"Stopped watching {job.job_type} job {job_id}"
+                job.result.set_exception(PixlDiscardError(msg))
+
+    async def refresh(self) -> dict[str, dict]:
+        """Fetch all jobs from Orthanc, updating the snapshot of unfinished jobs."""
+        jobs = await self._orthanc.get_jobs()
+        self.snapshot = JobsSnapshot.from_jobs(jobs)
+        return {job["ID"]: job for job in jobs}
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._jobs:
+            self._wake.clear()
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), timeout=self._interval)
+            # A new job has just been submitted, give it a moment to start
+            if self._wake.is_set():
+                await asyncio.sleep(self.min_interval)
+
+            try:
+                changed = await self._poll()
+            except Exception:  # noqa: BLE001
+                logger.exception("Failed to poll jobs on {}", self._orthanc.aet)
+                changed = False
+
+            if changed:
+                self._interval = self.min_interval
+            else:
+                self._interval = min(self._interval * self.backoff, self.max_interval)
+
+    async def _poll(self) -> bool:
+        """Update the state of all watched jobs, returning whether any of them changed."""
+        if not self._jobs:
+            return False
+
+        changed = False
+        try:
+            jobs = await self.refresh()
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to fetch jobs from {}: {}", self._orthanc.aet, exc)
+            for job_id, job in self._unfinished_jobs():
+                self._record_failed_poll(job_id, job, exc)
+        else:
+            for job_id, job in self._unfinished_jobs():
+                # The job may have dropped out of Orthanc's job history, so fall back to asking
+                job_info = jobs.get(job_id) or await self._fetch_job(job_id, job)
+                if job_info is not None:
+                    job.failed_polls = 0
+                    changed |= _update_job(job_id, job, job_info)
+
+        for job_id, job in self._unfinished_jobs():
+            if (time() - job.timer_started) > job.timeout:
+                msg = f"Failed to finish {job.job_type} job {job_id} in {job.timeout} seconds"
+                job.fail("timeout", msg)
+        return changed
+
+    def _unfinished_jobs(self) -> list[tuple[str, _WatchedJob]]:
+        return [(job_id, job) for job_id, job in self._jobs.items() if not job.result.done()]
+
+    async def _fetch_job(self, job_id: str, job: _WatchedJob) -> dict | None:
+        """Fetch a single job's state, returning None if it couldn't be fetched."""
+        try:
+            job_info: dict = await self._orthanc.job_state(job_id=job_id)
+        except aiohttp.ClientResponseError as exc:
+            if exc.status == HTTPStatus.NOT_FOUND:
+                job.fail("missing", f"{job.job_type} job {job_id} not found in {self._orthanc.aet}")
+                return None
+            self._record_failed_poll(job_id, job, exc)
+        except Exception as exc:  # noqa: BLE001
+            self._record_failed_poll(job_id, job, exc)
+        else:
+            return job_info
+        return None
+
+    def _record_failed_poll(self, job_id: str, job: _WatchedJob, exc: Exception) -> None:
+        job.failed_polls += 1
+        logger.debug(
+            "Failed to fetch {} job {} from {}: {}", job.job_type, job_id, self._orthanc.aet, exc
+        )
+        if job.failed_polls >= self.max_failed_polls:
+            msg = (
+                f"Failed to fetch {job.job_type} job {job_id} from {self._orthanc.aet} "
+                f"{job.failed_polls} times in a row: {exc}"
+            )
+            job.fail("error", msg)
+
+
+def _update_job(job_id: str, job: _WatchedJob, job_info: dict[str, Any]) -> bool:
+    """Update a watched job from its Orthanc state, returning whether the state changed."""
+    state: str = job_info["State"]
+    changed = state != job.state
+    job.state = state
+
+    if state == "Success":
+        job.outcome = "success"
+        job.result.set_result(job_info)
+    elif state == "Failure":
+        msg = f"Job failed: Error code={job_info['ErrorCode']} Cause={job_info['ErrorDescription']}"
+        job.fail("failure", msg)
+    elif state == "Pending":
+        job.timer_started = time()
+    elif job.job_type == "modify":
+        logger.debug("Modify job {}: {}", job_id, job_info)
+    return changed
+
+
+class PendingJobsGate:
+    """
+    Admit messages while the number of pending jobs on an Orthanc node is within a limit.
+
+    Orthanc starts to get buggy when there are a whole load of pending jobs, so messages are
+    requeued while there are more than `max_pending_jobs` pending. Rather than fetching every job
+    for every message, the gate uses the job monitor's snapshot, which is refreshed in the
+    background every `refresh_interval` seconds while the node's connection pool is open.
+
+    Each message admitted since the snapshot was taken may have submitted a job that is now
+    pending, so they are counted as pending jobs until the snapshot is refreshed. If only those
+    admissions would have a message requeued, the snapshot is refreshed first.
+    """
+
+    def __init__(
+        self,
+        orthanc: Orthanc,
+        max_pending_jobs: int = 0,
+        refresh_interval: float = 5,
+    ) -> None:
+        self._orthanc = orthanc
+        self.max_pending_jobs = max_pending_jobs
+        self.refresh_interval = refresh_interval
+
+        self._task: asyncio.Task | None = None
+        self._admitted = 0
+        self._admitted_since: JobsSnapshot | None = None
+        _gates.add(self)
+
+    @property
+    def snapshot(self) -> JobsSnapshot | None:
+        """Latest snapshot of the unfinished jobs on the node."""
+        return self._orthanc.job_monitor.snapshot
+
+    @property
+    def pending_jobs(self) -> int:
+        """Pending jobs in the latest snapshot."""
+        return self.snapshot.pending if self.snapshot else 0
+
+    @property
+    def over_limit(self) -> bool:
+        """Whether the latest snapshot has more pending jobs than the limit."""
+        return self.pending_jobs > self.max_pending_jobs
+
+    @property
+    def admitted(self) -> int:
+        """Messages admitted since the latest snapshot was taken."""
+        return self._admitted if self._admitted_since is self.snapshot else 0
+
+    @property
+    def is_open(self) -> bool:
+        """Whether another message would be admitted."""
+        return self.pending_jobs + self.admitted <= self.max_pending_jobs
+
+    async def admit_or_raise(self) -> None:
+        """Admit a message, or raise PixlRequeueMessageError to have it requeued."""
+        if self._orthanc.is_open:
+            self._ensure_refreshing()
+        if (
+            self.snapshot is None
+            or self.snapshot.age > self.refresh_interval
+            or (not self.is_open and not self.over_limit)
+        ):
+            await self._refresh()
+
+        if not self.is_open:
+            msg = (
+                f"{self.pending_jobs} pending jobs in orthanc raw and {self.admitted} messages "
+                f"admitted since, limit is {self.max_pending_jobs}"
+            )
+            raise PixlRequeueMessageError(msg)
+        self._admitted = self.admitted + 1
+        self._admitted_since = self.snapshot
+
+    async def stop(self) -> None:
+        """Stop refreshing the snapshot in the background."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _refresh(self) -> None:
+        await self._orthanc.job_monitor.refresh()
+        logger.trace("Unfinished jobs on {}: {}", self._orthanc.aet, self.snapshot)
+
+    def _ensure_refreshing(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            # The job monitor may have refreshed the snapshot recently
+            snapshot_age = self.snapshot.age if self.snapshot else self.refresh_interval
+            if snapshot_age >= self.refresh_interval:
+                try:
+                    await self._refresh()
+                except Exception:  # noqa: BLE001
+                    logger.exception("Failed to refresh jobs on {}", self._orthanc.aet)
+                snapshot_age = 0
+            await asyncio.sleep(self.refresh_interval - snapshot_age)
+
+
+_gates: weakref.WeakSet[PendingJobsGate] = weakref.WeakSet()
+
+
+def _observe_gates(_options: CallbackOptions) -> Iterable[metrics.Observation]:
+    for gate in list(_gates):
+        attributes = {"aet": gate._orthanc.aet}  # noqa: SLF001
+        yield metrics.Observation(gate.pending_jobs, {**attributes, "state": "pending"})
+        running = gate.snapshot.running if gate.snapshot else 0
+        yield metrics.Observation(running, {**attributes, "state": "running"})
+
+
+def _observe_gates_open(_options: CallbackOptions) -> Iterable[metrics.Observation]:
+    for gate in list(_gates):
+        yield metrics.Observation(int(gate.is_open), {"aet": gate._orthanc.aet})  # noqa: SLF001
+
+
+_meter = metrics.get_meter("pixl_imaging.jobs")
+_meter.create_observable_gauge(
+    "pixl.orthanc.unfinished_jobs",
+    callbacks=[_observe_gates],
+    description="Unfinished jobs on an Orthanc node, as seen by the pending jobs gate",
+)
+_meter.create_observable_gauge(
+    "pixl.orthanc.pending_jobs_gate.open",
+    callbacks=[_observe_gates_open],
+    description="Whether the pending jobs gate is admitting messages (1) or requeuing them (0)",
+)
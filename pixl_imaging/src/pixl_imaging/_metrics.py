@@ -0,0 +1,220 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Latency metrics for Orthanc REST calls and jobs.
+
+Metrics are recorded with OpenTelemetry, which exports them when telemetry is enabled, and are
+also kept in process so they can be scraped from imaging-api in Prometheus text format without
+a collector.
+"""
+
+from __future__ import annotations
+
+import bisect
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# Seconds, from local REST calls up to slow C-MOVEs
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+
+# Path segments following these are Orthanc IDs, answer indexes etc.
+_RESOURCE_COLLECTIONS = {"answers", "instances", "jobs", "patients", "queries", "series", "studies"}
+
+type _Attributes = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class _HistogramData:
+    bucket_counts: list[int] = field(default_factory=lambda: [0] * (len(DURATION_BUCKETS) + 1))
+    count: int = 0
+    total: float = 0
+
+
+class _LocalHistogram:
+    """Cumulative histogram of durations per set of attributes, for the Prometheus endpoint."""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._data: dict[_Attributes, _HistogramData] = {}
+
+    def record(self, value: float, attributes: dict[str, str]) -> None:
+        key = tuple(sorted(attributes.items()))
+        data = self._data.setdefault(key, _HistogramData())
+        data.bucket_counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        data.count += 1
+        data.total += value
+
+    def merge(self, other: _LocalHistogram) -> None:
+        """Add the durations recorded by another histogram, e.g. from another process."""
+        for key, other_data in other._data.items():
+            data = self._data.setdefault(key, _HistogramData())
+            data.bucket_counts = [
+                count + other_count
+                for count, other_count in zip(
+                    data.bucket_counts, other_data.bucket_counts, strict=True
+                )
+            ]
+            data.count += other_data.count
+            data.total += other_data.total
+
+    def prometheus_lines(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, data in sorted(self._data.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(
+                (*DURATION_BUCKETS, "+Inf"), data.bucket_counts, strict=True
+            ):
+                cumulative += bucket_count
+                labels = _labels((*key, ("le", str(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(key)} {data.total}")
+            lines.append(f"{self.name}_count{_labels(key)} {data.count}")
+        return lines
+
+
+def _labels(attributes: _Attributes) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in attributes) + "}"
+
+
+def endpoint_template(path: str) -> str:
+    """
+    Template of an Orthanc REST endpoint, replacing IDs so that metrics have a bounded set of
+    endpoints, e.g. `/queries/{id}/answers/{id}/content`.
+    """
+    segments = path.split("?", 1)[0].split("/")
+    template = [
+        "{id}" if index > 0 and segments[index - 1] in _RESOURCE_COLLECTIONS else segment
+        for index, segment in enumerate(segments)
+    ]
+    return "/".join(template)
+
+
+@dataclass
+class LocalMetrics:
+    """
+    Metrics kept in process for the Prometheus endpoint, which can be sent between processes and
+    combined.
+    """
+
+    request_duration: _LocalHistogram = field(
+        default_factory=lambda: _LocalHistogram(
+            "pixl_orthanc_request_duration_seconds", "Duration of REST requests to Orthanc"
+        )
+    )
+    job_duration: _LocalHistogram = field(
+        default_factory=lambda: _LocalHistogram(
+            "pixl_orthanc_job_duration_seconds",
+            "Time from submitting an Orthanc job to it finishing",
+        )
+    )
+
+    @classmethod
+    def merge(cls, all_metrics: Iterable[LocalMetrics]) -> LocalMetrics:
+        """Combine the metrics of several processes."""
+        merged = cls()
+        for local_metrics in all_metrics:
+            merged.request_duration.merge(local_metrics.request_duration)
+            merged.job_duration.merge(local_metrics.job_duration)
+        return merged
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            *self.request_duration.prometheus_lines(),
+            *self.job_duration.prometheus_lines(),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class OrthancMetrics:
+    """Durations and counts of REST requests to Orthanc, and of the Orthanc jobs waited on."""
+
+    def __init__(self) -> None:
+        meter = metrics.get_meter("pixl_imaging.orthanc")
+        self._request_duration = meter.create_histogram(
+            "pixl.orthanc.request.duration",
+            unit="s",
+            description="Duration of REST requests to Orthanc",
+        )
+        self._requests = meter.create_counter(
+            "pixl.orthanc.requests", description="REST requests to Orthanc"
+        )
+        self._job_duration = meter.create_histogram(
+            "pixl.orthanc.job.duration",
+            unit="s",
+            description="Time from submitting an Orthanc job to it finishing",
+        )
+        self._jobs = meter.create_counter(
+            "pixl.orthanc.jobs", description="Orthanc jobs that PIXL waited on"
+        )
+
+        self.local = LocalMetrics()
+
+    def record_request(
+        self, aet: str, method: str, path: str, status: str, duration: float
+    ) -> None:
+        """Record a REST request, with `status` the HTTP status code or "error" if none."""
+        attributes = {
+            "aet": aet,
+            "method": method,
+            "endpoint": endpoint_template(path),
+            "status": status,
+        }
+        self._request_duration.record(duration, attributes)
+        self._requests.add(1, attributes)
+        self.local.request_duration.record(duration, attributes)
+
+    def record_job(self, aet: str, job_type: str, outcome: str, duration: float) -> None:
+        """
+        Record a job that was waited on, with its `outcome`.
+
+        The outcome is one of success, failure, timeout, missing, error or stopped.
+        """
+        attributes = {"aet": aet, "job_type": job_type, "outcome": outcome}
+        self._job_duration.record(duration, attributes)
+        self._jobs.add(1, attributes)
+        self.local.job_duration.record(duration, attributes)
+
+    def prometheus_text(self) -> str:
+        """All metrics recorded in this process, in the Prometheus text exposition format."""
+        return self.local.prometheus_text()
+
+
+orthanc_metrics = OrthancMetrics()
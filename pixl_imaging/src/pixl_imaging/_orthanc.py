@@ -13,15 +13,27 @@
 #  limitations under the License.
 from __future__ import annotations
 
-from asyncio import sleep
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from http import HTTPStatus
 from time import time
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import aiohttp
-from core.exceptions import PixlDiscardError, PixlRequeueMessageError
 from decouple import config
 from loguru import logger
 
+from pixl_imaging._batching import RetrieveBatcher
+from pixl_imaging._jobs import JobMonitor, OrthancOperation, PendingJobsGate
+from pixl_imaging._metrics import orthanc_metrics
+from pixl_imaging._query_cache import QueryCache
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterable
+
+    from pixl_imaging._query_cache import CachedQuery
+
 
 class Orthanc:
     def __init__(  # noqa: PLR0913
@@ -32,6 +44,8 @@ class Orthanc:
         http_timeout: int,
         dicom_timeout: int,
         aet: str,
+        max_connections: int = 100,
+        keepalive_timeout: float = 15,
     ) -> None:
         if not url:
             msg = "URL for orthanc is required"
@@ -45,11 +59,130 @@ class Orthanc:
         self.http_timeout = http_timeout
         self.dicom_timeout = dicom_timeout
 
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self._session: aiohttp.ClientSession | None = None
+        self._requests_in_flight = 0
+        self._max_requests_in_flight = 0
+
+        self._modality_semaphores: dict[str, asyncio.Semaphore] = {}
+        self.recent_operations: deque[OrthancOperation] = deque(maxlen=1000)
+
+        self.job_monitor = JobMonitor(
+            self,
+            min_interval=config("PIXL_JOB_POLL_MIN_INTERVAL", default=0.5, cast=float),
+            max_interval=config("PIXL_JOB_POLL_MAX_INTERVAL", default=10, cast=float),
+            max_failed_polls=config("PIXL_JOB_POLL_MAX_FAILURES", default=5, cast=int),
+        )
+        self.query_cache = QueryCache(
+            ttl=config("PIXL_QUERY_CACHE_TTL", default=600, cast=float),
+            max_size=config("PIXL_QUERY_CACHE_SIZE", default=1000, cast=int),
+            negative_ttl=config("PIXL_QUERY_CACHE_NEGATIVE_TTL", default=30, cast=float),
+        )
+
+    async def open(self) -> None:
+        """
+        Open a keep-alive session, shared by all requests to this node until `close` is called.
+
+        Without an open session, each request creates (and tears down) its own connection.
+        """
+        if self.is_open:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        logger.debug(
+            "Opened connection pool to {} with up to {} connections",
+            self._url,
+            self.max_connections,
+        )
+
+    @property
+    def is_open(self) -> bool:
+        """Whether a shared session is open for this node."""
+        return self._session is not None and not self._session.closed
+
+    async def close(self) -> None:
+        """Stop watching jobs and close the shared session, if one is open."""
+        await self.job_monitor.stop()
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+        logger.debug("Closed connection pool to {}", self._url)
+
+    @property
+    def pool_stats(self) -> dict[str, Any]:
+        """
+        Saturation of the connection pool to this node.
+
+        Requests beyond `max_connections` wait for a free connection, so `waiting` > 0 means
+        the pool is saturated.
+        """
+        return {
+            "url": self._url,
+            "pooled": self.is_open,
+            "max_connections": self.max_connections,
+            "in_flight": self._requests_in_flight,
+            "waiting": max(0, self._requests_in_flight - self.max_connections),
+            "max_in_flight": self._max_requests_in_flight,
+        }
+
+    @staticmethod
+    def merge_pool_stats(all_stats: Iterable[dict[str, Any]]) -> dict[str, Any]:
+        """
+        Combine the `pool_stats` of a node from several processes, each with its own pool.
+
+        The counts are summed, so `max_in_flight` is an upper bound on the combined maximum.
+        """
+        all_stats = list(all_stats)
+        if not all_stats:
+            return {}
+        counts = ("max_connections", "in_flight", "waiting", "max_in_flight")
+        return {
+            "url": all_stats[0]["url"],
+            "pooled": all(stats["pooled"] for stats in all_stats),
+            **{count: sum(stats[count] for stats in all_stats) for count in counts},
+            "processes": len(all_stats),
+        }
+
+    @asynccontextmanager
+    async def _request_session(self) -> AsyncIterator[aiohttp.ClientSession]:
+        """Yield the shared session if open, otherwise a session for a single request."""
+        self._requests_in_flight += 1
+        self._max_requests_in_flight = max(self._max_requests_in_flight, self._requests_in_flight)
+        try:
+            if self._session is not None and self.is_open:
+                yield self._session
+            else:
+                async with aiohttp.ClientSession() as session:
+                    yield session
+        finally:
+            self._requests_in_flight -= 1
+
     @property
     def aet(self) -> str:
         """Application entity title (AET) of this Orthanc instance"""
         return self._aet
 
+    def modality_semaphore(self, modality: str, limit: int) -> asyncio.Semaphore:
+        """
+        Semaphore limiting the concurrent queries from this node to a modality.
+
+        Shared by all messages, so that concurrent messages can't overwhelm the modality.
+        """
+        if modality not in self._modality_semaphores:
+            self._modality_semaphores[modality] = asyncio.Semaphore(limit)
+        return self._modality_semaphores[modality]
+
+    def record_operation(self, kind: str, duration: float, *, failed: bool) -> None:
+        """Record the outcome of a query or job against a remote modality."""
+        self.recent_operations.append(
+            OrthancOperation(kind=kind, duration=duration, failed=failed, finished_at=time())
+        )
+
     @property
     async def modalities(self) -> Any:
         """Accessible modalities from this Orthanc instance"""
@@ -68,28 +201,75 @@ class Orthanc:
         """Query local Orthanc instance for statistics on a study or series."""
         return await self._get(f"/{resource_type}/{resource_id}/statistics")
 
-    async def get_local_instances(self, resource_type: str, resource_id: str) -> Any:
-        """Get the instances of a study or series."""
-        return await self._get(
-            f"/{resource_type}/{resource_id}/instances?short=true",
-            timeout=self.dicom_timeout,  # this API call can sometimes take several minutes
+    async def get_local_sop_instance_uids(self, resource_type: str, resource_id: str) -> set[str]:
+        """
+        Get the SOPInstanceUIDs of all instances in a study or series, with a single query.
+
+        :param resource_type: "studies" or "series"
+        :param resource_id: Orthanc ID of the study or series
+        """
+        parent = {"studies": "ParentStudy", "series": "ParentSeries"}[resource_type]
+        instances = await self._post(
+            "/tools/find",
+            data={
+                "Level": "Instance",
+                "Query": {},
+                parent: resource_id,
+                "Expand": True,
+                "RequestedTags": ["SOPInstanceUID"],
+            },
+            timeout=self.dicom_timeout,
         )
+        return {instance["RequestedTags"]["SOPInstanceUID"] for instance in instances}
 
     async def query_remote(self, data: dict, modality: str) -> str | None:
-        """Query a particular modality, available from this node"""
-        logger.debug("Running query on modality: {} with {}", modality, data)
+        """
+        Query a particular modality, available from this node.
 
-        response = await self._post(
-            f"/modalities/{modality}/query",
-            data=data,
-        )
+        Results are cached, so repeated queries for the same study don't go to the modality
+        while the local query still exists in Orthanc.
+        """
+        cached = self.query_cache.get(modality, data)
+        if cached is not None:
+            if await self._cached_query_exists(cached):
+                logger.debug("Using cached query {} on modality: {}", cached.query_id, modality)
+                return cached.query_id
+            self.query_cache.invalidate(modality, data)
+
+        logger.debug("Running query on modality: {} with {}", modality, data)
+        started_at = time()
+        try:
+            response = await self._post(
+                f"/modalities/{modality}/query",
+                data=data,
+            )
+        except (aiohttp.ClientError, TimeoutError):
+            self.record_operation("c-find", time() - started_at, failed=True)
+            raise
+        self.record_operation("c-find", time() - started_at, failed=False)
         logger.debug("Query response: {}", response)
-        query_answers = await self.get_remote_query_answers(response["ID"])
+        query_id = str(response["ID"])
+        query_answers = await self.get_remote_query_answers(query_id)
         if len(query_answers) > 0:
-            return str(response["ID"])
+            self.query_cache.put(modality, data, query_id=query_id, answers=query_answers)
+            return query_id
 
+        self.query_cache.put(modality, data, query_id=None, answers=[])
         return None
 
+    async def _cached_query_exists(self, cached: CachedQuery) -> bool:
+        """Check that Orthanc, which keeps a limited number of queries, still has a cached query."""
+        if cached.query_id is None:
+            return True
+        try:
+            await self.get_remote_query_answers(cached.query_id)
+        except aiohttp.ClientResponseError as err:
+            if err.status != HTTPStatus.NOT_FOUND:
+                raise
+            logger.debug("Cached query {} no longer exists in {}", cached.query_id, self.aet)
+            return False
+        return True
+
     async def get_remote_query_answers(self, query_id: str) -> Any:
         """Get the answers to a query"""
         return await self._get(f"/queries/{query_id}/answers")
@@ -130,13 +310,21 @@ class Orthanc:
         self, modality: str, missing_instances: list[dict[str, str]]
     ) -> str:
         """Retieve missing instances from remote modality in a single c-move query."""
+        return await self.retrieve_resources_from_remote(
+            modality, level="Instance", resources=missing_instances
+        )
+
+    async def retrieve_resources_from_remote(
+        self, modality: str, level: str, resources: list[dict[str, str]]
+    ) -> str:
+        """Retrieve resources, identified by their UIDs, from remote modality in a single c-move."""
         response = await self._post(
             f"/modalities/{modality}/move",
             data={
-                "Level": "Instance",
+                "Level": level,
                 "TargetAet": self.aet,
                 "Synchronous": False,
-                "Resources": missing_instances,
+                "Resources": resources,
             },
         )
         return str(response["ID"])
@@ -147,26 +335,7 @@ class Orthanc:
 
     async def wait_for_job_success_or_raise(self, job_id: str, job_type: str, timeout: int) -> None:
         """Wait for job to complete successfully, or raise exception if fails or exceeds timeout."""
-        job_info = {"State": "Pending"}
-        start_time = time()
-
-        while job_info["State"] != "Success":
-            if job_info["State"] == "Failure":
-                msg = (
-                    "Job failed: "
-                    f"Error code={job_info['ErrorCode']} Cause={job_info['ErrorDescription']}"
-                )
-                raise PixlDiscardError(msg)
-            if job_type == "modify":
-                logger.debug("Modify job: {}", job_info)
-            if (time() - start_time) > timeout:
-                msg = f"Failed to finish {job_type} job {job_id} in {timeout} seconds"
-                await sleep(10)
-                raise PixlDiscardError(msg)
-            await sleep(10)
-            if job_info["State"] == "Pending":
-                start_time = time()
-            job_info = await self.job_state(job_id=job_id)
+        await self.job_monitor.wait_for_job(job_id, job_type=job_type, timeout=timeout)
 
     async def job_state(self, job_id: str) -> Any:
         """Get job state from orthanc."""
@@ -174,37 +343,33 @@ class Orthanc:
         return await self._get(f"/jobs/{job_id}")
 
     async def _get(self, path: str, timeout: int | None = None) -> Any:
-        # Optionally override default http timeout
-        http_timeout = timeout or self.http_timeout
-        async with (
-            aiohttp.ClientSession() as session,
-            session.get(
-                f"{self._url}{path}",
-                auth=self._auth,
-                timeout=http_timeout,
-            ) as response,
-        ):
-            return await _deserialise(response)
+        return await self._request("GET", path, timeout=timeout)
 
     async def _post(self, path: str, data: dict, timeout: int | None = None) -> Any:
-        # Optionally override default http timeout
-        http_timeout = timeout or self.http_timeout
-        async with (
-            aiohttp.ClientSession() as session,
-            session.post(
-                f"{self._url}{path}", json=data, auth=self._auth, timeout=http_timeout
-            ) as response,
-        ):
-            return await _deserialise(response)
+        return await self._request("POST", path, data=data, timeout=timeout)
 
     async def delete(self, path: str) -> None:
-        async with (
-            aiohttp.ClientSession() as session,
-            session.delete(
-                f"{self._url}{path}", auth=self._auth, timeout=self.http_timeout
-            ) as response,
-        ):
-            await _deserialise(response)
+        await self._request("DELETE", path)
+
+    async def _request(
+        self, method: str, path: str, data: dict | None = None, timeout: int | None = None
+    ) -> Any:
+        """Make a request to the Orthanc REST API, recording its duration and status."""
+        # Optionally override default http timeout
+        http_timeout = timeout or self.http_timeout
+        status = "error"
+        started_at = time()
+        try:
+            async with (
+                self._request_session() as session,
+                session.request(
+                    method, f"{self._url}{path}", json=data, auth=self._auth, timeout=http_timeout
+                ) as response,
+            ):
+                status = str(response.status)
+                return await _deserialise(response)
+        finally:
+            orthanc_metrics.record_request(self.aet, method, path, status, time() - started_at)
 
 
 async def _deserialise(response: aiohttp.ClientResponse) -> Any:
@@ -224,32 +389,36 @@ class PIXLRawOrthanc(Orthanc):
             http_timeout=config("PIXL_QUERY_TIMEOUT", default=10, cast=int),
             dicom_timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=240, cast=int),
             aet=config("ORTHANC_RAW_AE_TITLE"),
+            max_connections=config("ORTHANC_RAW_MAX_CONNECTIONS", default=100, cast=int),
+            keepalive_timeout=config("PIXL_HTTP_KEEPALIVE_TIMEOUT", default=15, cast=float),
         )
 
         self.autoroute_to_anon = config("ORTHANC_AUTOROUTE_RAW_TO_ANON", default=False, cast=bool)
+        self.pending_jobs_gate = PendingJobsGate(
+            self,
+            max_pending_jobs=config("ORTHANC_RAW_MAX_PENDING_JOBS", default=0, cast=int),
+            refresh_interval=config("ORTHANC_RAW_JOBS_REFRESH_INTERVAL", default=5, cast=float),
+        )
+        self.retrieve_batcher = RetrieveBatcher(
+            self,
+            batch_size=config("PIXL_RETRIEVE_BATCH_SIZE", default=1, cast=int),
+            window=config("PIXL_RETRIEVE_BATCH_WINDOW", default=2, cast=float),
+        )
 
     async def raise_if_pending_jobs(self) -> None:
         """
-        Raise PixlRequeueMessageError if there are pending jobs on the server.
+        Raise PixlRequeueMessageError if there are too many pending jobs on the server.
 
         Otherwise orthanc starts to get buggy when there are a whole load of pending jobs.
         PixlRequeueMessageError will cause the rabbitmq message to be requeued
         """
-        jobs = await self.get_jobs()
-        unfinished_jobs = [x for x in jobs if x["State"] not in ("Success", "Failure")]
-        for job in unfinished_jobs:
-            logger.trace(
-                "{}, {}, {}, {}, {}",
-                job["State"],
-                job.get("CreationTime"),
-                job.get("ID"),
-                job.get("Type"),
-                job.get("EffectiveRuntime"),
-            )
-        for job in jobs:
-            if job["State"] == "Pending":
-                msg = "Pending messages in orthanc raw"
-                raise PixlRequeueMessageError(msg)
+        await self.pending_jobs_gate.admit_or_raise()
+
+    async def close(self) -> None:
+        """Stop batching retrievals and watching pending jobs, and close the shared session."""
+        await self.retrieve_batcher.stop()
+        await self.pending_jobs_gate.stop()
+        await super().close()
 
     async def send_study_to_anon(self, resource_id: str) -> Any:
         """Send study to orthanc anon."""
@@ -276,6 +445,8 @@ class PIXLAnonOrthanc(Orthanc):
             http_timeout=config("PIXL_QUERY_TIMEOUT", default=10, cast=int),
             dicom_timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=240, cast=int),
             aet=config("ORTHANC_ANON_AE_TITLE"),
+            max_connections=config("ORTHANC_ANON_MAX_CONNECTIONS", default=100, cast=int),
+            keepalive_timeout=config("PIXL_HTTP_KEEPALIVE_TIMEOUT", default=15, cast=float),
         )
 
         self.autoroute_to_endpoint = config(
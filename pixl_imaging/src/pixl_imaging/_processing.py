@@ -13,33 +13,56 @@
 #  limitations under the License.
 from __future__ import annotations
 
-import datetime
+import asyncio
+import inspect
 from dataclasses import dataclass
 from enum import StrEnum
 from typing import TYPE_CHECKING, Any
-from zoneinfo import ZoneInfo
 
 from core.exceptions import PixlDiscardError, PixlOutOfHoursError, PixlStudyNotInPrimaryArchiveError
 from decouple import config
 
 from pixl_imaging._orthanc import Orthanc, PIXLAnonOrthanc, PIXLRawOrthanc
+from pixl_imaging._schedule import ConsumptionSchedule
 
 if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterable
+
     from core.patient_queue.message import Message
 
 from loguru import logger
 
+# By default, the secondary archive is only queried out of working hours on weekdays
+secondary_schedule = ConsumptionSchedule.parse(
+    config("PIXL_SECONDARY_SCHEDULE", default="Mon-Fri 00:00-08:00, Mon-Fri 20:00-24:00"),
+    timezone=config("PIXL_SECONDARY_SCHEDULE_TIMEZONE", default=config("TZ")),
+)
+
 
 class DicomModality(StrEnum):
     primary = config("PRIMARY_DICOM_SOURCE_MODALITY")
     secondary = config("SECONDARY_DICOM_SOURCE_MODALITY")
 
+    @property
+    def max_concurrent_queries(self) -> int:
+        """Maximum number of concurrent queries to send to this archive."""
+        env_var = f"{self.name.upper()}_DICOM_SOURCE_MAX_CONCURRENT_QUERIES"
+        return int(config(env_var, default=4))
+
 
-async def process_message(message: Message, archive: DicomModality) -> None:
+async def process_message(
+    message: Message,
+    archive: DicomModality,
+    orthanc_raw: PIXLRawOrthanc | None = None,
+    orthanc_anon: PIXLAnonOrthanc | None = None,
+) -> None:
     """
     Process message from queue by retrieving a study with the given Patient and Accession Number.
     We may receive multiple messages with same Patient + Acc Num, either as retries or because
     they are needed for multiple projects.
+
+    The Orthanc nodes are shared between messages by the imaging-api so that their connection
+    pools are reused, if they're not given then new connections are made for this message.
     """
     with logger.contextualize(
         project_name=message.project_name,
@@ -51,8 +74,8 @@ async def process_message(message: Message, archive: DicomModality) -> None:
         logger.trace("Processing: {}. Querying {} archive.", message.identifier, archive.name)
 
         study = ImagingStudy.from_message(message)
-        orthanc_raw = PIXLRawOrthanc()
-        orthanc_anon = PIXLAnonOrthanc()
+        orthanc_raw = orthanc_raw or PIXLRawOrthanc()
+        orthanc_anon = orthanc_anon or PIXLAnonOrthanc()
         await _process_message(
             study=study,
             orthanc_raw=orthanc_raw,
@@ -71,7 +94,7 @@ async def _process_message(
     Retrieve a study from the archives and send it to Orthanc Anon.
 
     Querying the archives:
-    If 'archive' is 'secondary' and it's during working hours:
+    If 'archive' is 'secondary' and it's outside of PIXL_SECONDARY_SCHEDULE:
         - raise a PixlOutOfHoursError to have the message requeued
     If the study doesn't exist and 'archive' is primary:
         - publish the message to the secondary imaging queue
@@ -79,6 +102,8 @@ async def _process_message(
     If the study doesn't exist and 'archive' is secondary:
         - raise a PixlDiscardError
 
+    Concurrent messages for the same study share a single query and retrieval.
+
     Querying Orthanc Raw:
     If the study already exists in Orthanc Raw:
         - query the archive to determine whether any instances are missing
@@ -94,12 +119,68 @@ async def _process_message(
     """
     await orthanc_raw.raise_if_pending_jobs()
 
-    if archive.name == "secondary" and (_is_daytime() or _is_weekend()):
-        msg = "Not querying secondary archive during the daytime or on the weekend."
+    # The secondary consumer is paused outside of the schedule, this catches messages in flight
+    if archive.name == "secondary" and not secondary_schedule.is_open():
+        msg = "Not querying secondary archive outside of its schedule."
         raise PixlOutOfHoursError(msg)
 
     logger.info("Processing: {}. Querying {} archive.", study.message.identifier, archive.name)
 
+    await _retrieve_once(
+        key=(archive.value, *study.identity),
+        retrieve=lambda: _find_and_retrieve_study(
+            orthanc_raw=orthanc_raw,
+            study=study,
+            archive=archive,
+        ),
+    )
+
+    # Always query as Study level so we always send study resources to Orthanc Anon
+    resources = await _get_study_resources(
+        orthanc_raw=orthanc_raw,
+        study=study,
+        query_level="Study",
+    )
+
+    if not orthanc_raw.autoroute_to_anon:
+        logger.debug("Auto-routing to Orthanc Anon is not enabled. Not sending study {}", resources)
+        return
+
+    await orthanc_anon.notify_anon_to_retrieve_study_resources(
+        orthanc_raw=orthanc_raw,
+        resource_ids=resources,
+        series_uid=study.message.series_uid,
+        project_name=study.message.project_name,
+    )
+
+
+async def _retrieve_once(key: tuple[str, ...], retrieve: Callable[[], Awaitable[None]]) -> None:
+    """
+    Retrieve a study, unless a retrieval for the same study is already in flight.
+
+    Messages for a study that is already being retrieved wait for that retrieval, and get the same
+    result, rather than sending their own queries and C-MOVEs to the archive.
+    """
+    retrieval = _retrievals_in_flight.get(key)
+    if retrieval is not None:
+        logger.debug("Waiting for retrieval of {} in flight", key)
+    else:
+        retrieval = asyncio.ensure_future(retrieve())
+        _retrievals_in_flight[key] = retrieval
+        retrieval.add_done_callback(lambda _: _retrievals_in_flight.pop(key, None))
+    # Shielded so that cancelling one message doesn't cancel the retrieval for the others
+    await asyncio.shield(retrieval)
+
+
+_retrievals_in_flight: dict[tuple[str, ...], asyncio.Future[None]] = {}
+
+
+async def _find_and_retrieve_study(
+    orthanc_raw: PIXLRawOrthanc,
+    study: ImagingStudy,
+    archive: DicomModality,
+) -> None:
+    """Find a study in the archive, then retrieve it, or any instances missing from Orthanc Raw."""
     query_id = await _find_study_in_archive_or_raise(
         orthanc_raw=orthanc_raw,
         study=study,
@@ -115,7 +196,9 @@ async def _process_message(
     if not existing_local_resources:
         await _retrieve_study(
             orthanc_raw=orthanc_raw,
+            study=study,
             query_id=query_id,
+            archive=archive,
         )
     else:
         await _retrieve_missing_instances(
@@ -123,27 +206,9 @@ async def _process_message(
             orthanc_raw=orthanc_raw,
             study=study,
             query_id=query_id,
-            modality=archive.value,
+            archive=archive,
         )
 
-    # Always query as Study level so we always send study resources to Orthanc Anon
-    resources = await _get_study_resources(
-        orthanc_raw=orthanc_raw,
-        study=study,
-        query_level="Study",
-    )
-
-    if not orthanc_raw.autoroute_to_anon:
-        logger.debug("Auto-routing to Orthanc Anon is not enabled. Not sending study {}", resources)
-        return
-
-    await orthanc_anon.notify_anon_to_retrieve_study_resources(
-        orthanc_raw=orthanc_raw,
-        resource_ids=resources,
-        series_uid=study.message.series_uid,
-        project_name=study.message.project_name,
-    )
-
 
 async def _get_study_resources(
     orthanc_raw: PIXLRawOrthanc,
@@ -174,7 +239,7 @@ async def _find_study_in_archive_or_raise(
     """
     Query an archive for a study.
 
-    If 'archive' is 'secondary' and it's during working hours:
+    If 'archive' is 'secondary' and it's outside of PIXL_SECONDARY_SCHEDULE:
         - raise a PixlOutOfHoursError to have the message requeued
     If the study doesn't exist, and 'archive' is primary:
         - raise a PixlStudyNotInPrimaryArchiveError if a secondary archive is defined
@@ -243,36 +308,70 @@ async def _find_study_in_archive(
     )
 
 
-def _is_daytime() -> bool:
-    """Check if the current time is between 8 am and 8 pm."""
-    timezone = ZoneInfo(config("TZ"))
-    after_8am = datetime.time(8, 00) <= datetime.datetime.now(tz=timezone).time()
-    before_8pm = datetime.datetime.now(tz=timezone).time() <= datetime.time(20, 00)
-    return after_8am and before_8pm
-
-
-def _is_weekend() -> bool:
-    """Check if it's the weekend."""
-    timezone = ZoneInfo(config("TZ"))
-    saturday = 5
-    sunday = 6
-    return datetime.datetime.now(tz=timezone).weekday() in (saturday, sunday)
+async def _retrieve_study(
+    orthanc_raw: PIXLRawOrthanc,
+    study: ImagingStudy,
+    query_id: str,
+    archive: DicomModality,
+) -> None:
+    """
+    Retrieve instances for a study from the VNA / PACS.
 
+    If PIXL_RETRIEVE_BATCH_SIZE is more than 1, the study is retrieved in a batch with other
+    studies from the same archive. If the batched C-MOVE failed part way through, any instances
+    of the study that weren't moved are then retrieved on their own.
+    """
+    if orthanc_raw.retrieve_batcher.enabled:
+        resources = await _get_query_answer_resources(orthanc_raw, study, query_id)
+        if resources:
+            batch_succeeded = await orthanc_raw.retrieve_batcher.retrieve(
+                archive.value, level=study.query_level, resources=resources
+            )
+            if not batch_succeeded:
+                await _retrieve_missing_instances(
+                    resources=await _get_study_resources(
+                        orthanc_raw=orthanc_raw, study=study, query_level=study.query_level
+                    ),
+                    orthanc_raw=orthanc_raw,
+                    study=study,
+                    query_id=query_id,
+                    archive=archive,
+                )
+            return
 
-async def _retrieve_study(orthanc_raw: Orthanc, query_id: str) -> None:
-    """Retrieve instances for a study from the VNA / PACS."""
     job_id = await orthanc_raw.retrieve_study_from_remote(query_id=query_id)  # C-Move
     await orthanc_raw.wait_for_job_success_or_raise(
         job_id, "c-move", timeout=orthanc_raw.dicom_timeout
     )
 
 
+async def _get_query_answer_resources(
+    orthanc_raw: Orthanc, study: ImagingStudy, query_id: str
+) -> list[dict[str, str]]:
+    """
+    Get the UIDs of the studies, or series, answering a query, to retrieve them with a C-MOVE.
+
+    Returns an empty list if any answer doesn't have the UIDs needed.
+    """
+    query_tags = {"StudyInstanceUID": "0020,000d"}
+    if study.query_level == "Series":
+        query_tags["SeriesInstanceUID"] = "0020,000e"
+
+    resources = []
+    for answer_id in await orthanc_raw.get_remote_query_answers(query_id):
+        content = await orthanc_raw.get_remote_query_answer_content(query_id, answer_id)
+        if any(tag not in content for tag in query_tags.values()):
+            return []
+        resources.append({name: content[tag]["Value"] for name, tag in query_tags.items()})
+    return resources
+
+
 async def _retrieve_missing_instances(
     resources: list[str],
     orthanc_raw: Orthanc,
     study: ImagingStudy,
     query_id: str,
-    modality: str,
+    archive: DicomModality,
 ) -> None:
     """Retrieve missing instances for a study from the VNA / PACS."""
     missing_instance_uids = await _get_missing_instances(
@@ -280,6 +379,7 @@ async def _retrieve_missing_instances(
         study=study,
         resources=resources,
         query_id=query_id,
+        archive=archive,
     )
     if not missing_instance_uids:
         logger.debug("No missing instances for study {}", study.message.study_uid)
@@ -289,55 +389,43 @@ async def _retrieve_missing_instances(
         len(missing_instance_uids),
         study.message.identifier,
     )
-    job_id = await orthanc_raw.retrieve_instances_from_remote(modality, missing_instance_uids)
+    job_id = await orthanc_raw.retrieve_instances_from_remote(archive.value, missing_instance_uids)
     await orthanc_raw.wait_for_job_success_or_raise(
         job_id, "c-move for missing instances", timeout=orthanc_raw.dicom_timeout
     )
 
 
 async def _get_missing_instances(
-    orthanc_raw: Orthanc, study: ImagingStudy, resources: list[str], query_id: str
+    orthanc_raw: Orthanc,
+    study: ImagingStudy,
+    resources: list[str],
+    query_id: str,
+    archive: DicomModality,
 ) -> list[dict[str, str]]:
     """
     Check if any study instances are missing from Orthanc Raw.
 
+    Queries to the archive are sent concurrently, up to the archive's `max_concurrent_queries`
+    across all messages. The remote instances are cached with the study query, so they're only
+    queried once while the query is cached.
+
     Return a list of missing instance UIDs (empty if none missing)
     """
-    missing_instances: list[dict[str, str]] = []
-
-    # First query the VNA / PACS for the study instances
-    # We previously used the `query-instances` endpoint to get all instances in a Study (or Series),
-    # but the new VNA complains that the query has not SeriesInstanceUID. So now we get all series,
-    # iterate over each series, and get all instances in each series.
-    # If the query was made at the Series level, we can query the series instances directly.
-    if study.query_level == "Series":
-        series_query_answers = await orthanc_raw.get_remote_query_answers(query_id)
-        series_queries_and_answers = [(query_id, answer) for answer in series_query_answers]
+    semaphore = orthanc_raw.modality_semaphore(archive.value, archive.max_concurrent_queries)
+
+    # Messages for the same study (retries, or other projects) can reuse the remote instances
+    # found by an earlier message, rather than querying the VNA / PACS again
+    cached_query = orthanc_raw.query_cache.get_by_query_id(query_id)
+    instances_queries_and_answers: list[tuple[str, str]] | None = None
+    if cached_query is not None and cached_query.instance_count is not None:
+        num_remote_instances = cached_query.instance_count
     else:
-        series_queries_and_answers = []
-        study_query_answers = await orthanc_raw.get_remote_query_answers(query_id)
-        for study_answer_id in study_query_answers:
-            series_query_id = await orthanc_raw.get_remote_query_answer_series(
-                query_id=query_id,
-                answer_id=study_answer_id,
-            )
-            series_query_answers = await orthanc_raw.get_remote_query_answers(series_query_id)
-            series_queries_and_answers.extend(
-                [(series_query_id, answer) for answer in series_query_answers]
-            )
-
-    # For each series, get the instances
-    instances_queries_and_answers = []
-    for series_query_id, series_answer_id in series_queries_and_answers:
-        instances_query_id = await orthanc_raw.get_remote_query_answer_instances(
-            query_id=series_query_id, answer_id=series_answer_id
+        instances_queries_and_answers = await _query_remote_instances(
+            orthanc_raw=orthanc_raw, study=study, query_id=query_id, semaphore=semaphore
         )
-        instances_query_answers = await orthanc_raw.get_remote_query_answers(instances_query_id)
-        instances_queries_and_answers.extend(
-            [(instances_query_id, answer) for answer in instances_query_answers]
-        )
-
-    num_remote_instances = len(instances_queries_and_answers)
+        num_remote_instances = len(instances_queries_and_answers)
+        if cached_query is not None:
+            cached_query.instance_count = num_remote_instances
 
     # Get number of instances in Orthanc Raw
     num_local_instances = 0
@@ -349,30 +437,32 @@ async def _get_missing_instances(
         num_local_instances += int(statistics["CountInstances"])
 
     if (study.query_level == "Study") and (num_remote_instances == num_local_instances):
-        return missing_instances
+        return []
 
     # Get all SOPInstanceUIDs for the study that are in Orthanc Raw
-    orthanc_raw_sop_instance_uids = []
+    orthanc_raw_sop_instance_uids: set[str] = set()
     for resource in resources:
-        resource_instances = await orthanc_raw.get_local_instances(
+        orthanc_raw_sop_instance_uids |= await orthanc_raw.get_local_sop_instance_uids(
             resource_id=resource, resource_type=resource_type
         )
-        orthanc_raw_sop_instance_uids.extend(
-            [instance["MainDicomTags"]["0008,0018"] for instance in resource_instances]
+
+    if cached_query is not None and cached_query.instances is not None:
+        remote_instances = cached_query.instances
+    else:
+        if instances_queries_and_answers is None:
+            instances_queries_and_answers = await _query_remote_instances(
+                orthanc_raw=orthanc_raw, study=study, query_id=query_id, semaphore=semaphore
+            )
+        remote_instances = await _get_remote_instance_uids(
+            orthanc_raw, instances_queries_and_answers, semaphore
         )
+        if cached_query is not None:
+            cached_query.instances = remote_instances
 
     # If the SOPInstanceUID is not in the list of instances in Orthanc Raw
     # retrieve the instance from the VNA / PACS
-    query_tags = ["0020,000d", "0020,000e", "0008,0018"]
-    for instances_query_id, instance_query_answer in instances_queries_and_answers:
-        instance_query_answer_content = await orthanc_raw.get_remote_query_answer_content(
-            query_id=instances_query_id,
-            answer_id=instance_query_answer,
-        )
-        uids_for_query = {
-            instance_query_answer_content[x]["Name"]: instance_query_answer_content[x]["Value"]
-            for x in query_tags
-        }
+    missing_instances: list[dict[str, str]] = []
+    for uids_for_query in remote_instances:
         sop_instance_uid = uids_for_query["SOPInstanceUID"]
         if sop_instance_uid in orthanc_raw_sop_instance_uids:
             continue
@@ -387,6 +477,125 @@ async def _get_missing_instances(
     return missing_instances
 
 
+async def _query_remote_instances(
+    orthanc_raw: Orthanc,
+    study: ImagingStudy,
+    query_id: str,
+    semaphore: asyncio.Semaphore,
+) -> list[tuple[str, str]]:
+    """Query the VNA / PACS for the instances of a study, returning the instance answers."""
+    # We previously used the `query-instances` endpoint to get all instances in a Study (or Series),
+    # but the new VNA complains that the query has not SeriesInstanceUID. So now we get all series,
+    # iterate over each series, and get all instances in each series.
+    # If the query was made at the Series level, we can query the series instances directly.
+    if study.query_level == "Series":
+        series_query_answers = await orthanc_raw.get_remote_query_answers(query_id)
+        series_queries_and_answers = [(query_id, answer) for answer in series_query_answers]
+    else:
+        study_query_answers = await orthanc_raw.get_remote_query_answers(query_id)
+        series_queries_and_answers = _flatten(
+            await _gather_bounded(
+                semaphore,
+                (
+                    _query_answer_series(orthanc_raw, query_id, study_answer_id)
+                    for study_answer_id in study_query_answers
+                ),
+            )
+        )
+
+    # For each series, get the instances
+    return _flatten(
+        await _gather_bounded(
+            semaphore,
+            (
+                _query_answer_instances(orthanc_raw, series_query_id, series_answer_id)
+                for series_query_id, series_answer_id in series_queries_and_answers
+            ),
+        )
+    )
+
+
+async def _get_remote_instance_uids(
+    orthanc_raw: Orthanc,
+    instances_queries_and_answers: list[tuple[str, str]],
+    semaphore: asyncio.Semaphore,
+) -> list[dict[str, str]]:
+    """Get the study, series and SOP instance UIDs of each instance answer."""
+    query_tags = ["0020,000d", "0020,000e", "0008,0018"]
+    instance_query_answer_contents = await _gather_bounded(
+        semaphore,
+        (
+            orthanc_raw.get_remote_query_answer_content(
+                query_id=instances_query_id,
+                answer_id=instance_query_answer,
+            )
+            for instances_query_id, instance_query_answer in instances_queries_and_answers
+        ),
+    )
+    return [
+        {content[x]["Name"]: content[x]["Value"] for x in query_tags}
+        for content in instance_query_answer_contents
+    ]
+
+
+async def _query_answer_series(
+    orthanc_raw: Orthanc, query_id: str, answer_id: str
+) -> list[tuple[str, str]]:
+    """Query the archive for the series of a study answer, returning the series answers."""
+    series_query_id = await orthanc_raw.get_remote_query_answer_series(
+        query_id=query_id,
+        answer_id=answer_id,
+    )
+    series_query_answers = await orthanc_raw.get_remote_query_answers(series_query_id)
+    return [(series_query_id, answer) for answer in series_query_answers]
+
+
+async def _query_answer_instances(
+    orthanc_raw: Orthanc, query_id: str, answer_id: str
+) -> list[tuple[str, str]]:
+    """Query the archive for the instances of a series answer, returning the instance answers."""
+    instances_query_id = await orthanc_raw.get_remote_query_answer_instances(
+        query_id=query_id,
+        answer_id=answer_id,
+    )
+    instances_query_answers = await orthanc_raw.get_remote_query_answers(instances_query_id)
+    return [(instances_query_id, answer) for answer in instances_query_answers]
+
+
+async def _gather_bounded[T](
+    semaphore: asyncio.Semaphore, awaitables: Iterable[Awaitable[T]]
+) -> list[T]:
+    """
+    Await all awaitables concurrently, with at most the semaphore's limit running at once.
+
+    If one of them fails, the rest are cancelled so they don't keep querying the archive, and the
+    exception is raised.
+    """
+
+    async def _bounded(awaitable: Awaitable[T]) -> T:
+        async with semaphore:
+            return await awaitable
+
+    awaitables = list(awaitables)
+    tasks = [asyncio.ensure_future(_bounded(awaitable)) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Close the coroutines that never got the semaphore, so they aren't reported as unawaited
+        for awaitable in awaitables:
+            if inspect.iscoroutine(awaitable) and (
+                inspect.getcoroutinestate(awaitable) == inspect.CORO_CREATED
+            ):
+                awaitable.close()
+        raise
+
+
+def _flatten[T](nested: Iterable[list[T]]) -> list[T]:
+    return [item for items in nested for item in items]
+
+
 @dataclass
 class ImagingStudy:
     """Dataclass for DICOM study unique to a patient and imaging study"""
@@ -398,6 +607,16 @@ class ImagingStudy:
         """Build an imaging study from a queue message."""
         return ImagingStudy(message=message)
 
+    @property
+    def identity(self) -> tuple[str, str, str, str]:
+        """Identifiers of the study (and series) requested by the message, ignoring the project."""
+        return (
+            self.message.mrn,
+            self.message.accession_number,
+            self.message.study_uid,
+            self.message.series_uid,
+        )
+
     @property
     def query_level(self) -> str:
         return "Series" if self.message.series_uid else "Study"
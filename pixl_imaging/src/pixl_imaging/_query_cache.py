@@ -0,0 +1,145 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Cache the results of queries to remote archives."""
+
+from __future__ import annotations
+
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import time
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+@dataclass
+class CachedQuery:
+    """
+    Result of querying a remote archive.
+
+    `query_id` is the ID of the query in the local Orthanc, or None if nothing was found.
+    The remote instances are filled in once they're known, so that checking for missing
+    instances can skip querying the archive again.
+    """
+
+    query_id: str | None
+    expires_at: float
+    answers: list[str] = field(default_factory=list)
+    instance_count: int | None = None
+    instances: list[dict[str, str]] | None = None
+
+    @property
+    def expired(self) -> bool:
+        return time() > self.expires_at
+
+
+class QueryCache:
+    """
+    Least recently used cache of remote archive queries, whose entries expire after `ttl` seconds.
+
+    Queries are keyed by the modality and query (level, and UIDs or MRN and accession number), so
+    messages for the same study, e.g. retries or from multiple projects, share the results.
+    A `ttl` of 0 disables the cache.
+
+    Queries that found nothing expire after `negative_ttl` seconds instead, as the study may
+    arrive in the archive shortly, and aren't cached at all if it's 0.
+    """
+
+    def __init__(self, ttl: float, max_size: int, negative_ttl: float = 0) -> None:
+        self.ttl = ttl
+        self.negative_ttl = min(negative_ttl, ttl)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], CachedQuery] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Size of the cache and number of hits and misses."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "negative_ttl": self.negative_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def merge_stats(all_stats: Iterable[dict[str, Any]]) -> dict[str, Any]:
+        """Combine the `stats` of the caches of several processes, each with its own cache."""
+        all_stats = list(all_stats)
+        if not all_stats:
+            return {}
+        counts = ("size", "max_size", "hits", "misses")
+        return {
+            **all_stats[0],
+            **{count: sum(stats[count] for stats in all_stats) for count in counts},
+            "processes": len(all_stats),
+        }
+
+    def get(self, modality: str, query: dict) -> CachedQuery | None:
+        """Get the cached result of a query, if it hasn't expired."""
+        if not self.enabled:
+            return None
+
+        key = _key(modality, query)
+        entry = self._entries.get(key)
+        if entry is None or entry.expired:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(
+        self, modality: str, query: dict, query_id: str | None, answers: list[str]
+    ) -> CachedQuery:
+        """Cache the result of a query, evicting the least recently used entry if full."""
+        ttl = self.ttl if answers else self.negative_ttl
+        entry = CachedQuery(query_id=query_id, expires_at=time() + ttl, answers=answers)
+        if not self.enabled or ttl <= 0:
+            return entry
+
+        key = _key(modality, query)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, modality: str, query: dict) -> None:
+        """Remove a cached query that turned out to be stale, counting its lookup as a miss."""
+        if self._entries.pop(_key(modality, query), None) is not None:
+            self.hits -= 1
+            self.misses += 1
+
+    def get_by_query_id(self, query_id: str) -> CachedQuery | None:
+        """Get the cached result for a local query ID, without counting as a hit or miss."""
+        for entry in reversed(self._entries.values()):
+            if entry.query_id == query_id and not entry.expired:
+                return entry
+        return None
+
+
+def _key(modality: str, query: dict) -> tuple[str, str]:
+    return modality, json.dumps(query, sort_keys=True)
@@ -0,0 +1,153 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Adjust the extraction rate according to how the archives are coping."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime
+from statistics import mean
+from time import time
+from typing import TYPE_CHECKING
+
+from core.token_buffer.models import RateControllerStatus, RateDecision
+from loguru import logger
+
+if TYPE_CHECKING:
+    from core.token_buffer import TokenBucket
+
+    from pixl_imaging._jobs import OrthancOperation
+    from pixl_imaging._orthanc import PIXLRawOrthanc
+
+
+class RateController:
+    """
+    Adjust the rate of a token bucket with additive increase, multiplicative decrease (AIMD).
+
+    Every `interval` seconds, the queries and jobs that Orthanc Raw has run against the archives
+    since the last adjustment are checked. The archives are taken to be struggling if any failed,
+    if the mean duration of C-FINDs or of single study C-MOVEs exceeds its target, or if Orthanc
+    Raw has more pending jobs than it admits messages for. Then the rate is multiplied by
+    `decrease`, otherwise it is increased by `increase`, keeping within `min_rate` and `max_rate`.
+
+    The rate is left alone while it's 0, so that an operator can still pause extraction, and when
+    nothing has been sent to the archives since the last adjustment.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        token_bucket: TokenBucket,
+        orthanc_raw: PIXLRawOrthanc,
+        min_rate: float,
+        max_rate: float,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        interval: float = 30,
+        query_latency: float = 10,
+        move_latency: float = 120,
+        max_decisions: int = 20,
+    ) -> None:
+        self.token_bucket = token_bucket
+        self._orthanc_raw = orthanc_raw
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.query_latency = query_latency
+        self.move_latency = move_latency
+        self.max_decisions = max_decisions
+
+        self.status = RateControllerStatus(min_rate=min_rate, max_rate=max_rate)
+        self._last_adjusted_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start adjusting the rate in the background."""
+        if self._task is None or self._task.done():
+            self._last_adjusted_at = time()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop adjusting the rate."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def adjust(self) -> RateDecision | None:
+        """Adjust the rate from the operations since the last adjustment, returning the decision."""
+        since = self._last_adjusted_at
+        self._last_adjusted_at = time()
+        # Copied first, as operations may be recorded while adjusting from another thread
+        operations = [
+            operation
+            for operation in list(self._orthanc_raw.recent_operations)
+            if operation.finished_at > since
+        ]
+
+        rate = self.token_bucket.rate
+        if rate == 0 or not operations:
+            return None
+
+        reason = self._congestion(operations)
+        # A rate set by an operator outside of the bounds is only moved towards them
+        if reason is not None:
+            new_rate = max(min(self.status.min_rate, rate), rate * self.decrease)
+        else:
+            new_rate = min(max(self.status.max_rate, rate), rate + self.increase)
+            reason = f"{len(operations)} archive operations within targets"
+        if new_rate == rate:
+            return None
+
+        self.token_bucket.rate = float(new_rate)
+        decision = RateDecision(
+            time=datetime.datetime.now(tz=datetime.UTC),
+            old_rate=rate,
+            new_rate=new_rate,
+            reason=reason,
+        )
+        self.status.decisions = [*self.status.decisions, decision][-self.max_decisions :]
+        logger.info("Changed extraction rate from {} to {}: {}", rate, new_rate, reason)
+        return decision
+
+    def _congestion(self, operations: list[OrthancOperation]) -> str | None:
+        """Reason that the archives look to be struggling, or None if they're coping."""
+        failures = sum(operation.failed for operation in operations)
+        if failures:
+            return f"{failures} of {len(operations)} archive operations failed"
+
+        for kind, target in (("c-find", self.query_latency), ("c-move", self.move_latency)):
+            # Batched C-MOVEs take longer the more studies they move, so aren't held to the target
+            durations = [operation.duration for operation in operations if operation.kind == kind]
+            if durations and mean(durations) > target:
+                return f"mean {kind} took {mean(durations):.1f}s, target is {target}s"
+
+        gate = self._orthanc_raw.pending_jobs_gate
+        if gate.over_limit:
+            return f"{gate.pending_jobs} pending jobs in orthanc raw"
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self.token_bucket.is_shared:
+                    # The rate is read from and set in the database, so don't block the event loop
+                    await asyncio.to_thread(self.adjust)
+                else:
+                    self.adjust()
+            except Exception:  # noqa: BLE001
+                logger.exception("Failed to adjust the extraction rate")
@@ -0,0 +1,205 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Windows of time in which an archive can be queried, and consuming from its queue in them."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime
+import re
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from core.patient_queue.subscriber import PixlConsumer
+    from core.token_buffer import TokenBucket
+
+DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MINUTES_PER_DAY = 24 * 60
+
+_WINDOW_PATTERN = re.compile(
+    r"^(?P<first_day>\w{3})(-(?P<last_day>\w{3}))? "
+    r"(?P<start>\d{2}):(?P<start_minute>\d{2})-(?P<end>\d{2}):(?P<end_minute>\d{2})$"
+)
+
+
+@dataclass(frozen=True)
+class ScheduleWindow:
+    """Time of day in which consumption is allowed, on some days of the week."""
+
+    days: frozenset[int]
+    # Minutes since midnight, with end 1440 for the end of the day
+    start: int
+    end: int
+
+    @classmethod
+    def parse(cls, window: str) -> ScheduleWindow:
+        """
+        Parse a window such as "Mon-Fri 20:00-24:00" or "Sat 00:00-08:00".
+
+        :raises ValueError: if the window isn't in this format
+        """
+        match = _WINDOW_PATTERN.match(window.strip())
+        days = (None, *DAYS)
+        if match is None or match["first_day"] not in DAYS or match["last_day"] not in days:
+            msg = f"Schedule window must be like 'Mon-Fri 20:00-24:00', not '{window}'"
+            raise ValueError(msg)
+
+        first_day = DAYS.index(match["first_day"])
+        last_day = DAYS.index(match["last_day"] or match["first_day"])
+        start = int(match["start"]) * 60 + int(match["start_minute"])
+        end = int(match["end"]) * 60 + int(match["end_minute"])
+        if not 0 <= start < end <= MINUTES_PER_DAY:
+            msg = f"Schedule window must start before it ends, within a day, not '{window}'"
+            raise ValueError(msg)
+        return cls(days=frozenset(range(first_day, last_day + 1)), start=start, end=end)
+
+    def contains(self, moment: datetime.datetime) -> bool:
+        """Is the moment, in the timezone of the schedule, within this window?"""
+        minutes = moment.hour * 60 + moment.minute + moment.second / 60
+        return moment.weekday() in self.days and self.start <= minutes < self.end
+
+
+class ConsumptionSchedule:
+    """Windows of the week, in a timezone, in which a queue can be consumed from."""
+
+    def __init__(self, windows: list[ScheduleWindow], timezone: str) -> None:
+        self.windows = windows
+        self.timezone = ZoneInfo(timezone)
+
+    @classmethod
+    def parse(cls, windows: str, timezone: str) -> ConsumptionSchedule:
+        """Parse a comma separated list of windows, e.g. "Mon-Fri 00:00-08:00, Sat 10:00-12:00"."""
+        return cls([ScheduleWindow.parse(window) for window in windows.split(",")], timezone)
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(tz=self.timezone)
+
+    def is_open(self, moment: datetime.datetime | None = None) -> bool:
+        """Can the queue be consumed from now, or at the given moment?"""
+        moment = (moment or self.now()).astimezone(self.timezone)
+        return any(window.contains(moment) for window in self.windows)
+
+    def next_change(self, moment: datetime.datetime | None = None) -> datetime.datetime | None:
+        """
+        The next time after now, or the given moment, at which the schedule opens or closes.
+
+        None if it's always open or always closed.
+        """
+        moment = (moment or self.now()).astimezone(self.timezone)
+        is_open = self.is_open(moment)
+        boundaries = sorted(
+            datetime.datetime.combine(
+                moment.date() + datetime.timedelta(days=day), datetime.time(), self.timezone
+            )
+            + datetime.timedelta(minutes=minutes)
+            for day in range(8)
+            for window in self.windows
+            for minutes in (window.start, window.end)
+        )
+        for boundary in boundaries:
+            if boundary > moment and self.is_open(boundary) != is_open:
+                return boundary
+        return None
+
+
+class ConsumptionScheduler:
+    """
+    Consume from a queue only within the windows of a schedule.
+
+    When the schedule closes, the rate of the consumer's key is scaled to zero in this process and
+    the consumer stops consuming, so no messages are delivered until the schedule opens again.
+    Then the rate is ramped up to the key's rate over `ramp` seconds. The rate set for the key,
+    e.g. with `pixl update --key`, is left as it is throughout.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        schedule: ConsumptionSchedule,
+        token_bucket: TokenBucket,
+        consumer: PixlConsumer,
+        ramp: float = 300,
+        ramp_steps: int = 10,
+        max_sleep: float = 3600,
+    ) -> None:
+        self.schedule = schedule
+        self.token_bucket = token_bucket
+        self.consumer = consumer
+        self.ramp = ramp
+        self.ramp_steps = ramp_steps
+        self.max_sleep = max_sleep
+        self.is_open: bool | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def key(self) -> str:
+        """Token bucket key of the consumer."""
+        key: str = self.consumer.token_bucket_key
+        return key
+
+    def start(self) -> None:
+        """Start following the schedule in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop following the schedule."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def close(self) -> None:
+        """Stop consuming until the schedule opens."""
+        logger.info("Schedule for {} closed, pausing consumption", self.consumer.queue_name)
+        self.is_open = False
+        self.token_bucket.set_key_rate_factor(self.key, 0)
+        self.consumer.pause()
+
+    async def open(self) -> None:
+        """Ramp the rate of consumption up to the rate of the consumer's key."""
+        logger.info("Schedule for {} opened, ramping up consumption", self.consumer.queue_name)
+        self.is_open = True
+        for step in range(1, self.ramp_steps):
+            self.token_bucket.set_key_rate_factor(self.key, step / self.ramp_steps)
+            await asyncio.sleep(self.ramp / self.ramp_steps)
+            if not self.schedule.is_open():
+                self.close()
+                return
+        self.token_bucket.set_key_rate_factor(self.key, None)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                is_open = self.schedule.is_open()
+                if is_open and self.is_open is not True:
+                    await self.open()
+                elif not is_open and self.is_open is not False:
+                    self.close()
+            except Exception:  # noqa: BLE001
+                logger.exception("Failed to follow schedule for {}", self.consumer.queue_name)
+            await asyncio.sleep(self._seconds_until_change())
+
+    def _seconds_until_change(self) -> float:
+        next_change = self.schedule.next_change()
+        if next_change is None:
+            return self.max_sleep
+        seconds = (next_change - self.schedule.now()).total_seconds()
+        return min(self.max_sleep, max(0.0, seconds))
@@ -0,0 +1,235 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Worker processes that each consume from the imaging queues, with their own event loop, RabbitMQ
+connection and Orthanc connection pools, so that processing messages can use more than one core.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import multiprocessing
+import queue
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+from core.patient_queue.stats import ConsumerStats, ConsumerStatus, TokenAvailability
+from core.telemetry import configure_logging
+from core.token_buffer import TokenBucket
+from core.token_buffer.storage import storage_from_config
+from decouple import config
+from loguru import logger
+
+from pixl_imaging._consumers import TOKEN_BUCKET_KEYS, rate_controller_from_config, run_consumers
+from pixl_imaging._metrics import LocalMetrics, orthanc_metrics
+from pixl_imaging._orthanc import Orthanc, PIXLAnonOrthanc, PIXLRawOrthanc
+from pixl_imaging._query_cache import QueryCache
+
+if TYPE_CHECKING:
+    from multiprocessing.context import SpawnProcess
+
+    from core.token_buffer.models import AppState, RateControllerStatus
+
+# Seconds between each worker reporting its statistics, and checking that the workers are alive
+REPORT_INTERVAL = 1
+
+
+@dataclass
+class WorkerReport:
+    """Statistics of a worker's consumers and Orthanc nodes, sent to the supervisor"""
+
+    index: int
+    stats: dict[str, ConsumerStats]
+    paused: dict[str, bool]
+    rate_controller: RateControllerStatus | None = None
+    connection_pools: dict[str, dict[str, Any]] = field(default_factory=dict)
+    query_cache: dict[str, Any] = field(default_factory=dict)
+    metrics: LocalMetrics = field(default_factory=LocalMetrics)
+
+
+def run_worker(index: int, reports: multiprocessing.Queue[WorkerReport]) -> None:
+    """Entry point of a worker process, consuming until it's terminated."""
+    configure_logging(level=config("LOG_LEVEL", default="INFO"))
+    logger.info("Starting imaging worker {}", index)
+    asyncio.run(_consume(index, reports))
+
+
+async def _consume(index: int, reports: multiprocessing.Queue[WorkerReport]) -> None:
+    orthanc_raw = PIXLRawOrthanc()
+    orthanc_anon = PIXLAnonOrthanc()
+    await orthanc_raw.open()
+    await orthanc_anon.open()
+    token_bucket = TokenBucket(rate=0, capacity=5, storage=storage_from_config())
+    # The rate is shared, so only one worker adjusts it, from the operations that it has seen
+    rate_controller = rate_controller_from_config(token_bucket, orthanc_raw) if index == 0 else None
+    if rate_controller is not None:
+        rate_controller.start()
+
+    async with run_consumers(token_bucket, orthanc_raw, orthanc_anon) as consumers:
+        while True:
+            reports.put(
+                WorkerReport(
+                    index=index,
+                    stats={name: consumer.stats for name, consumer in consumers.items()},
+                    paused={name: consumer.paused for name, consumer in consumers.items()},
+                    rate_controller=None if rate_controller is None else rate_controller.status,
+                    connection_pools={
+                        "orthanc-raw": orthanc_raw.pool_stats,
+                        "orthanc-anon": orthanc_anon.pool_stats,
+                    },
+                    query_cache=orthanc_raw.query_cache.stats,
+                    metrics=orthanc_metrics.local,
+                )
+            )
+            await asyncio.sleep(REPORT_INTERVAL)
+
+
+class WorkerConsumers:
+    """The consumers of a queue in all of the workers, reporting their combined status."""
+
+    def __init__(self, pool: WorkerPool, queue_name: str) -> None:
+        """
+        :param pool: Pool of the workers
+        :param queue_name: Name of the queue consumed from
+        """
+        self._pool = pool
+        self.queue_name = queue_name
+        self.token_bucket_key = TOKEN_BUCKET_KEYS[queue_name]
+
+    def status(self) -> ConsumerStatus:
+        """Statistics of the messages consumed so far by all workers, and the tokens for them."""
+        reports = self._pool.reports.values()
+        stats = ConsumerStats.merge(
+            self.queue_name,
+            (report.stats[self.queue_name] for report in reports),
+        )
+        token_bucket = self._pool.state.token_bucket
+        return stats.status(
+            TokenAvailability(
+                rate=token_bucket.rate_for(self.token_bucket_key),
+                seconds_until_token=token_bucket.seconds_until_token(self.token_bucket_key),
+                paused=all(report.paused[self.queue_name] for report in reports),
+            )
+        )
+
+
+class WorkerPool:
+    """
+    Supervisor of processes that each consume from the imaging queues.
+
+    Workers that exit are restarted. Each worker reports the statistics of its consumers, which are
+    combined by `consumers`, and the first worker runs the rate controller if it's enabled, whose
+    status is kept in the app state. The rate is shared through the token bucket's storage, so it
+    must be shared by all processes.
+    """
+
+    def __init__(self, workers: int, state: AppState) -> None:
+        """
+        :param workers: Number of worker processes
+        :param state: State of the supervisor's app, whose token bucket shares storage with the
+            workers
+        """
+        if not state.token_bucket.is_shared:
+            msg = "PIXL_TOKEN_BUCKET_STORAGE must be 'database' to run more than one worker"
+            raise ValueError(msg)
+        self.workers = workers
+        self.state = state
+        self.reports: dict[int, WorkerReport] = {}
+        self.consumers = {name: WorkerConsumers(self, name) for name in TOKEN_BUCKET_KEYS}
+
+        self._context = multiprocessing.get_context("spawn")
+        self._reports_queue: multiprocessing.Queue[WorkerReport] = self._context.Queue()
+        self._processes: dict[int, SpawnProcess] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start the workers, and supervise them in the background."""
+        for index in range(self.workers):
+            self._start_worker(index)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self) -> None:
+        """Stop supervising, and terminate the workers."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for process in self._processes.values():
+            process.terminate()
+        for process in self._processes.values():
+            await asyncio.to_thread(process.join)
+        self._processes.clear()
+
+    def connection_pools(self) -> dict[str, dict[str, Any]]:
+        """Saturation of the Orthanc connection pools, combined across the workers."""
+        reports = list(self.reports.values())
+        return {
+            node: Orthanc.merge_pool_stats(
+                report.connection_pools[node]
+                for report in reports
+                if node in report.connection_pools
+            )
+            for node in ("orthanc-raw", "orthanc-anon")
+        }
+
+    def query_cache(self) -> dict[str, Any]:
+        """Hits and misses of the workers' caches of archive queries, combined."""
+        return QueryCache.merge_stats(
+            report.query_cache for report in self.reports.values() if report.query_cache
+        )
+
+    def metrics(self) -> LocalMetrics:
+        """Durations of Orthanc requests and jobs, combined across the workers."""
+        return LocalMetrics.merge(report.metrics for report in self.reports.values())
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self._reports_queue),
+            name=f"imaging-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def collect_reports(self) -> None:
+        """Keep the latest report of each worker."""
+        while True:
+            try:
+                report = self._reports_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.reports[report.index] = report
+            if report.index == 0:
+                self.state.rate_controller = report.rate_controller
+
+    async def _supervise(self) -> None:
+        while True:
+            try:
+                self.collect_reports()
+                for index, process in self._processes.items():
+                    if not process.is_alive():
+                        logger.warning(
+                            "Imaging worker {} exited with code {}, restarting it",
+                            index,
+                            process.exitcode,
+                        )
+                        self.reports.pop(index, None)
+                        self._start_worker(index)
+            except Exception:  # noqa: BLE001
+                logger.exception("Failed to supervise imaging workers")
+            await asyncio.sleep(REPORT_INTERVAL)
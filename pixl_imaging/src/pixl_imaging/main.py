@@ -15,27 +15,92 @@
 
 from __future__ import annotations
 
-import asyncio
 import importlib.metadata
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any
 
-from core.patient_queue.subscriber import PixlConsumer
 from core.rest_api.router import router, state
 from core.telemetry import configure_logging
 from decouple import config
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from loguru import logger
 
-from ._processing import DicomModality, process_message
+from ._consumers import rate_controller_from_config, run_consumers
+from ._metrics import orthanc_metrics
+from ._orthanc import PIXLAnonOrthanc, PIXLRawOrthanc
+from ._workers import WorkerPool
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+# Number of processes consuming from the imaging queues, 1 to consume in the API's process
+WORKERS = config("PIXL_IMAGING_WORKERS", default=1, cast=int)
+
+# Orthanc nodes shared by all messages, so that their connection pools are reused
+orthanc_raw = PIXLRawOrthanc()
+orthanc_anon = PIXLAnonOrthanc()
+
+rate_controller = rate_controller_from_config(state.token_bucket, orthanc_raw)
+
+# Supervisor of the worker processes, while PIXL_IMAGING_WORKERS is greater than 1
+worker_pool: WorkerPool | None = None
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    """
+    Open the Orthanc connection pools and start consuming from the imaging queues.
+
+    If enabled, the extraction rate controller is also started. The secondary queue is only
+    consumed from within PIXL_SECONDARY_SCHEDULE.
+
+    With PIXL_IMAGING_WORKERS greater than 1, the queues are instead consumed from by that many
+    worker processes, whose statistics are combined.
+
+    On shutdown, the connection pools are closed.
+    """
+    if WORKERS > 1:
+        async with _run_workers():
+            yield
+        return
+
+    await orthanc_raw.open()
+    await orthanc_anon.open()
+    if rate_controller is not None:
+        state.rate_controller = rate_controller.status
+        rate_controller.start()
+
+    async with run_consumers(state.token_bucket, orthanc_raw, orthanc_anon) as consumers:
+        state.consumers.update(consumers)
+        yield
+
+    if rate_controller is not None:
+        await rate_controller.stop()
+    await orthanc_raw.close()
+    await orthanc_anon.close()
+
+
+@asynccontextmanager
+async def _run_workers() -> AsyncIterator[None]:
+    global worker_pool
+    logger.info("Consuming from the imaging queues with {} workers", WORKERS)
+    pool = worker_pool = WorkerPool(WORKERS, state)
+    state.consumers.update(pool.consumers)
+    pool.start()
+    try:
+        yield
+    finally:
+        await pool.stop()
+        worker_pool = None
 
-QUEUE_NAME = "imaging-primary"
-SECONDARY_QUEUE_NAME = "imaging-secondary"
 
 app = FastAPI(
     title="imaging-api",
     description="Imaging extraction service",
     version=importlib.metadata.version("pixl_imaging"),
     default_response_class=JSONResponse,
+    lifespan=lifespan,
 )
 app.include_router(router)
 
@@ -45,33 +110,26 @@ configure_logging(level=logging_level)
 logger.warning("Running logging at level {}", logging_level)
 
 
-@app.on_event("startup")
-async def startup_event() -> None:
-    """
-    Task create: the coroutine submitted to run "in the background",
-    i.e. concurrently with the current task and all other tasks,
-    switching between them at await points
-    the task is consumer.run and the callback is _processing.process_message
-    """
-    background_tasks = set()
-    async with (
-        PixlConsumer(
-            QUEUE_NAME,
-            token_bucket=state.token_bucket,
-            token_bucket_key="primary",  # noqa: S106
-            callback=lambda message: process_message(message, archive=DicomModality.primary),
-        ) as primary_consumer,
-        PixlConsumer(
-            SECONDARY_QUEUE_NAME,
-            token_bucket=state.token_bucket,
-            token_bucket_key="secondary",  # noqa: S106
-            callback=lambda message: process_message(message, archive=DicomModality.secondary),
-        ) as secondary_consumer,
-    ):
-        task = asyncio.create_task(primary_consumer.run())
-        background_tasks.add(task)
-        task.add_done_callback(background_tasks.discard)
-
-        task = asyncio.create_task(secondary_consumer.run())
-        background_tasks.add(task)
-        task.add_done_callback(background_tasks.discard)
+@app.get("/orthanc-connection-pools", summary="Saturation of the Orthanc connection pools")
+async def get_orthanc_connection_pools() -> dict[str, Any]:  # noqa: D103
+    if worker_pool is not None:
+        return worker_pool.connection_pools()
+    return {"orthanc-raw": orthanc_raw.pool_stats, "orthanc-anon": orthanc_anon.pool_stats}
+
+
+@app.get("/query-cache", summary="Hits and misses of the cache of archive queries")
+async def get_query_cache() -> dict[str, Any]:  # noqa: D103
+    if worker_pool is not None:
+        return worker_pool.query_cache()
+    return orthanc_raw.query_cache.stats
+
+
+@app.get(
+    "/metrics",
+    summary="Durations of Orthanc requests and jobs, in Prometheus text format",
+    response_class=PlainTextResponse,
+)
+async def get_metrics() -> str:  # noqa: D103
+    if worker_pool is not None:
+        return worker_pool.metrics().prometheus_text()
+    return orthanc_metrics.prometheus_text()
@@ -15,11 +15,13 @@
 
 from __future__ import annotations
 
+import asyncio
+import dataclasses
 import datetime
 import os
 import pathlib
 import shlex
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 import pytest
 from core.exceptions import PixlDiscardError, PixlOutOfHoursError, PixlStudyNotInPrimaryArchiveError
@@ -31,6 +33,7 @@ from pydicom.uid import generate_uid
 from pytest_check import check
 from pytest_pixl.helpers import run_subprocess
 
+from pixl_imaging import _processing
 from pixl_imaging._orthanc import Orthanc, PIXLRawOrthanc
 from pixl_imaging._processing import DicomModality, ImagingStudy, process_message
 
@@ -471,6 +474,38 @@ async def test_existing_message_sent_twice(orthanc_raw, message: Message) -> Non
         )
 
 
+@pytest.mark.processing
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("_add_image_to_fake_vna")
+async def test_concurrent_messages_share_retrieval(
+    orthanc_raw, message: Message, monkeypatch
+) -> None:
+    """
+    Given the VNA has images, and orthanc raw has no images
+    When we process messages for the same study from two projects concurrently
+    Then the study is only queried and retrieved once, and saved in orthanc raw
+    """
+    retrieved_projects = []
+    find_and_retrieve_study = _processing._find_and_retrieve_study
+
+    async def _record_retrieval(**kwargs: Any) -> None:
+        retrieved_projects.append(kwargs["study"].message.project_name)
+        await find_and_retrieve_study(**kwargs)
+
+    monkeypatch.setattr(_processing, "_find_and_retrieve_study", _record_retrieval)
+    other_project_message = dataclasses.replace(message, project_name="other project")
+
+    await asyncio.gather(
+        process_message(message, archive=DicomModality.primary),
+        process_message(other_project_message, archive=DicomModality.primary),
+    )
+
+    assert retrieved_projects == [message.project_name]
+    study = ImagingStudy.from_message(message)
+    orthanc = await orthanc_raw
+    assert len(await study.query_local(orthanc, query_level=study.query_level)) == 1
+
+
 @pytest.mark.processing
 @pytest.mark.asyncio
 @pytest.mark.usefixtures("_add_image_to_fake_vna")
@@ -638,7 +673,7 @@ async def test_querying_pacs_during_working_hours(
 
     assert not await study.query_local(orthanc, query_level=study.query_level)
 
-    match = "Not querying secondary archive during the daytime or on the weekend."
+    match = "Not querying secondary archive outside of its schedule."
     with monkeypatch.context() as mp, pytest.raises(PixlOutOfHoursError, match=match):  # noqa: PT012
         mp.setattr(datetime, "datetime", query_date)
         await process_message(missing_message, archive=DicomModality.secondary)
@@ -0,0 +1,581 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the Orthanc REST client, using a fake Orthanc server rather than docker."""
+
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+
+import aiohttp
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+
+from pixl_imaging._batching import RetrieveBatcher
+from pixl_imaging._jobs import PendingJobsGate
+from pixl_imaging._metrics import orthanc_metrics
+from pixl_imaging._orthanc import Orthanc
+from pixl_imaging._processing import _query_remote_instances
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+class FakeOrthanc:
+    """Minimal stand-in for the Orthanc REST API, recording the connections used."""
+
+    def __init__(self) -> None:
+        self.peers: set[tuple] = set()
+        self.jobs: dict[str, dict] = {}
+        self.instances: dict[str, list[str]] = {}
+        self.find_queries: list[dict] = []
+        self.remote_studies: dict[str, list[str]] = {}
+        self.queries: dict[str, list[str]] = {}
+        self.remote_queries = 0
+        self.local_studies: set[str] = set()
+        self.unavailable_studies: set[str] = set()
+        self.moves: list[dict] = []
+        self.job_requests = 0
+        self.jobs_unavailable = False
+        self.answers_per_query = 8
+        self.child_query_delay = 0.0
+        self.child_queries = 0
+        self.failing_child_query: int | None = None
+        self.in_flight_child_queries = 0
+        self.max_in_flight_child_queries = 0
+        self.app = web.Application()
+        self.app.router.add_get("/studies", self.get_studies)
+        self.app.router.add_get("/jobs", self.get_jobs)
+        self.app.router.add_get("/jobs/{job_id}", self.get_job)
+        self.app.router.add_post("/tools/find", self.find)
+        self.app.router.add_post("/modalities/{modality}/query", self.query_modality)
+        self.app.router.add_get("/queries/{query_id}/answers", self.get_query_answers)
+        self.app.router.add_post("/modalities/{modality}/move", self.move)
+        for level in ("series", "instances"):
+            self.app.router.add_post(
+                f"/queries/{{query_id}}/answers/{{answer_id}}/query-{level}",
+                self.query_answer_children,
+            )
+
+    async def get_studies(self, request: web.Request) -> web.Response:
+        self.peers.add(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(0.01)
+        return web.json_response(["study"])
+
+    async def get_jobs(self, _request: web.Request) -> web.Response:
+        self.job_requests += 1
+        if self.jobs_unavailable:
+            raise web.HTTPInternalServerError
+        return web.json_response(list(self.jobs.values()))
+
+    async def get_job(self, request: web.Request) -> web.Response:
+        self.job_requests += 1
+        if request.match_info["job_id"] not in self.jobs:
+            raise web.HTTPNotFound
+        return web.json_response(self.jobs[request.match_info["job_id"]])
+
+    async def find(self, request: web.Request) -> web.Response:
+        query = await request.json()
+        self.find_queries.append(query)
+        if "ParentStudy" not in query:
+            study_uid = query["Query"]["StudyInstanceUID"]
+            return web.json_response([study_uid] if study_uid in self.local_studies else [])
+        instances = self.instances[query["ParentStudy"]]
+        return web.json_response(
+            [{"ID": uid, "RequestedTags": {"SOPInstanceUID": uid}} for uid in instances]
+        )
+
+    async def query_modality(self, request: web.Request) -> web.Response:
+        query = await request.json()
+        self.remote_queries += 1
+        query_id = f"query-{self.remote_queries}"
+        self.queries[query_id] = self.remote_studies.get(query["Query"]["StudyInstanceUID"], [])
+        return web.json_response({"ID": query_id})
+
+    async def get_query_answers(self, request: web.Request) -> web.Response:
+        query_id = request.match_info["query_id"]
+        if query_id not in self.queries:
+            raise web.HTTPNotFound
+        return web.json_response(self.queries[query_id])
+
+    async def query_answer_children(self, request: web.Request) -> web.Response:
+        """Query the series or instances of an answer, counting the concurrent queries."""
+        self.child_queries += 1
+        query_number = self.child_queries
+        self.in_flight_child_queries += 1
+        self.max_in_flight_child_queries = max(
+            self.max_in_flight_child_queries, self.in_flight_child_queries
+        )
+        try:
+            await asyncio.sleep(self.child_query_delay)
+            if query_number == self.failing_child_query:
+                raise web.HTTPInternalServerError
+        finally:
+            self.in_flight_child_queries -= 1
+        query_id = f"{request.match_info['query_id']}.{request.match_info['answer_id']}"
+        self.queries[query_id] = [str(answer) for answer in range(self.answers_per_query)]
+        return web.json_response({"ID": query_id})
+
+    async def move(self, request: web.Request) -> web.Response:
+        move = await request.json()
+        self.moves.append(move)
+        job_id = f"move-{len(self.moves)}"
+        moved = {resource["StudyInstanceUID"] for resource in move["Resources"]}
+        self.local_studies |= moved - self.unavailable_studies
+        self.set_job_state(job_id, "Failure" if moved & self.unavailable_studies else "Success")
+        return web.json_response({"ID": job_id})
+
+    def set_job_state(self, job_id: str, state: str) -> None:
+        self.jobs[job_id] = {
+            "ID": job_id,
+            "State": state,
+            "ErrorCode": 0 if state != "Failure" else 1,
+            "ErrorDescription": "Success" if state != "Failure" else "Error",
+        }
+
+
+@pytest_asyncio.fixture
+async def fake_orthanc() -> AsyncGenerator[tuple[FakeOrthanc, str]]:
+    fake = FakeOrthanc()
+    server = TestServer(fake.app)
+    await server.start_server()
+    yield fake, str(server.make_url("")).rstrip("/")
+    await server.close()
+
+
+def _orthanc(url: str, max_connections: int = 100) -> Orthanc:
+    return Orthanc(
+        url=url,
+        username="orthanc",
+        password="orthanc",  # noqa: S106
+        http_timeout=5,
+        dicom_timeout=5,
+        aet="PIXLRAW",
+        max_connections=max_connections,
+    )
+
+
+@pytest.mark.asyncio
+async def test_open_session_reuses_connections(fake_orthanc) -> None:
+    """
+    Given an Orthanc node with an open connection pool of one connection
+    When multiple requests are made
+    Then they all use the same keep-alive connection
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url, max_connections=1)
+    await orthanc.open()
+    try:
+        results = await asyncio.gather(*(orthanc._get("/studies") for _ in range(5)))
+    finally:
+        await orthanc.close()
+
+    assert results == [["study"]] * 5
+    assert len(fake.peers) == 1
+    assert orthanc.pool_stats["max_in_flight"] == 5
+    assert orthanc.pool_stats["in_flight"] == 0
+    assert orthanc.pool_stats["pooled"] is False
+
+
+@pytest.mark.asyncio
+async def test_requests_without_open_session(fake_orthanc) -> None:
+    """
+    Given an Orthanc node without an open connection pool
+    When requests are made
+    Then each request uses its own connection
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+
+    for _ in range(3):
+        assert await orthanc._get("/studies") == ["study"]
+
+    assert len(fake.peers) == 3
+
+
+@pytest.mark.asyncio
+async def test_jobs_are_watched_together(fake_orthanc) -> None:
+    """
+    Given several jobs running on Orthanc that finish after a short time
+    When waiting for them all to succeed
+    Then they resolve well within the maximum polling interval, from a shared polling loop
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    job_ids = [f"job-{i}" for i in range(5)]
+    for job_id in job_ids:
+        fake.set_job_state(job_id, "Running")
+
+    async def finish_jobs() -> None:
+        await asyncio.sleep(0.2)
+        for job_id in job_ids:
+            fake.set_job_state(job_id, "Success")
+
+    finishing = asyncio.create_task(finish_jobs())
+    await asyncio.wait_for(
+        asyncio.gather(
+            *(orthanc.wait_for_job_success_or_raise(job_id, "c-move", 10) for job_id in job_ids)
+        ),
+        timeout=5,
+    )
+    await finishing
+
+    assert orthanc.job_monitor.watched_jobs == 0
+    # Far fewer requests than one per job per poll
+    assert fake.job_requests < len(job_ids)
+
+
+@pytest.mark.asyncio
+async def test_failed_job_raises(fake_orthanc) -> None:
+    """
+    Given a job that fails in Orthanc
+    When waiting for it to succeed
+    Then a PixlDiscardError is raised
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    fake.set_job_state("failing", "Failure")
+
+    with pytest.raises(PixlDiscardError, match="Job failed"):
+        await orthanc.wait_for_job_success_or_raise("failing", "c-move", 10)
+
+
+@pytest.mark.asyncio
+async def test_job_timeout_raises(fake_orthanc) -> None:
+    """
+    Given a job that keeps running in Orthanc
+    When waiting for it longer than the timeout
+    Then a PixlDiscardError is raised
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    orthanc.job_monitor.max_interval = 0.1
+    fake.set_job_state("slow", "Running")
+
+    with pytest.raises(PixlDiscardError, match="Failed to finish"):
+        await orthanc.wait_for_job_success_or_raise("slow", "c-move", 0)
+
+
+@pytest.mark.asyncio
+async def test_missing_job_raises_without_affecting_others(fake_orthanc) -> None:
+    """
+    Given a job that Orthanc doesn't know about, and another job that finishes after a short time
+    When waiting for both to succeed
+    Then the missing job raises a PixlDiscardError and the other job still succeeds
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    fake.set_job_state("running", "Running")
+
+    async def finish_job() -> None:
+        await asyncio.sleep(0.2)
+        fake.set_job_state("running", "Success")
+
+    finishing = asyncio.create_task(finish_job())
+    missing, running = await asyncio.wait_for(
+        asyncio.gather(
+            orthanc.wait_for_job_success_or_raise("missing", "c-move", 10),
+            orthanc.wait_for_job_success_or_raise("running", "c-move", 10),
+            return_exceptions=True,
+        ),
+        timeout=5,
+    )
+    await finishing
+
+    assert isinstance(missing, PixlDiscardError)
+    assert "not found" in str(missing)
+    assert running is None
+
+
+@pytest.mark.asyncio
+async def test_unreachable_jobs_raise(fake_orthanc) -> None:
+    """
+    Given an Orthanc node whose jobs can't be fetched
+    When waiting for a job to succeed
+    Then a PixlDiscardError is raised after the maximum number of failed polls
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.01
+    orthanc.job_monitor.max_interval = 0.01
+    orthanc.job_monitor.max_failed_polls = 3
+    fake.set_job_state("job", "Running")
+    fake.jobs_unavailable = True
+
+    with pytest.raises(PixlDiscardError, match="3 times in a row"):
+        await asyncio.wait_for(orthanc.wait_for_job_success_or_raise("job", "c-move", 10), 5)
+    assert fake.job_requests == 3
+
+
+@pytest.mark.asyncio
+async def test_job_timeout_runs_while_polls_fail(fake_orthanc) -> None:
+    """
+    Given an Orthanc node whose jobs can't be fetched
+    When waiting for a job for longer than its timeout
+    Then a PixlDiscardError is raised for the timeout, counted from when the job was watched
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    orthanc.job_monitor.max_interval = 0.05
+    orthanc.job_monitor.max_failed_polls = 1000
+    fake.jobs_unavailable = True
+
+    with pytest.raises(PixlDiscardError, match="Failed to finish"):
+        await asyncio.wait_for(orthanc.wait_for_job_success_or_raise("job", "c-move", 0), 5)
+
+
+@pytest.mark.asyncio
+async def test_pending_jobs_gate(fake_orthanc) -> None:
+    """
+    Given two pending jobs in Orthanc and a gate allowing up to one pending job
+    When messages are admitted
+    Then they're requeued until a job has started, using the cached snapshot of jobs in between
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    gate = PendingJobsGate(orthanc, max_pending_jobs=1, refresh_interval=60)
+    fake.set_job_state("first", "Pending")
+    fake.set_job_state("second", "Pending")
+
+    for _ in range(3):
+        with pytest.raises(PixlRequeueMessageError):
+            await gate.admit_or_raise()
+    assert fake.job_requests == 1
+
+    fake.set_job_state("first", "Running")
+    await orthanc.job_monitor.refresh()
+    await gate.admit_or_raise()
+
+    assert gate.snapshot.pending == 1
+    assert gate.snapshot.running == 1
+    # The admitted message may have submitted another pending job
+    assert not gate.is_open
+
+
+@pytest.mark.asyncio
+async def test_pending_jobs_gate_counts_admissions(fake_orthanc) -> None:
+    """
+    Given a snapshot without pending jobs and a gate allowing up to one pending job
+    When several messages are admitted against that snapshot, each submitting a job
+    Then the admissions count as pending jobs, and once they're over the limit the snapshot is
+    refreshed before the next message is requeued
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    gate = PendingJobsGate(orthanc, max_pending_jobs=1, refresh_interval=60)
+    await orthanc.job_monitor.refresh()
+
+    for job_id in ("first", "second"):
+        await gate.admit_or_raise()
+        fake.set_job_state(job_id, "Pending")
+    assert fake.job_requests == 1
+    assert gate.admitted == 2
+
+    with pytest.raises(PixlRequeueMessageError):
+        await gate.admit_or_raise()
+    assert fake.job_requests == 2
+    assert gate.pending_jobs == 2
+    assert gate.admitted == 0
+
+
+@pytest.mark.asyncio
+async def test_local_sop_instance_uids(fake_orthanc) -> None:
+    """
+    Given a study in Orthanc with several instances
+    When getting the SOPInstanceUIDs of the study
+    Then they're returned as a set from a single instance-level query
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    fake.instances["study"] = ["1.2.3.1", "1.2.3.2", "1.2.3.3"]
+
+    uids = await orthanc.get_local_sop_instance_uids(resource_type="studies", resource_id="study")
+
+    assert uids == {"1.2.3.1", "1.2.3.2", "1.2.3.3"}
+    assert len(fake.find_queries) == 1
+    assert fake.find_queries[0]["Level"] == "Instance"
+    assert fake.find_queries[0]["RequestedTags"] == ["SOPInstanceUID"]
+
+
+@pytest.mark.asyncio
+async def test_remote_queries_are_cached(fake_orthanc) -> None:
+    """
+    Given a study in the archive and a study missing from it
+    When each is queried repeatedly
+    Then the archive is only queried again once Orthanc has dropped the cached query
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    fake.remote_studies["1.2.3"] = ["0"]
+    query = {"Level": "Study", "Query": {"StudyInstanceUID": "1.2.3"}}
+    missing_query = {"Level": "Study", "Query": {"StudyInstanceUID": "4.5.6"}}
+
+    query_id = await orthanc.query_remote(query, modality="PRIMARYQR")
+    assert await orthanc.query_remote(query, modality="PRIMARYQR") == query_id
+    assert await orthanc.query_remote(missing_query, modality="PRIMARYQR") is None
+    assert await orthanc.query_remote(missing_query, modality="PRIMARYQR") is None
+    assert fake.remote_queries == 2
+
+    del fake.queries[query_id]
+    assert await orthanc.query_remote(query, modality="PRIMARYQR") not in (None, query_id)
+    assert fake.remote_queries == 3
+    assert orthanc.query_cache.stats["hits"] == 2
+    assert orthanc.query_cache.stats["misses"] == 3
+
+
+@pytest.mark.asyncio
+async def test_retrievals_are_batched(fake_orthanc) -> None:
+    """
+    Given a batch size of two, and a study that the archive fails to send
+    When three studies are retrieved at once
+    Then they're retrieved in two C-MOVEs, and only the study that wasn't sent fails
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    batcher = RetrieveBatcher(orthanc, batch_size=2, window=0.1)
+    fake.unavailable_studies.add("3")
+
+    results = await asyncio.gather(
+        *(
+            batcher.retrieve("PRIMARYQR", level="Study", resources=[{"StudyInstanceUID": uid}])
+            for uid in ("1", "2", "3")
+        ),
+        return_exceptions=True,
+    )
+
+    assert results[:2] == [True, True]
+    assert isinstance(results[2], PixlDiscardError)
+    assert [len(move["Resources"]) for move in fake.moves] == [2, 1]
+    assert fake.local_studies == {"1", "2"}
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_not_complete(fake_orthanc) -> None:
+    """
+    Given a batch of two studies, one of which the archive fails to send so the C-MOVE fails
+    When the studies are retrieved
+    Then the study that was moved is reported as needing a check for missing instances
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    batcher = RetrieveBatcher(orthanc, batch_size=2, window=0.1)
+    fake.unavailable_studies.add("2")
+
+    moved, failed = await asyncio.gather(
+        *(
+            batcher.retrieve("PRIMARYQR", level="Study", resources=[{"StudyInstanceUID": uid}])
+            for uid in ("1", "2")
+        ),
+        return_exceptions=True,
+    )
+
+    assert moved is False
+    assert isinstance(failed, PixlDiscardError)
+    assert "Job failed" in str(failed)
+
+
+@pytest.mark.asyncio
+async def test_requests_and_jobs_are_measured(fake_orthanc) -> None:
+    """
+    Given a job that succeeds in Orthanc
+    When waiting for it, and requesting a missing resource
+    Then the durations of the requests and the job are recorded against their endpoint templates
+    """
+    fake, url = fake_orthanc
+    orthanc = _orthanc(url)
+    orthanc.job_monitor.min_interval = 0.05
+    fake.set_job_state("measured", "Success")
+
+    await orthanc.wait_for_job_success_or_raise("measured", "measured job", 10)
+    with pytest.raises(aiohttp.ClientResponseError):
+        await orthanc.get_remote_query_answers("missing")
+
+    metrics = orthanc_metrics.prometheus_text()
+    assert (
+        'pixl_orthanc_request_duration_seconds_count{aet="PIXLRAW",endpoint="/jobs",'
+        'method="GET",status="200"}'
+    ) in metrics
+    assert (
+        'pixl_orthanc_request_duration_seconds_count{aet="PIXLRAW",'
+        'endpoint="/queries/{id}/answers",method="GET",status="404"}'
+    ) in metrics
+    assert (
+        'pixl_orthanc_job_duration_seconds_count{aet="PIXLRAW",job_type="measured job",'
+        'outcome="success"} 1'
+    ) in metrics
+
+
+@pytest.mark.asyncio
+async def test_remote_instance_queries_are_bounded(fake_orthanc) -> None:
+    """
+    Given two messages querying the instances of studies with many series in the same archive
+    When the instances are queried concurrently
+    Then no more than the archive's max concurrent queries are in flight at once, across messages
+    """
+    fake, url = fake_orthanc
+    fake.child_query_delay = 0.01
+    fake.queries = {"first": ["0"], "second": ["0"]}
+    orthanc = _orthanc(url)
+    semaphore = orthanc.modality_semaphore("PRIMARYQR", 2)
+    study = SimpleNamespace(query_level="Study")
+
+    answers = await asyncio.gather(
+        *(
+            _query_remote_instances(orthanc, study, query_id, semaphore)
+            for query_id in ("first", "second")
+        )
+    )
+
+    assert [len(instances) for instances in answers] == [8 * 8, 8 * 8]
+    assert fake.child_queries == 2 * (1 + 8)
+    assert fake.max_in_flight_child_queries == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_remote_instance_query_cancels_the_rest(fake_orthanc) -> None:
+    """
+    Given a study with many series, where querying the instances of one series fails
+    When the instances are queried
+    Then the error is raised, and the queries that were waiting to be sent are cancelled
+    """
+    fake, url = fake_orthanc
+    fake.child_query_delay = 0.01
+    fake.queries = {"study": ["0"]}
+    # The first query is for the series of the study, then one query per series
+    fake.failing_child_query = 2
+    orthanc = _orthanc(url)
+    semaphore = orthanc.modality_semaphore("PRIMARYQR", 2)
+    study = SimpleNamespace(query_level="Study")
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await _query_remote_instances(orthanc, study, "study", semaphore)
+    queries_sent = fake.child_queries
+    await asyncio.sleep(0.1)
+
+    assert queries_sent < 1 + 8
+    assert fake.child_queries == queries_sent
+    assert fake.in_flight_child_queries == 0
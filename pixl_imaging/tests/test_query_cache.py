@@ -0,0 +1,98 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the cache of remote archive queries."""
+
+from __future__ import annotations
+
+import time
+
+from pixl_imaging._query_cache import QueryCache
+
+
+def _query(study_uid: str) -> dict:
+    return {"Level": "Study", "Query": {"StudyInstanceUID": study_uid}}
+
+
+def test_least_recently_used_query_is_evicted() -> None:
+    """
+    Given a full cache
+    When another query is cached
+    Then the least recently used query is evicted
+    """
+    cache = QueryCache(ttl=60, max_size=2, negative_ttl=60)
+    cache.put("PRIMARYQR", _query("1"), query_id="a", answers=["0"])
+    cache.put("PRIMARYQR", _query("2"), query_id=None, answers=[])
+    assert cache.get("PRIMARYQR", _query("1")) is not None
+
+    cache.put("PRIMARYQR", _query("3"), query_id="c", answers=["0"])
+
+    assert cache.get("PRIMARYQR", _query("2")) is None
+    assert cache.get("PRIMARYQR", _query("1")).query_id == "a"
+    assert cache.get("SECONDARYQR", _query("1")) is None
+    assert cache.stats == {
+        "size": 2,
+        "max_size": 2,
+        "ttl": 60,
+        "negative_ttl": 60,
+        "hits": 2,
+        "misses": 2,
+    }
+
+
+def test_expired_queries_are_misses() -> None:
+    """
+    Given a cached query with its instances
+    When the query has expired
+    Then it's a miss, and can no longer be found by its query ID
+    """
+    cache = QueryCache(ttl=0.05, max_size=10)
+    entry = cache.put("PRIMARYQR", _query("1"), query_id="a", answers=["0"])
+    entry.instance_count = 3
+    assert cache.get_by_query_id("a") is entry
+
+    time.sleep(0.1)
+
+    assert cache.get("PRIMARYQR", _query("1")) is None
+    assert cache.get_by_query_id("a") is None
+    assert cache.stats["misses"] == 1
+
+
+def test_empty_queries_expire_sooner() -> None:
+    """
+    Given a cache with a short TTL for queries that found nothing
+    When a query that found nothing and one that found a study are cached
+    Then the query that found nothing expires first
+    """
+    cache = QueryCache(ttl=60, max_size=10, negative_ttl=0.05)
+    cache.put("PRIMARYQR", _query("1"), query_id=None, answers=[])
+    cache.put("PRIMARYQR", _query("2"), query_id="b", answers=["0"])
+    assert cache.get("PRIMARYQR", _query("1")) is not None
+
+    time.sleep(0.1)
+
+    assert cache.get("PRIMARYQR", _query("1")) is None
+    assert cache.get("PRIMARYQR", _query("2")).query_id == "b"
+
+
+def test_empty_queries_are_not_cached_without_negative_ttl() -> None:
+    """
+    Given a cache without a TTL for queries that found nothing
+    When a query that found nothing is cached
+    Then it isn't found in the cache
+    """
+    cache = QueryCache(ttl=60, max_size=10)
+    cache.put("PRIMARYQR", _query("1"), query_id=None, answers=[])
+
+    assert cache.get("PRIMARYQR", _query("1")) is None
+    assert cache.stats["size"] == 0
@@ -0,0 +1,144 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the extraction rate controller."""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections import deque
+from time import time
+from types import SimpleNamespace
+
+import pytest
+from core.token_buffer import TokenBucket
+
+from pixl_imaging._jobs import OrthancOperation
+from pixl_imaging._rate_controller import RateController
+
+
+@pytest.fixture
+def orthanc_raw() -> SimpleNamespace:
+    """Just enough of Orthanc Raw for the rate controller."""
+    return SimpleNamespace(
+        recent_operations=deque(),
+        pending_jobs_gate=SimpleNamespace(over_limit=False, pending_jobs=0),
+    )
+
+
+def _operation(kind: str, duration: float = 1, *, failed: bool = False) -> OrthancOperation:
+    return OrthancOperation(kind=kind, duration=duration, failed=failed, finished_at=time())
+
+
+def test_rate_increases_additively_up_to_max(orthanc_raw) -> None:
+    """
+    Given queries and retrievals within their target durations
+    When the rate is adjusted repeatedly
+    Then it increases by a fixed step until it reaches the maximum rate
+    """
+    bucket = TokenBucket(rate=1, capacity=5)
+    controller = RateController(bucket, orthanc_raw, min_rate=0.5, max_rate=2, increase=0.5)
+
+    rates = []
+    for _ in range(3):
+        orthanc_raw.recent_operations.extend([_operation("c-find"), _operation("c-move")])
+        controller.adjust()
+        rates.append(bucket.rate)
+
+    assert rates == [1.5, 2, 2]
+    assert len(controller.status.decisions) == 2
+    assert controller.status.decisions[-1].new_rate == 2
+
+
+@pytest.mark.parametrize(
+    ("kind", "duration", "failed", "too_many_pending_jobs"),
+    [
+        ("c-move", 1, True, False),
+        ("c-find", 30, False, False),
+        ("c-move", 300, False, False),
+        ("c-find", 1, False, True),
+    ],
+)
+def test_rate_decreases_multiplicatively_down_to_min(
+    orthanc_raw, kind, duration, failed, too_many_pending_jobs
+) -> None:
+    """
+    Given a failure, a slow query or retrieval, or too many pending jobs in Orthanc Raw
+    When the rate is adjusted
+    Then it's halved, but not below the minimum rate
+    """
+    bucket = TokenBucket(rate=4, capacity=5)
+    controller = RateController(bucket, orthanc_raw, min_rate=1.5, max_rate=10, decrease=0.5)
+    orthanc_raw.pending_jobs_gate.over_limit = too_many_pending_jobs
+
+    orthanc_raw.recent_operations.append(_operation(kind, duration, failed=failed))
+    controller.adjust()
+    assert bucket.rate == 2
+
+    orthanc_raw.recent_operations.append(_operation(kind, duration, failed=failed))
+    controller.adjust()
+    assert bucket.rate == 1.5
+
+
+def test_batched_retrievals_not_held_to_move_latency(orthanc_raw) -> None:
+    """
+    Given a batched retrieval that took longer than a single study's retrieval should
+    When the rate is adjusted
+    Then it's increased, as a batch's duration grows with the number of studies in it
+    """
+    bucket = TokenBucket(rate=1, capacity=5)
+    controller = RateController(bucket, orthanc_raw, min_rate=0.5, max_rate=2, move_latency=120)
+
+    orthanc_raw.recent_operations.append(_operation("batched c-move", 300))
+    controller.adjust()
+
+    assert bucket.rate == 1.5
+
+
+def test_rate_unchanged_when_paused_or_idle(orthanc_raw) -> None:
+    """
+    Given a rate of 0, or no queries or retrievals since the last adjustment
+    When the rate is adjusted
+    Then it's left unchanged
+    """
+    bucket = TokenBucket(rate=0, capacity=5)
+    controller = RateController(bucket, orthanc_raw, min_rate=1, max_rate=10)
+
+    orthanc_raw.recent_operations.append(_operation("c-find"))
+    assert controller.adjust() is None
+    assert bucket.rate == 0
+
+    bucket.rate = 2.0
+    assert controller.adjust() is None
+    assert bucket.rate == 2
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_adjusted_from_a_thread(orthanc_raw, monkeypatch) -> None:
+    """
+    Given a token bucket whose rate is shared through the database
+    When the controller runs
+    Then the rate is adjusted from a thread, so the event loop isn't blocked on the database
+    """
+    monkeypatch.setattr(TokenBucket, "is_shared", property(lambda _self: True))
+    controller = RateController(TokenBucket(), orthanc_raw, min_rate=1, max_rate=10, interval=0.01)
+    adjusted_from = []
+    monkeypatch.setattr(controller, "adjust", lambda: adjusted_from.append(threading.get_ident()))
+
+    controller.start()
+    await asyncio.sleep(0.1)
+    await controller.stop()
+
+    assert adjusted_from
+    assert threading.get_ident() not in adjusted_from
@@ -0,0 +1,154 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the schedule of consumption from the secondary archive."""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+from unittest.mock import Mock, patch
+from zoneinfo import ZoneInfo
+
+import pytest
+from core.token_buffer import TokenBucket
+from core.token_buffer.storage import KeyRate
+
+from pixl_imaging._schedule import ConsumptionSchedule, ConsumptionScheduler, ScheduleWindow
+
+LONDON = ZoneInfo("Europe/London")
+OUT_OF_HOURS = "Mon-Fri 00:00-08:00, Mon-Fri 20:00-24:00"
+
+
+@pytest.mark.parametrize(
+    ("moment", "is_open"),
+    [
+        (datetime.datetime(2024, 1, 1, 2, 0, tzinfo=LONDON), True),  # Monday
+        (datetime.datetime(2024, 1, 1, 11, 0, tzinfo=LONDON), False),
+        (datetime.datetime(2024, 1, 1, 20, 0, tzinfo=LONDON), True),
+        (datetime.datetime(2024, 1, 5, 23, 59, tzinfo=LONDON), True),  # Friday
+        (datetime.datetime(2024, 1, 6, 2, 0, tzinfo=LONDON), False),  # Saturday
+        (datetime.datetime(2024, 1, 1, 12, 0, tzinfo=datetime.UTC), False),
+    ],
+)
+def test_schedule_is_open(moment, is_open) -> None:
+    """The default schedule is only open on weekdays, outside of working hours."""
+    schedule = ConsumptionSchedule.parse(OUT_OF_HOURS, timezone="Europe/London")
+    assert schedule.is_open(moment) is is_open
+
+
+@pytest.mark.parametrize(
+    ("moment", "next_change"),
+    [
+        # Monday morning, closes at 8am
+        (
+            datetime.datetime(2024, 1, 1, 2, 0, tzinfo=LONDON),
+            datetime.datetime(2024, 1, 1, 8, 0, tzinfo=LONDON),
+        ),
+        # Monday working hours, opens at 8pm
+        (
+            datetime.datetime(2024, 1, 1, 11, 0, tzinfo=LONDON),
+            datetime.datetime(2024, 1, 1, 20, 0, tzinfo=LONDON),
+        ),
+        # Monday evening, stays open over midnight until Tuesday 8am
+        (
+            datetime.datetime(2024, 1, 1, 22, 0, tzinfo=LONDON),
+            datetime.datetime(2024, 1, 2, 8, 0, tzinfo=LONDON),
+        ),
+        # Friday evening, closes at midnight for the weekend
+        (
+            datetime.datetime(2024, 1, 5, 22, 0, tzinfo=LONDON),
+            datetime.datetime(2024, 1, 6, 0, 0, tzinfo=LONDON),
+        ),
+        # Saturday, opens on Monday
+        (
+            datetime.datetime(2024, 1, 6, 2, 0, tzinfo=LONDON),
+            datetime.datetime(2024, 1, 8, 0, 0, tzinfo=LONDON),
+        ),
+    ],
+)
+def test_schedule_next_change(moment, next_change) -> None:
+    """The next change skips window boundaries that don't open or close the schedule."""
+    schedule = ConsumptionSchedule.parse(OUT_OF_HOURS, timezone="Europe/London")
+    assert schedule.next_change(moment.replace(tzinfo=LONDON)) == next_change.replace(tzinfo=LONDON)
+
+
+def test_always_open_schedule_never_changes() -> None:
+    schedule = ConsumptionSchedule.parse("Mon-Sun 00:00-24:00", timezone="Europe/London")
+    assert schedule.is_open()
+    assert schedule.next_change() is None
+
+
+@pytest.mark.parametrize("window", ["Weekdays 00:00-08:00", "Mon-Fri 08:00-02:00", "Mon 8-9"])
+def test_invalid_window(window) -> None:
+    with pytest.raises(ValueError, match="Schedule window must"):
+        ScheduleWindow.parse(window)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_pauses_and_ramps_up_consumer() -> None:
+    """
+    Given a schedule that is closed
+    When the scheduler follows it
+    Then the consumer's key has no tokens and the consumer is paused,
+    And when the schedule opens the key's rate is ramped up to the token bucket's rate
+    """
+    schedule = Mock(spec=ConsumptionSchedule)
+    schedule.is_open.return_value = False
+    bucket = TokenBucket(rate=2, capacity=5)
+    consumer = Mock(token_bucket_key="secondary", queue_name="imaging-secondary")  # noqa: S106
+    scheduler = ConsumptionScheduler(schedule, bucket, consumer, ramp=0, ramp_steps=4)
+
+    scheduler.close()
+    consumer.pause.assert_called_once()
+    assert not bucket.has_token(key="secondary")
+    assert bucket.has_token(key="primary")
+
+    rates = []
+    original_sleep = asyncio.sleep
+
+    async def record_rate(_seconds: float) -> None:
+        rates.append(bucket.rate_for("secondary"))
+        await original_sleep(0)
+
+    schedule.is_open.return_value = True
+    with patch("pixl_imaging._schedule.asyncio.sleep", record_rate):
+        await scheduler.open()
+
+    assert rates == [0.5, 1, 1.5]
+    assert bucket.rate_for("secondary") == 2
+    assert not bucket.has_key_rate("secondary")
+
+
+@pytest.mark.asyncio
+async def test_scheduler_keeps_key_rate() -> None:
+    """
+    Given the secondary key has its own rate
+    When the schedule closes and opens again
+    Then the key's rate is paused and ramped up to its own rate, which is left as it was set
+    """
+    schedule = Mock(spec=ConsumptionSchedule)
+    bucket = TokenBucket(rate=2, capacity=5)
+    bucket.set_key_rate("secondary", rate=0.5, capacity=2)
+    consumer = Mock(token_bucket_key="secondary", queue_name="imaging-secondary")  # noqa: S106
+    scheduler = ConsumptionScheduler(schedule, bucket, consumer, ramp=0, ramp_steps=2)
+
+    scheduler.close()
+    assert bucket.rate_for("secondary") == 0
+    assert bucket.key_rates == {"secondary": KeyRate(rate=0.5, capacity=2)}
+
+    schedule.is_open.return_value = True
+    await scheduler.open()
+
+    assert bucket.rate_for("secondary") == 0.5
+    assert bucket.key_rates == {"secondary": KeyRate(rate=0.5, capacity=2)}
@@ -0,0 +1,135 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the supervisor of the imaging workers."""
+
+from __future__ import annotations
+
+import queue
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+from core.patient_queue.stats import ConsumerStats, Outcome
+from core.token_buffer import TokenBucket
+from core.token_buffer.models import RateControllerStatus
+
+from pixl_imaging._consumers import QUEUE_NAME, SECONDARY_QUEUE_NAME
+from pixl_imaging._metrics import LocalMetrics
+from pixl_imaging._workers import WorkerPool, WorkerReport
+
+
+def _report(index: int, successes: int, *, paused: bool) -> WorkerReport:
+    stats = {}
+    for name in (QUEUE_NAME, SECONDARY_QUEUE_NAME):
+        stats[name] = ConsumerStats(name)
+        for latency in range(successes):
+            stats[name].started()
+            stats[name].finished(Outcome.success, latency=latency)
+        stats[name].started()
+    return WorkerReport(
+        index=index,
+        stats=stats,
+        paused={QUEUE_NAME: paused, SECONDARY_QUEUE_NAME: True},
+        rate_controller=RateControllerStatus(min_rate=0.1, max_rate=10) if index == 0 else None,
+    )
+
+
+def test_workers_need_shared_token_bucket() -> None:
+    state = SimpleNamespace(token_bucket=TokenBucket(), rate_controller=None)
+    with pytest.raises(ValueError, match="PIXL_TOKEN_BUCKET_STORAGE must be 'database'"):
+        WorkerPool(2, state)
+
+
+def test_worker_stats_combined() -> None:
+    """
+    Given reports from each worker
+    When the status of a queue's consumers is requested
+    Then the statistics of the workers are combined, and the rate controller status is kept
+    """
+    token_bucket = Mock(is_shared=True)
+    token_bucket.rate_for.return_value = 2
+    token_bucket.seconds_until_token.return_value = 0
+    state = SimpleNamespace(token_bucket=token_bucket, rate_controller=None)
+    pool = WorkerPool(2, state)
+    pool._reports_queue = queue.Queue()
+    pool._reports_queue.put(_report(0, 1, paused=True))
+    pool._reports_queue.put(_report(1, 2, paused=False))
+    pool._reports_queue.put(_report(1, 3, paused=False))
+
+    pool.collect_reports()
+
+    status = pool.consumers[QUEUE_NAME].status()
+    assert status.in_flight == 2
+    assert status.outcomes[Outcome.success] == 4
+    assert status.latency_percentiles["p50"] == 0.5
+    assert status.tokens.rate == 2
+    assert not status.tokens.paused
+    assert pool.consumers[SECONDARY_QUEUE_NAME].status().tokens.paused
+    assert state.rate_controller.max_rate == 10
+
+
+def _orthanc_report(index: int, in_flight: int, hits: int) -> WorkerReport:
+    metrics = LocalMetrics()
+    metrics.request_duration.record(0.1, {"aet": "PIXLRAW", "endpoint": "/jobs"})
+    pool_stats = {
+        "url": "http://orthanc-raw:8042",
+        "pooled": True,
+        "max_connections": 100,
+        "in_flight": in_flight,
+        "waiting": 0,
+        "max_in_flight": in_flight,
+    }
+    return WorkerReport(
+        index=index,
+        stats={},
+        paused={},
+        connection_pools={"orthanc-raw": pool_stats, "orthanc-anon": pool_stats},
+        query_cache={
+            "size": hits,
+            "max_size": 1000,
+            "ttl": 600,
+            "negative_ttl": 30,
+            "hits": hits,
+            "misses": 1,
+        },
+        metrics=metrics,
+    )
+
+
+def test_worker_orthanc_stats_combined() -> None:
+    """
+    Given reports from each worker of their Orthanc connection pools, query cache and metrics
+    When they are requested from the supervisor
+    Then the workers' statistics are combined
+    """
+    state = SimpleNamespace(token_bucket=Mock(is_shared=True), rate_controller=None)
+    pool = WorkerPool(2, state)
+    pool._reports_queue = queue.Queue()
+    pool._reports_queue.put(_orthanc_report(0, in_flight=2, hits=3))
+    pool._reports_queue.put(_orthanc_report(1, in_flight=5, hits=4))
+
+    pool.collect_reports()
+
+    connection_pools = pool.connection_pools()
+    assert connection_pools["orthanc-raw"]["in_flight"] == 7
+    assert connection_pools["orthanc-raw"]["max_connections"] == 200
+    assert connection_pools["orthanc-raw"]["processes"] == 2
+    query_cache = pool.query_cache()
+    assert query_cache["hits"] == 7
+    assert query_cache["misses"] == 2
+    assert query_cache["ttl"] == 600
+    assert (
+        'pixl_orthanc_request_duration_seconds_count{aet="PIXLRAW",endpoint="/jobs"} 2'
+        in pool.metrics().prometheus_text()
+    )
@@ -0,0 +1,103 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Compare the throughput of anonymising an instance with the tag operations of base.yaml in a single
+pass with enforcing the allowlist and then applying the tag actions in separate passes, as it was
+done before.
+
+Run from the root of the repo with the pixl_dcmd environment, including its test dependencies, e.g.
+    uv run python scripts/benchmark_anonymisation.py --number 500
+"""
+
+from __future__ import annotations
+
+import argparse
+import timeit
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+
+from core.project_config.tag_operations import _load_scheme
+from dicomanonymizer.simpledicomanonymizer import anonymize_dataset
+from pixl_dcmd import main as pixl_dcmd
+from pydicom import Dataset, dcmread
+from pytest_pixl.dicom import generate_dicom_dataset
+
+BASE_TAG_OPERATIONS = Path(__file__).parents[1] / "projects/configs/tag-operations/base.yaml"
+
+
+def _hash_values(pat_value: str, project_slug: str, hash_len: int = 0) -> str:
+    return f"{project_slug}-{pat_value}"[:hash_len]
+
+
+def _anonymise_recursively(dataset: Dataset, tag_actions: dict) -> None:
+    anonymize_dataset(dataset, tag_actions, delete_private_tags=False)
+    for data_element in dataset:
+        if data_element.VR == "SQ":
+            for item in data_element.value:
+                _anonymise_recursively(item, tag_actions)
+
+
+def _separate_passes(
+    dataset: Dataset, plan: pixl_dcmd.AnonymisationPlan, tag_actions: dict
+) -> None:
+    pixl_dcmd._delete_tags_not_allowed(dataset, plan.allowed_tags, recursive=True)  # noqa: SLF001
+    _anonymise_recursively(dataset, tag_actions)
+
+
+def _single_pass(dataset: Dataset, plan: pixl_dcmd.AnonymisationPlan, _tag_actions: dict) -> None:
+    pixl_dcmd._anonymise_dataset(dataset, plan.tag_actions, plan.allowed_tags)  # noqa: SLF001
+
+
+def main() -> None:
+    """Time anonymising an instance in a single pass and in separate passes."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=500, help="instances to anonymise")
+    args = parser.parse_args()
+
+    tag_scheme = _load_scheme(BASE_TAG_OPERATIONS)
+    tag_actions = pixl_dcmd._convert_schema_to_actions("benchmark", tag_scheme)  # noqa: SLF001
+    # Both are timed with the tags and actions compiled once, as they are for each project
+    plan = pixl_dcmd.AnonymisationPlan(
+        tag_scheme=tag_scheme,
+        allowed_tags=pixl_dcmd._allowed_tags(tag_scheme),  # noqa: SLF001
+        tag_actions=pixl_dcmd._compile_tag_actions(tag_actions),  # noqa: SLF001
+    )
+    dataset = generate_dicom_dataset(Modality="DX")
+    # Add a sequence, so that the items of sequences are anonymised too
+    dataset.ReferencedStudySequence = [generate_dicom_dataset(Modality="DX") for _ in range(3)]
+    instance = pixl_dcmd.write_dataset_to_bytes(dataset)
+    elements = len(list(dataset.iterall()))
+    print(f"{len(tag_scheme)} tags in base.yaml, {elements} elements per instance")  # noqa: T201
+
+    # Securely hashing calls the hasher API, which isn't part of the timings
+    with patch.object(pixl_dcmd, "_hash_values", _hash_values):
+        for name, anonymise in (("separate", _separate_passes), ("single", _single_pass)):
+            duration = timeit.timeit(
+                "anonymise(dcmread(BytesIO(instance)), plan, tag_actions)",
+                globals={
+                    "anonymise": anonymise,
+                    "dcmread": dcmread,
+                    "BytesIO": BytesIO,
+                    "instance": instance,
+                    "plan": plan,
+                    "tag_actions": tag_actions,
+                },
+                number=args.number,
+            )
+            print(f"{name:<8} {args.number / duration:>10,.0f} instances/s")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Compare the cost of validating an instance when the DICOM standard is loaded for every instance,
+as it was before it was cached, with loading it once per process.
+
+Run from the root of the repo with the pixl_dcmd environment, including its test dependencies, e.g.
+    uv run python scripts/benchmark_dicom_validation.py --number 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import timeit
+
+from pixl_dcmd import dicom_helpers
+from pixl_dcmd.dicom_helpers import DicomValidator, load_dicom_info
+from pydicom import Dataset
+from pytest_pixl.dicom import generate_dicom_dataset
+
+
+def _validate(dataset: Dataset, edition: str) -> None:
+    validator = DicomValidator(edition=edition)
+    validator.validate_original(dataset)
+    validator.validate_anonymised(dataset)
+
+
+def _validate_uncached(dataset: Dataset, edition: str) -> None:
+    dicom_helpers._dicom_info.clear()  # noqa: SLF001
+    _validate(dataset, edition)
+
+
+def main() -> None:
+    """Time validating an instance with and without the cached DICOM standard."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20, help="instances to validate")
+    parser.add_argument("--edition", default="2024e", help="edition of the DICOM standard")
+    args = parser.parse_args()
+
+    dataset = generate_dicom_dataset(Modality="DX")
+    # Download the edition if needed, so that it isn't part of the timings
+    load_dicom_info(args.edition)
+
+    for name, validate in (("uncached", _validate_uncached), ("cached", _validate)):
+        duration = timeit.timeit(
+            "validate(dataset, edition)",
+            globals={"validate": validate, "dataset": dataset, "edition": args.edition},
+            number=args.number,
+        )
+        print(f"{name:<8} {duration / args.number * 1000:>10.1f} ms/instance")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
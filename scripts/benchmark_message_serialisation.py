@@ -0,0 +1,78 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Compare the compact message serialisation with the legacy jsonpickle serialisation.
+
+Run from the root of the repo with the pixl_core environment, e.g.
+    uv run python scripts/benchmark_message_serialisation.py --number 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import timeit
+
+from core.patient_queue.message import Message, deserialise
+from jsonpickle import decode, encode
+
+MESSAGE = Message(
+    mrn="12345678",
+    accession_number="ABC123456789",
+    study_uid="1.2.826.0.1.3680043.8.498.12345678901234567890123456789012",
+    series_uid="",
+    study_date=datetime.date(2024, 1, 1),
+    procedure_occurrence_id=123456,
+    project_name="my-project",
+    extract_generated_timestamp=datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.UTC),
+)
+
+
+def _report(name: str, body: bytes, encode_time: float, decode_time: float, number: int) -> None:
+    print(  # noqa: T201
+        f"{name:<8} {len(body):>6} bytes/message  "
+        f"encode {number / encode_time:>10,.0f} messages/s  "
+        f"decode {number / decode_time:>10,.0f} messages/s"
+    )
+
+
+def main() -> None:
+    """Time encoding and decoding a message in each format."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=50_000, help="messages to encode and decode")
+    args = parser.parse_args()
+
+    compact_body = MESSAGE.serialise()
+    assert deserialise(compact_body) == MESSAGE  # noqa: S101
+    _report(
+        "compact",
+        compact_body,
+        timeit.timeit(MESSAGE.serialise, number=args.number),
+        timeit.timeit(lambda: deserialise(compact_body), number=args.number),
+        args.number,
+    )
+
+    legacy_body = encode(MESSAGE).encode()
+    assert decode(legacy_body) == MESSAGE  # noqa: S101, S301
+    _report(
+        "legacy",
+        legacy_body,
+        timeit.timeit(lambda: encode(MESSAGE).encode(), number=args.number),
+        timeit.timeit(lambda: deserialise(legacy_body), number=args.number),
+        args.number,
+    )
+
+
+if __name__ == "__main__":
+    main()